@@ -1,13 +1,20 @@
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.contrib import admin
-from django.contrib.admin.views.main import ChangeList
+from django.contrib.admin.views.main import ChangeList, ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, \
+    IS_POPUP_VAR
 from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 from django.http import HttpResponse
+from django.utils.hashcompat import md5_constructor
 from easytree import utils
-from easytree.forms import BaseEasyTreeForm
+from easytree.closure import get_closure
+from easytree.forms import BaseEasyTreeForm, node_label
 from easytree.exceptions import EasyTreeException
+from easytree.versions import get_versions, condition_on_tree
 from django.db import transaction, connection
+from django.db.models import Q
+import operator
 import django.contrib.admin.views.main
 
 class EasyTreeChangeList(ChangeList):
@@ -18,15 +25,27 @@ class EasyTreeChangeList(ChangeList):
     If no ordering is specified in your EasyTreeAdmin derived model admin, 
     querysets will be ordered by default using BOTH ``tree_id`` and ``lft``;
     this tecnique allows to overcome the segmentation of the tree induced by 
-    pagination facilities when ordering only by ``lft``.
-    
+    pagination facilities when ordering only by ``lft``. Models using the
+    closure storage are ordered by ``tree_id`` and in DFS order instead.
     
+    With ``lazy_changelist``, only the root nodes are listed unless the list
+    is searched or filtered.
     """
     _easytree_patched = True
+
+    def is_filtered(self):
+        return bool(self.query or [key for key in self.params
+            if key not in (ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, IS_POPUP_VAR)])
+
     def get_query_set(self):
         qs = super(EasyTreeChangeList, self).get_query_set()
         if isinstance(self.model_admin, EasyTreeAdmin):
+            if self.model_admin.lazy_changelist and not self.is_filtered():
+                qs = qs.filter(lft=1)
             if self.model_admin.ordering == ('lft',):
+                closure = get_closure(qs.model.objects)
+                if closure is not None:
+                    return closure.order_dfs(qs)
                 return qs.order_by('tree_id', 'lft')
         return qs
 
@@ -48,6 +67,20 @@ class EasyTreeAdmin(admin.ModelAdmin):
     
     toplevel_model_cache = None
 
+    # list the root nodes only, their children are fetched when expanded
+    lazy_changelist = False
+
+    # the nodes per page of the autocomplete view of relative_to, and the
+    # fields searched (defaults to search_fields, or to path_field; without
+    # any, relative_to is a plain select)
+    autocomplete_per_page = 20
+    autocomplete_search_fields = None
+
+    def __init__(self, model, admin_site):
+        super(EasyTreeAdmin, self).__init__(model, admin_site)
+        if self.lazy_changelist and not self.change_list_template:
+            self.change_list_template = 'admin/easytree_lazy_change_list.html'
+
     def display_as_node(self, obj):
         return  u'%s %s' % (
             u'>>>' * ((obj.depth or 1) -1),
@@ -70,6 +103,14 @@ class EasyTreeAdmin(admin.ModelAdmin):
             
         return root_node
     
+    def get_form(self, request, obj=None, **kwargs):
+        form = super(EasyTreeAdmin, self).get_form(request, obj=obj, **kwargs)
+        if issubclass(form, BaseEasyTreeForm) and self.get_autocomplete_search_fields():
+            from django.core.urlresolvers import reverse
+            info = self.model._meta.app_label, self.model._meta.module_name
+            form.relative_to_autocomplete_url = reverse('admin:%s_%s_autocomplete' % info)
+        return form
+
     def get_fieldsets(self, request, obj=None):
         
         fieldsets = super(EasyTreeAdmin, self).get_fieldsets(request, obj=obj)
@@ -119,6 +160,169 @@ class EasyTreeAdmin(admin.ModelAdmin):
             json_data = {'success': False, 'error': error}
         
         return HttpResponse(simplejson.dumps(json_data), mimetype='text/javascript')                
+
+    def batch_move_view(self, request):
+        """
+        Applies several moves with a single renumbering of the trees, given
+        either as a ``moves`` POST parameter, a JSON list of ``[node,
+        relative_to, position]`` primary keys and positions, or as a
+        ``parent`` (empty for the root nodes) and a JSON list of the
+        ``children`` in their new order. The moves are validated before any
+        of them is made.
+        """
+        manager = self.toplevel_model.objects
+        error = None
+
+        def get_nodes(pks):
+            # in_bulk leaves the missing nodes out
+            nodes = manager.in_bulk(pks)
+            for pk in pks:
+                if pk not in nodes:
+                    raise self.toplevel_model.DoesNotExist
+            return nodes
+
+        try:
+            if 'moves' in request.POST:
+                moves = simplejson.loads(request.POST['moves'])
+                nodes = get_nodes([move[0] for move in moves] + [move[1] for move in moves])
+                manager.move_many([(nodes[node], nodes[relative_to], pos)
+                    for node, relative_to, pos in moves])
+            else:
+                children = simplejson.loads(request.POST['children'])
+                parent = request.POST['parent'] and manager.get(pk=request.POST['parent']) or None
+                nodes = get_nodes(children)
+                manager.reorder_children(parent, [nodes[pk] for pk in children])
+        except (KeyError, ValueError, TypeError):
+            error = _('Invalid POST parameters')
+        except self.toplevel_model.DoesNotExist:
+            error = _('No such model instance')
+        except EasyTreeException, e:
+            error = e.message
+
+        if not error:
+            json_data = {'success': True}
+        else:
+            json_data = {'success': False, 'error': unicode(error)}
+        return HttpResponse(simplejson.dumps(json_data), mimetype='text/javascript')
+
+    def get_descendant_count(self, obj):
+        """
+        :returns: the number of descendants of a node, from its ``lft`` and
+            ``rgt`` values, or ``None`` when it would need a query (sparse
+            trees and the closure storage).
+        """
+        opts = self.toplevel_model._easytree_meta
+        if opts.spacing == 1 and not opts.closure_model:
+            return (obj.rgt - obj.lft - 1) / 2
+        return None
+
+    def is_leaf(self, obj):
+        """
+        :returns: ``True`` if the node is a leaf, ``None`` if it is not known
+            without a query (closure storage).
+        """
+        if self.toplevel_model._easytree_meta.closure_model:
+            return None
+        return obj.rgt - obj.lft == 1
+
+    def get_children_queryset(self, parent_pk):
+        """
+        :returns: the children of a node, read with a single query on the
+            ``parent_field`` foreign key or on the ``(tree_id, depth, lft)``
+            index.
+        """
+        cls = self.toplevel_model
+        parent_field = cls._easytree_meta.parent_field
+        if parent_field:
+            return cls.objects.filter(**{parent_field: parent_pk}).order_by('tree_id', 'lft')
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        def parent(column):
+            return '(SELECT %s FROM %s WHERE %s = %%s)' % (column, table, qn(cls._meta.pk.column))
+        return cls.objects.extra(where=[
+            '%s.tree_id = %s' % (table, parent('tree_id')),
+            '%s.depth = %s' % (table, parent('depth + 1')),
+            '%s.lft > %s' % (table, parent('lft')),
+            '%s.lft < %s' % (table, parent('rgt'))
+        ], params=[parent_pk] * 4).order_by('tree_id', 'lft')
+
+    def get_autocomplete_search_fields(self):
+        """
+        :returns: the fields searched by the autocomplete view of
+            ``relative_to``: the ``autocomplete_search_fields``, the
+            ``search_fields`` or the ``path_field`` of the model, if any.
+        """
+        path_field = self.toplevel_model._easytree_meta.path_field
+        return self.autocomplete_search_fields or self.search_fields or \
+            [field for field in [path_field] if field]
+
+    def get_autocomplete_queryset(self, query):
+        """
+        :returns: the nodes matching the words of ``query`` in the
+            ``autocomplete_search_fields``, in DFS order; all of them if
+            there is no field to search.
+        """
+        cls = self.toplevel_model
+        qs = cls.objects.order_by('tree_id', 'lft')
+        closure = get_closure(cls.objects)
+        if closure is not None:
+            qs = closure.order_dfs(qs)
+        # the prefixes of the search_fields of the changelist
+        lookups = [{'^': '%s__istartswith', '=': '%s__iexact', '@': '%s__search'}.get(
+            field[0], '%s__icontains') % field.lstrip('^=@') for field in self.get_autocomplete_search_fields()]
+        if not lookups:
+            return qs
+        for word in query.split():
+            qs = qs.filter(reduce(operator.or_, [Q(**{lookup: word}) for lookup in lookups]))
+        return qs
+
+    def autocomplete_view(self, request):
+        """
+        Returns a page of the nodes matching the ``q`` GET parameter, with
+        their labels and the path of their ancestors, for the widget of
+        ``relative_to``.
+        """
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            json_data = {'success': False, 'error': unicode(_('Invalid GET parameters'))}
+        else:
+            per_page = self.autocomplete_per_page
+            start = (page - 1) * per_page
+            # one node more tells if there is a next page, without counting
+            nodes = list(self.get_autocomplete_queryset(request.GET.get('q', ''))[start:start + per_page + 1])
+            has_next = len(nodes) > per_page
+            nodes = nodes[:per_page]
+            path_field = self.toplevel_model._easytree_meta.path_field
+            if not path_field:
+                ancestors = self.toplevel_model.objects.get_ancestors_for_nodes(nodes)
+            json_data = {'success': True, 'has_next': has_next, 'nodes': [{
+                'pk': node.pk,
+                'label': node_label(node),
+                'path': path_field and getattr(node, path_field) or \
+                    u' / '.join([unicode(ancestor) for ancestor in ancestors[node] + [node]])
+            } for node in nodes]}
+        return HttpResponse(simplejson.dumps(json_data), mimetype='text/javascript')
+
+    def children_view(self, request):
+        """
+        Returns the children of the node given by the ``node`` GET
+        parameter, for the expansion of the nodes of the lazy changelist.
+        """
+        try:
+            parent_pk = self.toplevel_model._meta.pk.to_python(request.GET['node'])
+        except (KeyError, ValidationError):
+            json_data = {'success': False, 'error': unicode(_('Invalid GET parameters'))}
+        else:
+            nodes = [{
+                'pk': node.pk,
+                'label': unicode(node),
+                'depth': node.depth,
+                'descendant_count': self.get_descendant_count(node),
+                'is_leaf': self.is_leaf(node)
+            } for node in self.get_children_queryset(parent_pk)]
+            json_data = {'success': True, 'nodes': nodes}
+        return HttpResponse(simplejson.dumps(json_data), mimetype='text/javascript')
         
     def get_urls(self):
         
@@ -132,6 +336,15 @@ class EasyTreeAdmin(admin.ModelAdmin):
             url(r'^move/$',
                 self.admin_site.admin_view(self.move_view),
                 name='%s_%s_move' % info),
+            url(r'^batch_move/$',
+                self.admin_site.admin_view(self.batch_move_view),
+                name='%s_%s_batch_move' % info),
+            url(r'^autocomplete/$',
+                self.admin_site.admin_view(self.autocomplete_view),
+                name='%s_%s_autocomplete' % info),
+            url(r'^children/$',
+                self.admin_site.admin_view(self.children_view),
+                name='%s_%s_children' % info),
         ) + admin_urls
         
     def changelist_view(self, request, extra_context=None):
@@ -145,5 +358,13 @@ class EasyTreeAdmin(admin.ModelAdmin):
 
         info = self.model._meta.app_label, self.model._meta.module_name
         extra_context['move_url'] = reverse('admin:%s_%s_move' % info)
-        
-        return super(EasyTreeAdmin, self).changelist_view(request, extra_context=extra_context)
+        extra_context['children_url'] = reverse('admin:%s_%s_children' % info)
+
+        view = super(EasyTreeAdmin, self).changelist_view
+        if get_versions(self.toplevel_model.objects) is not None:
+            # unchanged trees are answered with a 304, the page also depends
+            # on the query string and the user
+            view = condition_on_tree(self.toplevel_model,
+                key_func=lambda request, **kwargs: md5_constructor('%s:%s' % (
+                    request.get_full_path(), request.user.pk)).hexdigest())(view)
+        return view(request, extra_context=extra_context)
@@ -0,0 +1,393 @@
+"""
+Deferred structural changes.
+
+The validators of the model (see the ``validators`` EasyTreeMeta option) are
+not run for the adds and moves done in a batch: validate them beforehand
+with the ``validate_*`` methods of the manager.
+
+Inside a ``with MyTreeModel.objects.batch():`` block, the nodes added with
+``save()`` and moved with ``move()`` are placed in an in-memory copy of the
+trees involved instead of renumbering the trees in the database. The final
+``lft``, ``rgt``, ``depth`` and ``tree_id`` values are written when the block
+exits, with batched UPDATE statements in a single transaction. The
+``node_pre_move`` signals are sent before these statements, with the values
+of the nodes before the batch, and the ``node_moved`` signals afterwards.
+
+Operations working on the stored values (queryset ``delete()``,
+``bulk_load``, ``rebuild``, ``resort_siblings`` and ``rebuild_paths``) first
+write the changes recorded so far, and the batch goes on from the result.
+"""
+from django.db import connection, transaction
+from easytree import utils
+from easytree.exceptions import InvalidMoveToDescendant, InvalidPosition, MissingNodeOrderBy
+from easytree.instrumentation import instrumented
+from easytree.signals import node_moved, node_pre_move, has_receivers
+import threading
+
+qn = connection.ops.quote_name
+
+CHILD_POSITIONS = ('first-child', 'last-child', 'sorted-child')
+SIBLING_POSITIONS = ('first-sibling', 'left', 'right', 'last-sibling', 'sorted-sibling')
+
+_state = threading.local()
+
+def get_batch(model):
+    """
+    :returns: the batch running for the model in the current thread, or
+        ``None``.
+    """
+    return getattr(_state, 'batches', {}).get(model)
+
+class Entry(object):
+    """
+    A node of the in-memory trees. The children of the root entries of the
+    trees not loaded from the database are unknown (``loaded`` is
+    ``False``).
+    """
+    def __init__(self, node, loaded=True):
+        self.node = node
+        self.parent = None
+        self.children = []
+        self.loaded = loaded
+
+class TreeBatch(object):
+    """
+    Context manager recording adds and moves of the nodes of a model,
+    without running the validators of the model.
+
+    Only the trees involved are loaded, with a query each; the list of the
+    root nodes is loaded when roots are added or moved. Until the block
+    exits, the nodes added are stored with ``lft``, ``rgt``, ``depth`` and
+    ``tree_id`` set to 0 and the database is not updated, so queries on the
+    trees see their state before the batch.
+    """
+    batch_size = 500
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.model = manager.get_first_model()
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.entries = {}
+            self.new = []
+            self.roots = None
+            self.moves = []
+            self.written_moves = []
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            self.manager.lock_forest()
+            if not hasattr(_state, 'batches'):
+                _state.batches = {}
+            _state.batches[self.model] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth:
+            return False
+        try:
+            try:
+                if exc_type is None:
+                    self.write()
+                    transaction.commit()
+                else:
+                    transaction.rollback()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            transaction.leave_transaction_management()
+            del _state.batches[self.model]
+        if exc_type is None:
+            self.manager._flush_cache()
+            self.send_signals()
+        return False
+
+    def write(self):
+        """
+        Writes the changes recorded so far, the next ones are recorded from
+        the trees written.
+        """
+        self.flush()
+        self.written_moves.extend(self.moves)
+        self.entries = {}
+        self.new = []
+        self.roots = None
+        self.moves = []
+
+    """ Recording """
+
+    def add(self, new_object, dest=None, pos=None, kind='sibling'):
+        """
+        Places a new node relative to ``dest`` (as a ``kind`` of it, either
+        ``'sibling'`` or ``'child'``), or as the last root node.
+        """
+        new_object.lft = new_object.rgt = new_object.depth = new_object.tree_id = 0
+        entry = Entry(new_object)
+        if dest is None:
+            roots = self._get_roots()
+            pos = self._fix_position(pos, SIBLING_POSITIONS, kind)
+            if roots:
+                self._insert(entry, roots[-1], pos)
+            else:
+                roots.append(entry)
+        else:
+            positions = {'sibling': SIBLING_POSITIONS, 'child': CHILD_POSITIONS}[kind]
+            pos = self._fix_position(pos, positions, kind)
+            self._insert(entry, self._get_entry(dest), pos)
+        self.new.append(entry)
+
+    def move(self, target, dest, pos=None):
+        """
+        Moves a node and its descendants relative to ``dest``.
+        """
+        real_pos = pos
+        pos = self._fix_position(pos, SIBLING_POSITIONS + CHILD_POSITIONS, 'sibling')
+        entry = self._get_entry(target)
+        dest_entry = self._get_entry(dest)
+
+        ancestor = dest_entry
+        while ancestor is not None:
+            if ancestor is entry and (ancestor is not dest_entry or pos in CHILD_POSITIONS):
+                raise InvalidMoveToDescendant("Can't move node to a descendant.")
+            ancestor = ancestor.parent
+
+        siblings = self._get_siblings(entry)
+        index = siblings.index(entry)
+        del siblings[index]
+        try:
+            self._insert(entry, dest_entry, pos, (siblings, index))
+        except:
+            siblings.insert(index, entry)
+            raise
+        self.moves.append((target.__class__, entry, dest_entry, real_pos))
+
+    def _fix_position(self, pos, positions, kind):
+        node_order_by = self.model._easytree_meta.node_order_by
+        if pos is None:
+            if node_order_by:
+                pos = 'sorted-%s' % kind
+            else:
+                pos = 'last-%s' % kind
+        if pos not in positions:
+            raise InvalidPosition('Invalid relative position: %s' % (pos,))
+        if node_order_by and not pos.startswith('sorted-'):
+            raise InvalidPosition('Must use sorted-sibling or sorted-child'
+                                  ' when node_order_by is enabled')
+        if pos.startswith('sorted-') and not node_order_by:
+            raise MissingNodeOrderBy('Missing node_order_by attribute.')
+        return pos
+
+    def _insert(self, entry, dest, pos, removed=None):
+        """
+        Inserts a detached entry. ``removed`` is the list of siblings and the
+        index the entry has just been removed from, if any.
+        """
+        if pos in CHILD_POSITIONS:
+            self._load_tree(dest)
+            parent, siblings = dest, dest.children
+            pos = pos.replace('-child', '-sibling')
+        else:
+            parent, siblings = dest.parent, self._get_siblings(dest)
+
+        if pos == 'first-sibling':
+            index = 0
+        elif pos == 'last-sibling':
+            index = len(siblings)
+        elif pos == 'sorted-sibling':
+            key = self._get_sort_key(entry)
+            index = len(siblings)
+            for i, sibling in enumerate(siblings):
+                if self._get_sort_key(sibling) > key:
+                    index = i
+                    break
+        else:
+            if dest is entry:
+                # moving a node next to itself leaves it where it was
+                siblings, index = removed
+            else:
+                index = siblings.index(dest)
+            if pos == 'right' and dest is not entry:
+                index += 1
+
+        siblings.insert(index, entry)
+        entry.parent = parent
+
+    def _get_sort_key(self, entry):
+        return [getattr(entry.node, field) for field in self.model._easytree_meta.node_order_by]
+
+    """ In-memory trees """
+
+    def _get_entry(self, node):
+        entry = self.entries.get(node.pk)
+        if entry is not None:
+            # the roots are listed without their children
+            self._load_tree(entry)
+            return entry
+        for entry in self.new:
+            if entry.node is node or (node.pk is not None and entry.node.pk == node.pk):
+                return entry
+        tree_id = self.model.objects.filter(pk=node.pk).values_list('tree_id', flat=True)[0]
+        self._load_tree(Entry(self.model(tree_id=tree_id), loaded=False))
+        return self.entries[node.pk]
+
+    def _get_siblings(self, entry):
+        if entry.parent is None:
+            return self._get_roots()
+        return entry.parent.children
+
+    def _get_roots(self):
+        if self.roots is None:
+            self.roots = []
+            for node in self.model.objects.filter(lft=1).order_by('tree_id'):
+                entry = self.entries.get(node.pk)
+                if entry is None:
+                    entry = self.entries[node.pk] = Entry(node, loaded=False)
+                self.roots.append(entry)
+        return self.roots
+
+    def _load_tree(self, entry):
+        """
+        Loads the nodes of the tree of an entry whose children are unknown.
+        """
+        if entry.loaded:
+            return
+        stack = []
+        for node in self.model.objects.filter(tree_id=entry.node.tree_id).order_by('lft'):
+            current = self.entries.get(node.pk)
+            if current is None:
+                current = self.entries[node.pk] = Entry(node)
+            current.loaded = True
+            while stack and stack[-1].node.rgt < node.lft:
+                stack.pop()
+            if stack:
+                current.parent = stack[-1]
+                stack[-1].children.append(current)
+            stack.append(current)
+
+    """ Writing """
+
+    @instrumented('batch')
+    def flush(self):
+        """
+        Numbers the trees loaded and writes the values that changed.
+        """
+        opts = self.model._easytree_meta
+        meta = self.model._meta
+
+        if self.roots is not None:
+            # the roots that were roots before keep their ids while they stay
+            # in order, the others take the next free id
+            trees = []
+            tree_id = 0
+            for index, root in enumerate(self.roots):
+                if root.node.lft == 1 and root.node.tree_id > tree_id:
+                    tree_id = root.node.tree_id
+                elif index == len(self.roots) - 1:
+                    tree_id += opts.tree_id_spacing
+                else:
+                    tree_id += 1
+                trees.append((root, tree_id))
+        else:
+            # no root was added or moved, the trees keep their ids
+            trees = [(entry, entry.node.tree_id) for entry in self.entries.values()
+                if entry.parent is None]
+
+        if opts.parent_field:
+            parent_attname = meta.get_field(opts.parent_field).attname
+
+        # the values before the batch, for the node_pre_move signal
+        old_values = {}
+        for sender, entry, dest, pos in self.moves:
+            node = entry.node
+            old_values[id(entry)] = {'tree_id': node.tree_id, 'lft': node.lft,
+                                     'rgt': node.rgt, 'depth': node.depth}
+
+        renumbered = {}
+        changed = []
+        for root, tree_id in trees:
+            if not root.loaded:
+                if root.node.tree_id != tree_id:
+                    renumbered[root.node.tree_id] = tree_id
+                continue
+            numbered = utils.number_tree([root], lambda entry: entry.children, spacing=opts.spacing)
+            for entry, lft, rgt, depth, parent in numbered:
+                node = entry.node
+                is_changed = (node.lft, node.rgt, node.depth, node.tree_id) != (lft, rgt, depth, tree_id)
+                node.lft, node.rgt, node.depth, node.tree_id = lft, rgt, depth, tree_id
+                if opts.path_field:
+                    path = getattr(node, opts.path_field)
+                    self.manager._set_path(node, parent and parent.node)
+                    is_changed = is_changed or getattr(node, opts.path_field) != path
+                if opts.parent_field:
+                    parent_id = getattr(node, parent_attname)
+                    self.manager._set_parent(node, parent and parent.node)
+                    is_changed = is_changed or getattr(node, parent_attname) != parent_id
+                if is_changed:
+                    changed.append(node)
+
+        for sender, entry, dest, pos in self.moves:
+            if not has_receivers(node_pre_move, sender):
+                continue
+            node = entry.node
+            node_pre_move.send(
+                sender=sender,
+                node=node,
+                relative_to=dest.node,
+                relative_position=pos,
+                old_values=old_values[id(entry)],
+                new_values={'tree_id': node.tree_id, 'lft': node.lft,
+                            'rgt': node.rgt, 'depth': node.depth}
+            )
+
+        cursor = connection.cursor()
+        if renumbered:
+            cursor.execute('UPDATE %(table)s SET tree_id = CASE tree_id %(cases)s END '
+                ' WHERE tree_id IN (%(tree_ids)s)' % {
+                    'table': qn(meta.db_table),
+                    'cases': ' '.join(['WHEN %d THEN %d' % item for item in renumbered.items()]),
+                    'tree_ids': ', '.join([str(tree_id) for tree_id in renumbered.keys()])
+                })
+
+        columns = ['lft', 'rgt', 'depth', 'tree_id']
+        if opts.path_field:
+            columns.append(meta.get_field(opts.path_field).column)
+        if opts.parent_field:
+            columns.append(meta.get_field(opts.parent_field).column)
+        sql = 'UPDATE %(table)s SET %(columns)s WHERE %(pk_col)s = %%s' % {
+            'table': qn(meta.db_table),
+            'columns': ', '.join(['%s = %%s' % qn(column) for column in columns]),
+            'pk_col': qn(meta.pk.column)
+        }
+        params = []
+        for node in changed:
+            row = [node.lft, node.rgt, node.depth, node.tree_id]
+            if opts.path_field:
+                row.append(getattr(node, opts.path_field))
+            if opts.parent_field:
+                row.append(getattr(node, parent_attname))
+            params.append(row + [node.pk])
+        for start in range(0, len(params), self.batch_size):
+            cursor.executemany(sql, params[start:start+self.batch_size])
+
+    def send_signals(self):
+        moves = [move for move in self.written_moves if has_receivers(node_moved, move[0])]
+        if not moves:
+            return
+        pks = []
+        for sender, entry, dest, pos in moves:
+            pks.extend([entry.node.pk, dest.node.pk])
+        nodes = self.model.objects.in_bulk(pks)
+        for sender, entry, dest, pos in moves:
+            if entry.node.pk not in nodes or dest.node.pk not in nodes:
+                # deleted later in the batch
+                continue
+            node_moved.send(
+                sender=sender,
+                node_moved=nodes[entry.node.pk],
+                moved_to_node=nodes[dest.node.pk],
+                relative_position=pos
+            )
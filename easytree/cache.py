@@ -0,0 +1,150 @@
+"""
+Caching of tree reads.
+
+With the ``cache_backend`` EasyTreeMeta option, the results of
+``get_tree``, ``get_descendants_for`` and ``get_children_for`` are stored in
+a Django cache, under keys including version counters kept in the same
+cache:
+
+- one per ``tree_id``, for the results read from a node of the tree;
+- an epoch, for all of them, changed when trees may be renumbered;
+- one for the whole forest, for ``get_tree()`` without a parent.
+
+The trees locked by a structural change, and the tree of every node saved,
+get new versions once the change is committed, so stale results are never
+read again and expire from the cache. The counters start from the current
+time, so that they don't go back to values used before if they are evicted.
+
+The results are returned as querysets already evaluated: filtering them
+again runs a query. Changes made with ``QuerySet.update()`` or in raw SQL
+are not seen, and inside transactions managed by the caller the versions
+change before the commit, so a concurrent request may cache the previous
+state until the next change.
+"""
+from django.core.cache import cache as default_cache, get_cache
+from easytree import locking
+import threading
+import time
+
+_state = threading.local()
+
+def get_tree_cache(manager):
+    """
+    :returns: the cache of the manager's model, or ``None`` if its reads are
+        not cached.
+    """
+    opts = manager.get_first_model()._easytree_meta
+    if not opts.cache_backend:
+        return None
+    try:
+        return opts._tree_cache
+    except AttributeError:
+        opts._tree_cache = TreeCache(manager.get_first_model())
+        return opts._tree_cache
+
+def cached(func):
+    """
+    Decorates a read of the manager taking a node (or ``None`` for the whole
+    forest) and returning a queryset, serving the result from the cache.
+    Reads made during structural changes always query the database, and
+    reads made by another one are cached as part of it.
+    """
+    def wrapper(self, *args, **kwargs):
+        tree_cache = get_tree_cache(self)
+        if tree_cache is None or locking.is_mutating() or getattr(_state, 'reading', False):
+            return func(self, *args, **kwargs)
+        _state.reading = True
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            _state.reading = False
+        node = (list(args) + kwargs.values() + [None])[0]
+        return tree_cache.get(self.model, func.__name__, node, result)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__dict__.update(func.__dict__)
+    return wrapper
+
+class TreeCache(object):
+    """
+    The cache of the reads of a model and its subclasses.
+    """
+    def __init__(self, model):
+        opts = model._easytree_meta
+        if opts.cache_backend == 'default':
+            self.cache = default_cache
+        else:
+            self.cache = get_cache(opts.cache_backend)
+        self.timeout = opts.cache_timeout
+        self.prefix = 'easytree.%s.%s' % (model._meta.app_label, model._meta.object_name)
+        self._local = threading.local()
+
+    def key(self, *parts):
+        return ':'.join([self.prefix] + [str(part) for part in parts])
+
+    def _new_version(self, key):
+        self.cache.add(key, int(time.time() * 1000), self.timeout * 10)
+        return self.cache.get(key)
+
+    def get_versions(self, keys):
+        versions = self.cache.get_many(keys)
+        return [versions.get(key) or self._new_version(key) for key in keys]
+
+    def _bump(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self._new_version(key)
+
+    """ Reading """
+
+    def get(self, model, method, node, queryset):
+        """
+        :returns: the queryset, with the results of the last evaluation of
+            the same read of the same version of the tree.
+        """
+        if node is None:
+            versions = self.get_versions([self.key('forest')])
+            node_key = 'all'
+        else:
+            versions = self.get_versions([self.key('epoch'), self.key('tree', node.tree_id)])
+            # the values of the node are part of the key, the reads of a
+            # node not reloaded after a change are different
+            node_key = '%s-%s-%s-%s-%s' % (node.pk, node.tree_id, node.lft, node.rgt, node.depth)
+        key = self.key(model._meta.object_name, method, node_key, *versions)
+        nodes = self.cache.get(key)
+        if nodes is None:
+            self.cache.set(key, list(queryset), self.timeout)
+        else:
+            queryset._result_cache = nodes
+        return queryset
+
+    """ Invalidation """
+
+    def _pending(self):
+        if not hasattr(self._local, 'tree_ids'):
+            self._local.tree_ids = set()
+            self._local.renumbered = False
+        return self._local
+
+    def record(self, tree_ids=(), renumbered=False):
+        """
+        Records trees being changed, or all the trees if they may be
+        renumbered, until :meth:`flush` is called.
+        """
+        pending = self._pending()
+        pending.tree_ids.update(tree_ids)
+        pending.renumbered = pending.renumbered or renumbered
+
+    def flush(self):
+        """
+        Gives new versions to the trees recorded.
+        """
+        pending = self._pending()
+        if pending.renumbered:
+            self._bump(self.key('epoch'))
+        for tree_id in pending.tree_ids:
+            self._bump(self.key('tree', tree_id))
+        self._bump(self.key('forest'))
+        pending.tree_ids.clear()
+        pending.renumbered = False
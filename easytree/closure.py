@@ -0,0 +1,609 @@
+"""
+Closure table storage.
+
+With the ``closure_model`` EasyTreeMeta option, the ancestors of every node
+are stored as ``(ancestor, descendant, distance)`` rows of a closure model,
+including a row with distance 0 linking each node to itself, instead of
+being encoded in nested set values. Moving a subtree rewrites only the
+closure rows linking it to its old and new ancestors, the ``tree_id`` and
+``depth`` of its nodes and the positions of its new siblings; nothing else
+in the tree is touched.
+
+The node columns keep part of their meaning: ``tree_id`` and ``depth`` are
+maintained as usual and root nodes have ``lft = 1``, but the ``lft`` of the
+other nodes is only their position among their siblings (starting from 2)
+and ``rgt`` is always ``lft + 1``. The parent of each node is read from the
+``parent_field`` foreign key, which is required. The DFS order of the nodes
+is computed from the positions of their ancestors.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, models, transaction
+from django.db.models import Max
+import threading
+
+qn = connection.ops.quote_name
+
+_state = threading.local()
+
+def get_closure(manager):
+    """
+    :returns: the closure storage of the manager's model, or ``None`` if it
+        is stored as nested sets.
+    """
+    if manager.model._easytree_meta.closure_model:
+        return ClosureStorage(manager)
+    return None
+
+class ClosureStorage(object):
+    """
+    Implements the structural operations of
+    :class:`easytree.managers.EasyTreeManager` on a closure table.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.model = manager.get_first_model()
+        opts = self.model._easytree_meta
+        if not opts.parent_field:
+            raise ImproperlyConfigured('%s: closure_model requires parent_field.' % self.model.__name__)
+        self.closure = opts.closure_model
+        if isinstance(self.closure, basestring):
+            self.closure = models.get_model(self.model._meta.app_label, self.closure)
+        self.parent_field = opts.parent_field
+
+        meta = self.closure._meta
+        self.sql_params = {
+            'closure': qn(meta.db_table),
+            'ancestor_col': qn(meta.get_field('ancestor').column),
+            'descendant_col': qn(meta.get_field('descendant').column),
+            'table': qn(self.model._meta.db_table),
+            'pk_col': qn(self.model._meta.pk.column),
+            'parent_col': qn(self.model._meta.get_field(self.parent_field).column),
+        }
+
+    def execute(self, sql, values=None, params=()):
+        params_dict = dict(self.sql_params)
+        params_dict.update(values or {})
+        cursor = connection.cursor()
+        cursor.execute(sql % params_dict, params)
+
+    """ Reading """
+
+    def _ancestor_ids(self, target, min_distance=1):
+        return self.closure.objects.filter(descendant=target.pk,
+            distance__gte=min_distance).values('ancestor')
+
+    def _descendant_ids(self, target, min_distance=1):
+        return self.closure.objects.filter(ancestor=target.pk,
+            distance__gte=min_distance).values('descendant')
+
+    def get_ancestors_for(self, target):
+        return self.model.objects.filter(pk__in=self._ancestor_ids(target)).order_by('depth')
+
+    def get_ancestors_for_nodes(self, nodes):
+        ancestors = {}
+        for node in nodes:
+            ancestors[node] = []
+        rows = self.closure.objects.filter(descendant__in=[node.pk for node in nodes],
+            distance__gt=0).select_related('ancestor').order_by('-distance')
+        by_pk = {}
+        for row in rows:
+            by_pk.setdefault(row.descendant_id, []).append(row.ancestor)
+        for node in nodes:
+            ancestors[node] = by_pk.get(node.pk, [])
+        return ancestors
+
+    def get_dfs_key_sql(self):
+        """
+        :returns: an SQL expression sorting the nodes of a tree in DFS order:
+            the zero-padded positions of the ancestors of the node and its
+            own, from the root down.
+        """
+        if settings.DATABASE_ENGINE in ('postgresql', 'postgresql_psycopg2'):
+            sql = "SELECT string_agg(lpad(CAST(a.lft AS text), 10, '0'), '/' ORDER BY c.distance DESC) " \
+                  " FROM %(closure)s c JOIN %(table)s a ON a.%(pk_col)s = c.%(ancestor_col)s " \
+                  " WHERE c.%(descendant_col)s = %(table)s.%(pk_col)s"
+        elif settings.DATABASE_ENGINE == 'sqlite3':
+            # group_concat keeps the order of the rows of the subquery
+            sql = "SELECT group_concat(position, '/') FROM " \
+                  " (SELECT substr('0000000000' || a.lft, -10, 10) AS position " \
+                  "  FROM %(closure)s c JOIN %(table)s a ON a.%(pk_col)s = c.%(ancestor_col)s " \
+                  "  WHERE c.%(descendant_col)s = %(table)s.%(pk_col)s ORDER BY c.distance DESC) positions"
+        else:
+            sql = "SELECT GROUP_CONCAT(LPAD(a.lft, 10, '0') ORDER BY c.distance DESC SEPARATOR '/') " \
+                  " FROM %(closure)s c JOIN %(table)s a ON a.%(pk_col)s = c.%(ancestor_col)s " \
+                  " WHERE c.%(descendant_col)s = %(table)s.%(pk_col)s"
+        return '(%s)' % (sql % self.sql_params)
+
+    def order_dfs(self, queryset):
+        """
+        :returns: the queryset ordered by ``tree_id`` and in DFS order within
+            each tree.
+        """
+        return queryset.extra(select={'easytree_dfs_key': self.get_dfs_key_sql()}) \
+            .order_by('tree_id', 'easytree_dfs_key')
+
+    def get_descendants_for(self, target):
+        return self.order_dfs(self.model.objects.filter(pk__in=self._descendant_ids(target)))
+
+    def get_tree(self, parent=None):
+        if parent is None:
+            return self.order_dfs(self.model.objects.all())
+        return self.order_dfs(self.model.objects.filter(pk__in=self._descendant_ids(parent, 0)))
+
+    def get_cached_tree(self, parent=None):
+        """
+        Sorts the nodes of the tree in DFS order in Python, from their
+        parents and positions, and links them to each other.
+        """
+        nodes = list(self.get_tree(parent))
+        attname = self.model._meta.get_field(self.parent_field).attname
+        children = {}
+        for node in nodes:
+            node._cached_children = []
+            children.setdefault(getattr(node, attname), []).append(node)
+        if parent is None:
+            top_level = sorted(children.get(None, []), key=lambda node: node.tree_id)
+            for root in top_level:
+                root._cached_ancestors = []
+                root._cached_siblings = top_level
+        else:
+            top_level = [node for node in nodes if node.pk == parent.pk]
+        tree = []
+        stack = list(reversed(top_level))
+        while stack:
+            node = stack.pop()
+            tree.append(node)
+            node_children = sorted(children.get(node.pk, []), key=lambda child: child.lft)
+            for child in node_children:
+                child._cached_parent_obj = node
+                node._cached_children.append(child)
+                if hasattr(node, '_cached_ancestors'):
+                    child._cached_ancestors = node._cached_ancestors + [node]
+            stack.extend(reversed(node_children))
+        return tree
+
+    def prefetch_children_for(self, nodes, depth=None):
+        """
+        Fetches the descendants of the given nodes down to ``depth`` levels
+        (all of them if ``depth`` is ``None``) through their closure rows and
+        links them to their parents.
+
+        :returns: the given nodes and the descendants fetched.
+        """
+        tree = {}
+        if nodes:
+            rows = self.closure.objects.filter(ancestor__in=[node.pk for node in nodes], distance__gt=0)
+            if depth is not None:
+                rows = rows.filter(distance__lte=depth)
+            for descendant in self.model.objects.filter(pk__in=rows.values('descendant')):
+                tree[descendant.pk] = descendant
+        for node in nodes:
+            tree[node.pk] = node
+        attname = self.model._meta.get_field(self.parent_field).attname
+        for node in tree.values():
+            node._cached_children = []
+        # the parents come before their children, and siblings by position
+        for node in sorted(tree.values(), key=lambda node: (node.depth, node.lft)):
+            parent = tree.get(getattr(node, attname))
+            if parent is not None:
+                node._cached_parent_obj = parent
+                parent._cached_children.append(node)
+                if hasattr(parent, '_cached_ancestors'):
+                    node._cached_ancestors = parent._cached_ancestors + [parent]
+            elif node.depth == 1:
+                node._cached_ancestors = []
+        return tree.values()
+
+    def get_subtree_sql(self, target):
+        """
+        :returns: a WHERE clause selecting a node and its descendants.
+        """
+        return '%(pk_col)s IN (SELECT %(descendant_col)s FROM %(closure)s ' \
+               ' WHERE %(ancestor_col)s = %(target)d)' % dict(self.sql_params, target=target.pk)
+
+    def get_descendant_count(self, target):
+        return self.closure.objects.filter(ancestor=target.pk, distance__gt=0).count()
+
+    def is_descendant_of(self, target, node):
+        return self.closure.objects.filter(ancestor=node.pk, descendant=target.pk,
+            distance__gt=0).count() > 0
+
+    def is_sibling_of(self, target, node):
+        attname = self.model._meta.get_field(self.parent_field).attname
+        return getattr(target, attname) == getattr(node, attname)
+
+    def is_leaf(self, target):
+        return not self.model.objects.filter(**{self.parent_field: target.pk})[:1]
+
+    """ Writing """
+
+    def insert_node(self, node):
+        """
+        Adds the closure rows of a node just inserted.
+        """
+        parent_id = getattr(node, self.model._meta.get_field(self.parent_field).attname)
+        self.execute('INSERT INTO %(closure)s (%(ancestor_col)s, %(descendant_col)s, distance) '
+            ' SELECT %(ancestor_col)s, %(node)d, distance + 1 FROM %(closure)s '
+            '  WHERE %(descendant_col)s = %(parent)d', {
+                'node': node.pk, 'parent': parent_id or 0})
+        self.execute('INSERT INTO %(closure)s (%(ancestor_col)s, %(descendant_col)s, distance) '
+            ' VALUES (%(node)d, %(node)d, 0)', {'node': node.pk})
+
+    def place(self, parent, pos, dest=None):
+        """
+        Makes room for a node among the children of ``parent``, at ``pos``
+        (``'first-*'``, ``'last-*'``, or ``'left'`` and ``'right'`` of the
+        sibling ``dest``), shifting the positions of the siblings on its
+        right.
+
+        :returns: the ``lft`` of the node.
+        """
+        if pos in ('last-child', 'last-sibling'):
+            last = self.model.objects.filter(**{self.parent_field: parent.pk}) \
+                .aggregate(Max('lft'))['lft__max']
+            return (last or 1) + 1
+        first = {'first-child': 2, 'first-sibling': 2}.get(pos)
+        if first is None:
+            first = dest.lft + {'left': 0, 'right': 1}[pos]
+        self.execute('UPDATE %(table)s SET lft = lft + 1, rgt = rgt + 1 '
+            ' WHERE %(parent_col)s = %(parent)d AND lft >= %(first)d', {
+                'parent': parent.pk, 'first': first})
+        return first
+
+    def add_child_to(self, target, new_object, pos):
+        if pos == 'sorted-child':
+            dest = self.manager.get_sorted_dest_for(target,
+                self.manager.get_children_for(target), new_object)
+            if dest is None:
+                new_object.lft = self.place(target, 'last-child')
+            else:
+                new_object.lft = self.place(target, 'left', dest)
+        else:
+            new_object.lft = self.place(target, pos)
+        new_object.rgt = new_object.lft + 1
+        new_object.tree_id = target.tree_id
+        new_object.depth = target.depth + 1
+        self.manager._set_parent(new_object, target)
+        self.manager._set_path(new_object, target)
+
+    def add_sibling_to(self, target, new_object, pos):
+        """
+        Adds a sibling to a node that is not a root.
+        """
+        parent = self.manager.get_parent_for(target, True)
+        if pos == 'sorted-sibling':
+            target = self.manager.get_sorted_dest_for(target,
+                self.manager.get_siblings_for(target), new_object)
+            pos = target is None and 'last-sibling' or 'left'
+        new_object.lft = self.place(parent, pos, target)
+        new_object.rgt = new_object.lft + 1
+        new_object.tree_id = parent.tree_id
+        new_object.depth = parent.depth + 1
+        self.manager._set_parent(new_object, parent)
+        self.manager._set_path(new_object, parent)
+
+    def _root_tree_id(self, pos, dest):
+        """
+        :returns: the ``tree_id`` of a tree placed at ``pos`` relative to the
+            root ``dest``, making room for it if needed.
+        """
+        manager = self.manager
+        spacing = self.model._easytree_meta.tree_id_spacing
+        last_root = manager.get_last_root_node()
+        if pos == 'last-sibling' or (pos == 'right' and dest.pk == last_root.pk):
+            return last_root.tree_id + spacing
+        before = {'first-sibling': lambda: manager.get_root_nodes()[0].tree_id,
+                  'left': lambda: dest.tree_id,
+                  'right': lambda: manager._get_next_tree_id(dest.tree_id)}[pos]()
+        if spacing > 1:
+            tree_id, sql, params = manager._get_free_tree_id(before)
+        else:
+            tree_id = before
+            sql, params = manager._move_tree_right(before)
+        if sql:
+            connection.cursor().execute(sql, params)
+        return tree_id
+
+    def move(self, target, dest, pos, real_dest, real_pos):
+        """
+        Moves a subtree, with ``pos`` and ``dest`` already validated by
+        :meth:`easytree.managers.EasyTreeManager.fix_move_vars`.
+
+        :returns: the new ``tree_id``, ``lft``, ``rgt`` and ``depth`` of the
+            node, or ``None`` if it was not moved.
+        """
+        manager = self.manager
+        attname = self.model._meta.get_field(self.parent_field).attname
+        parent = None
+        if pos in ('first-child', 'last-child', 'sorted-child'):
+            parent = dest
+        elif not manager.is_root(dest):
+            parent = manager.get_parent_for(dest, True)
+
+        if pos.startswith('sorted-'):
+            if parent is None:
+                siblings = manager.get_root_nodes()
+            else:
+                siblings = manager.get_children_for(parent)
+            sorted_dest = manager.get_sorted_dest_for(dest, siblings.exclude(pk=target.pk), target)
+            if sorted_dest is None:
+                pos = parent is None and 'last-sibling' or 'last-child'
+            else:
+                pos, dest = 'left', sorted_dest
+        if dest.pk == target.pk and pos in ('left', 'right'):
+            # moving a node next to itself leaves it where it was
+            return None
+
+        if parent is None:
+            tree_id = self._root_tree_id(pos, dest)
+            lft, depth = 1, 1
+        else:
+            lft = self.place(parent, pos, dest)
+            tree_id, depth = parent.tree_id, parent.depth + 1
+        new_values = {'tree_id': tree_id, 'lft': lft, 'rgt': lft + 1, 'depth': depth}
+        manager._send_pre_move(target, real_dest, real_pos, new_values)
+
+        if getattr(target, attname) != (parent and parent.pk):
+            # unlink the subtree from its old ancestors and link it to the
+            # new ones
+            self.execute('DELETE FROM %(closure)s '
+                ' WHERE %(descendant_col)s IN (SELECT %(descendant_col)s FROM %(closure)s '
+                '   WHERE %(ancestor_col)s = %(target)d) '
+                ' AND %(ancestor_col)s NOT IN (SELECT %(descendant_col)s FROM %(closure)s '
+                '   WHERE %(ancestor_col)s = %(target)d)', {'target': target.pk})
+            if parent is not None:
+                self.execute('INSERT INTO %(closure)s (%(ancestor_col)s, %(descendant_col)s, distance) '
+                    ' SELECT a.%(ancestor_col)s, d.%(descendant_col)s, a.distance + d.distance + 1 '
+                    ' FROM %(closure)s a, %(closure)s d '
+                    ' WHERE a.%(descendant_col)s = %(parent)d AND d.%(ancestor_col)s = %(target)d', {
+                        'parent': parent.pk, 'target': target.pk})
+
+        self.execute('UPDATE %(table)s SET tree_id = %(tree_id)d, depth = depth %(depthdiff)+d '
+            ' WHERE %(subtree)s', {
+                'tree_id': tree_id, 'depthdiff': depth - target.depth,
+                'subtree': self.get_subtree_sql(target)})
+        self.execute('UPDATE %(table)s SET lft = %(lft)d, rgt = %(lft)d + 1, '
+            ' %(parent_col)s = %%s WHERE %(pk_col)s = %(target)d', {
+                'lft': lft, 'target': target.pk}, [parent and parent.pk])
+        manager._set_parent(target, parent)
+        return new_values
+
+    def delete(self, queryset):
+        """
+        Deletes the nodes of a queryset and all their descendants.
+        """
+        pks = self.closure.objects.filter(ancestor__in=list(queryset.values_list('pk', flat=True))) \
+            .values_list('descendant', flat=True)
+        models.query.QuerySet.delete(self.model.objects.filter(pk__in=list(pks)))
+
+    def resort_siblings(self, siblings, ordered):
+        """
+        Gives the positions of ``siblings``, in their current order, to the
+        same nodes sorted as ``ordered``, with a single UPDATE.
+        """
+        positions = [(node.pk, sibling.lft) for node, sibling in zip(ordered, siblings)
+            if node.lft != sibling.lft]
+        if not positions:
+            return
+        self.execute('UPDATE %(table)s SET lft = CASE %(pk_col)s %(lft_cases)s END, '
+            ' rgt = CASE %(pk_col)s %(rgt_cases)s END WHERE %(pk_col)s IN (%(pks)s)', {
+                'lft_cases': ' '.join(['WHEN %d THEN %d' % item for item in positions]),
+                'rgt_cases': ' '.join(['WHEN %d THEN %d' % (pk, lft + 1) for pk, lft in positions]),
+                'pks': ', '.join([str(pk) for pk, lft in positions])})
+
+    def bulk_load(self, nodes, get_children, parent=None, batch_size=500):
+        """
+        Inserts new nodes as new trees, or as the last children of
+        ``parent``, one level at a time: the primary keys of a level are
+        read back by parent and position, and its closure rows are copied
+        from the rows of the parents, before the next level is inserted.
+
+        :returns: the number of nodes inserted.
+        """
+        manager = self.manager
+        if parent is None:
+            last_root = manager.get_last_root_node()
+            tree_id = last_root and last_root.tree_id or 0
+            level = []
+            for node in nodes:
+                tree_id += self.model._easytree_meta.tree_id_spacing
+                node.tree_id, node.lft, node.depth = tree_id, 1, 1
+                level.append((node, None))
+        else:
+            last = self.model.objects.filter(**{self.parent_field: parent.pk}) \
+                .aggregate(Max('lft'))['lft__max']
+            level = []
+            for position, node in enumerate(nodes):
+                node.tree_id, node.lft, node.depth = parent.tree_id, (last or 1) + position + 1, parent.depth + 1
+                level.append((node, parent))
+
+        count = 0
+        while level:
+            for node, node_parent in level:
+                node.rgt = node.lft + 1
+                manager._set_path(node, node_parent)
+                manager._set_parent(node, node_parent)
+            manager._insert_nodes([node for node, node_parent in level], batch_size)
+            self._read_inserted_pks(level, batch_size)
+            pks = [node.pk for node, node_parent in level]
+            for start in range(0, len(pks), batch_size):
+                self._link_inserted_nodes(pks[start:start+batch_size])
+            count += len(level)
+
+            children = []
+            for node, node_parent in level:
+                for position, child in enumerate(get_children(node)):
+                    child.tree_id, child.lft, child.depth = node.tree_id, position + 2, node.depth + 1
+                    children.append((child, node))
+            level = children
+        return count
+
+    def _read_inserted_pks(self, level, batch_size):
+        """
+        Sets the primary keys of a level of nodes just inserted, read back
+        by ``tree_id`` for the roots and by parent and position for the
+        other nodes.
+        """
+        attname = self.model._meta.get_field(self.parent_field).attname
+        keys = [(node_parent and node_parent.pk, node_parent is None and node.tree_id or node.lft)
+            for node, node_parent in level]
+        pks = {}
+        for start in range(0, len(level), batch_size):
+            chunk = level[start:start+batch_size]
+            if chunk[0][1] is None:
+                rows = self.model.objects.filter(lft=1, tree_id__in=[node.tree_id for node, node_parent in chunk]) \
+                    .values_list('pk', 'tree_id')
+                for pk, tree_id in rows:
+                    pks[(None, tree_id)] = pk
+            else:
+                rows = self.model.objects.filter(**{'%s__in' % self.parent_field:
+                    list(set([node_parent.pk for node, node_parent in chunk]))}).values_list('pk', attname, 'lft')
+                for pk, parent_id, lft in rows:
+                    pks[(parent_id, lft)] = pk
+        for (node, node_parent), key in zip(level, keys):
+            node.pk = pks[key]
+
+    def _link_inserted_nodes(self, pks):
+        """
+        Adds the closure rows of nodes inserted together, whose parents
+        already have theirs.
+        """
+        pks = ', '.join([str(pk) for pk in pks])
+        self.execute('INSERT INTO %(closure)s (%(ancestor_col)s, %(descendant_col)s, distance) '
+            ' SELECT c.%(ancestor_col)s, n.%(pk_col)s, c.distance + 1 '
+            ' FROM %(closure)s c JOIN %(table)s n ON c.%(descendant_col)s = n.%(parent_col)s '
+            ' WHERE n.%(pk_col)s IN (%(pks)s)', {'pks': pks})
+        self.execute('INSERT INTO %(closure)s (%(ancestor_col)s, %(descendant_col)s, distance) '
+            ' SELECT %(pk_col)s, %(pk_col)s, 0 FROM %(table)s WHERE %(pk_col)s IN (%(pks)s)', {'pks': pks})
+
+    def rebuild(self, pks, get_children, trees, batch_size=500):
+        """
+        Numbers the nodes with the given primary keys from the ``(root,
+        tree_id)`` pairs of ``trees`` and rewrites their closure rows, with
+        batched statements of ``batch_size`` rows.
+
+        :returns: the ``(lft, rgt, depth, tree_id, pk)`` values of the nodes;
+            the nodes not reached from a root get ``tree_id`` 0 and only
+            their own closure row.
+        """
+        values = []
+        links = []
+        reached = set()
+        for root, tree_id in trees:
+            stack = [(root, 1, 1, [])]
+            while stack:
+                pk, lft, depth, ancestors = stack.pop()
+                values.append((lft, lft + 1, depth, tree_id, pk))
+                reached.add(pk)
+                ancestors = [pk] + ancestors
+                for distance, ancestor in enumerate(ancestors):
+                    links.append((ancestor, pk, distance))
+                for position, child in enumerate(get_children(pk)):
+                    stack.append((child, position + 2, depth + 1, ancestors))
+        for pk in pks:
+            if pk not in reached:
+                values.append((0, 0, 1, 0, pk))
+                links.append((pk, pk, 0))
+
+        for start in range(0, len(pks), batch_size):
+            self.execute('DELETE FROM %(closure)s WHERE %(descendant_col)s IN (%(pks)s)', {
+                'pks': ', '.join([str(pk) for pk in pks[start:start+batch_size]])})
+        cursor = connection.cursor()
+        sql = 'INSERT INTO %(closure)s (%(ancestor_col)s, %(descendant_col)s, distance) ' \
+              ' VALUES (%%s, %%s, %%s)' % self.sql_params
+        for start in range(0, len(links), batch_size):
+            cursor.executemany(sql, links[start:start+batch_size])
+        return values
+
+    """ Checking """
+
+    def get_check_sql(self):
+        """
+        :returns: the queries finding the problems of the trees, as ``(tree_id,
+            problem)`` rows.
+
+        See: :meth:`easytree.managers.EasyTreeManager.check`
+        """
+        checks = [
+            "SELECT tree_id, 'interval' AS problem FROM %(table)s WHERE rgt <> lft + 1",
+            "SELECT tree_id, 'root' AS problem FROM %(table)s GROUP BY tree_id "
+            " HAVING SUM(CASE WHEN %(parent_col)s IS NULL AND lft = 1 AND depth = 1 THEN 1 ELSE 0 END) <> 1",
+            "SELECT tree_id, 'root' AS problem FROM %(table)s "
+            " WHERE (%(parent_col)s IS NULL AND lft <> 1) OR (%(parent_col)s IS NOT NULL AND lft < 2)",
+            "SELECT MIN(tree_id), 'duplicate' AS problem FROM %(table)s "
+            " WHERE %(parent_col)s IS NOT NULL GROUP BY %(parent_col)s, lft HAVING COUNT(*) > 1",
+            "SELECT n.tree_id, 'nesting' AS problem FROM %(table)s n "
+            " JOIN %(table)s p ON p.%(pk_col)s = n.%(parent_col)s "
+            " WHERE n.tree_id <> p.tree_id OR n.depth <> p.depth + 1",
+            # every node is linked to itself and to the ancestors of its
+            # parent, one step further, and to nothing else
+            "SELECT n.tree_id, 'closure' AS problem FROM %(table)s n WHERE NOT EXISTS "
+            " (SELECT 1 FROM %(closure)s c WHERE c.%(ancestor_col)s = n.%(pk_col)s "
+            "  AND c.%(descendant_col)s = n.%(pk_col)s AND c.distance = 0)",
+            "SELECT n.tree_id, 'closure' AS problem FROM %(table)s n "
+            " JOIN %(closure)s p ON p.%(descendant_col)s = n.%(parent_col)s WHERE NOT EXISTS "
+            " (SELECT 1 FROM %(closure)s c WHERE c.%(descendant_col)s = n.%(pk_col)s "
+            "  AND c.%(ancestor_col)s = p.%(ancestor_col)s AND c.distance = p.distance + 1)",
+            "SELECT n.tree_id, 'closure' AS problem FROM %(closure)s c "
+            " JOIN %(table)s n ON n.%(pk_col)s = c.%(descendant_col)s "
+            " WHERE NOT (c.%(ancestor_col)s = n.%(pk_col)s AND c.distance = 0) AND NOT EXISTS "
+            " (SELECT 1 FROM %(closure)s p WHERE p.%(descendant_col)s = n.%(parent_col)s "
+            "  AND p.%(ancestor_col)s = c.%(ancestor_col)s AND p.distance = c.distance - 1)",
+        ]
+        return ' UNION ALL '.join(checks) % self.sql_params
+
+    """ Batches """
+
+    def get_batch(self):
+        """
+        :returns: the batch running for the model in the current thread, or
+            a new one.
+        """
+        return getattr(_state, 'batches', {}).get(self.model) or ClosureBatch(self.manager)
+
+class ClosureBatch(object):
+    """
+    Context manager running the adds and moves done inside it in a single
+    transaction, holding the lock on the forest.
+
+    Nothing is deferred: a change of a closure table writes only the rows of
+    the nodes changed and of their new siblings, so the changes are made,
+    validated and signaled as they come, and are committed when the block
+    exits.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.model = manager.get_first_model()
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        if self.depth == 1:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            self.manager.lock_forest()
+            if not hasattr(_state, 'batches'):
+                _state.batches = {}
+            _state.batches[self.model] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth:
+            return False
+        try:
+            try:
+                if exc_type is None:
+                    transaction.commit()
+                else:
+                    transaction.rollback()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            transaction.leave_transaction_management()
+            del _state.batches[self.model]
+        if exc_type is None:
+            self.manager._flush_cache()
+        return False
@@ -1,4 +1,7 @@
 from django import forms
+from django.utils.encoding import force_unicode, smart_unicode
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 from easytree import utils
 from easytree.exceptions import EasyTreeException
@@ -14,17 +17,119 @@ pos_map = {
     'sorted-child': _('Sorted child')
 }
 
+def node_label(obj):
+    """
+    :returns: the label of a node, indented by its depth.
+    """
+    return u'%s %s' % (
+        u'>>>' * ((obj.depth or 1) -1),
+        smart_unicode(obj)
+    )
+
 class EasyTreeModelChoiceField(forms.ModelChoiceField):
     
     def label_from_instance(self, obj):
-        return u'%s %s' % (
-            u'>>>' * ((obj.depth or 1) -1),
-            super(EasyTreeModelChoiceField, self).label_from_instance(obj)
-        )
+        return node_label(obj)
+
+AUTOCOMPLETE_JS = u'''
+if (typeof easytree_autocomplete == 'undefined') {
+    var easytree_autocomplete = function(id, url) {
+        var input = document.getElementById(id);
+        var search = document.getElementById(id + '_search');
+        var results = document.getElementById(id + '_results');
+        var timer = null;
+
+        function load(page, append) {
+            var request = new XMLHttpRequest();
+            request.open('GET', url + '?q=' + encodeURIComponent(search.value) + '&page=' + page, true);
+            request.onreadystatechange = function() {
+                if (request.readyState != 4 || request.status != 200) return;
+                var data = JSON.parse(request.responseText);
+                if (!append) results.innerHTML = '';
+                else results.removeChild(results.lastChild);
+                for (var i = 0; i < data.nodes.length; i++) {
+                    var node = data.nodes[i];
+                    var item = document.createElement('li');
+                    var link = document.createElement('a');
+                    link.href = '#';
+                    link.title = node.path;
+                    link.appendChild(document.createTextNode(node.label));
+                    link.onclick = (function(node) {
+                        return function() {
+                            input.value = node.pk;
+                            search.value = node.label;
+                            results.innerHTML = '';
+                            return false;
+                        };
+                    })(node);
+                    item.appendChild(link);
+                    results.appendChild(item);
+                }
+                if (data.has_next) {
+                    var more = document.createElement('li');
+                    var link = document.createElement('a');
+                    link.href = '#';
+                    link.appendChild(document.createTextNode('...'));
+                    link.onclick = function() {
+                        load(page + 1, true);
+                        return false;
+                    };
+                    more.appendChild(link);
+                    results.appendChild(more);
+                }
+            };
+            request.send(null);
+        }
+
+        search.onkeyup = function() {
+            if (!search.value) input.value = '';
+            clearTimeout(timer);
+            timer = setTimeout(function() { load(1, false); }, 250);
+        };
+    };
+}'''
+
+class EasyTreeAutocompleteWidget(forms.TextInput):
+    """
+    Widget choosing a node by searching the autocomplete view of
+    :class:`easytree.admin.EasyTreeAdmin` at ``url``, one page of nodes at a
+    time. Rendering it reads the selected node only.
+    """
+    # the value is in a hidden input, but the field is shown with its label
+    input_type = 'hidden'
+
+    def __init__(self, url, model, attrs=None):
+        super(EasyTreeAutocompleteWidget, self).__init__(attrs)
+        self.url = url
+        self.model = model
+
+    def render(self, name, value, attrs=None):
+        hidden = super(EasyTreeAutocompleteWidget, self).render(name, value, attrs)
+        label = u''
+        if value:
+            try:
+                label = node_label(self.model._default_manager.get(pk=value))
+            except (self.model.DoesNotExist, ValueError):
+                pass
+        field_id = (attrs or {}).get('id', self.attrs.get('id', 'id_%s' % name))
+        return mark_safe(u'''%(hidden)s
+<input type="text" id="%(id)s_search" value="%(label)s" autocomplete="off" size="40" />
+<ul id="%(id)s_results" class="easytree-autocomplete"></ul>
+<script type="text/javascript">%(js)s
+easytree_autocomplete('%(id)s', '%(url)s');</script>''' % {
+            'js': AUTOCOMPLETE_JS,
+            'hidden': hidden,
+            'id': field_id,
+            'label': escape(label),
+            'url': escape(force_unicode(self.url))
+        })
 
 class BaseEasyTreeForm(forms.ModelForm):
     
     toplevel_model_cache = None
+
+    # set by EasyTreeAdmin.get_form to the url of its autocomplete view
+    relative_to_autocomplete_url = None
     
     def get_toplevel_model(self):
         if not self.toplevel_model_cache:
@@ -45,6 +150,9 @@ class BaseEasyTreeForm(forms.ModelForm):
         }
         if raw_relative_to:
             choice_field_kwargs['widget'] = forms.TextInput
+        elif self.relative_to_autocomplete_url:
+            choice_field_kwargs['widget'] = EasyTreeAutocompleteWidget(
+                self.relative_to_autocomplete_url, self.toplevel_model)
 
         self.fields['relative_to'] = EasyTreeModelChoiceField(**choice_field_kwargs)
         
@@ -0,0 +1,193 @@
+"""
+Instrumentation of the structural operations.
+
+Each operation changing the trees of a model (``add_root``,
+``add_child_to``, ``add_sibling_to``, ``move``, ``delete``, ``rebuild``,
+``bulk_load``, ``resort_siblings`` and the writing of a batch) is measured
+when the ``easytree.signals.tree_operation`` signal has receivers for the
+model, and is then sent with an :class:`Operation` describing it::
+
+    from easytree.signals import tree_operation
+
+    def forward(sender, operation, **kwargs):
+        statsd.timing('easytree.%s' % operation.name, operation.seconds * 1000)
+
+    tree_operation.connect(forward, sender=MyTreeModel)
+
+The statements are counted on the cursors the operation gets from the
+connection. Operations run by another one, like ``add_sibling_to`` called by
+``add_child_to``, are part of it and are not reported on their own. Nothing
+is measured while the signal has no receivers.
+
+:data:`collector` is an in-process :class:`Collector`, started with
+``collector.connect()``.
+"""
+from django.db import connection
+from easytree.signals import tree_operation, has_receivers
+import inspect
+import threading
+import time
+
+_state = threading.local()
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+class Operation(object):
+    """
+    A measured operation.
+
+    - ``name``: the name of the manager method, or ``'batch'``.
+    - ``model``: the model of the manager.
+    - ``tree_id``: the tree of the node added or moved, or of the tree
+      rebuilt; ``None`` for operations on several trees.
+    - ``subtree_size``: the number of nodes added or moved, ``None`` when it
+      is not known without a query (sparse trees and the closure storage).
+    - ``seconds``: the wall time.
+    - ``statements``: the number of SQL statements run.
+    - ``rows``: the number of rows inserted, updated or deleted, from the
+      ``rowcount`` of the statements.
+    """
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self.tree_id = None
+        self.subtree_size = None
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+
+    def __repr__(self):
+        return '<Operation %s.%s: tree %s, %s nodes, %.4fs, %d statements, %d rows>' % (
+            self.model.__name__, self.name, self.tree_id, self.subtree_size,
+            self.seconds, self.statements, self.rows)
+
+    def describe(self, node, new):
+        """
+        Sets the tree and the subtree size from the node added or moved.
+        """
+        opts = self.model._easytree_meta
+        self.tree_id = node.tree_id
+        if new:
+            self.subtree_size = 1
+        elif opts.spacing == 1 and not opts.closure_model:
+            self.subtree_size = (node.rgt - node.lft + 1) / 2
+
+class CountingCursor(object):
+    """
+    Wraps a cursor, counting the statements and the rows written in an
+    operation.
+    """
+    def __init__(self, cursor, operation):
+        self.cursor = cursor
+        self.operation = operation
+
+    def _count(self, sql):
+        self.operation.statements += 1
+        if sql.lstrip()[:6].upper() in WRITE_STATEMENTS and self.cursor.rowcount > 0:
+            self.operation.rows += self.cursor.rowcount
+
+    def execute(self, sql, *args):
+        result = self.cursor.execute(sql, *args)
+        self._count(sql)
+        return result
+
+    def executemany(self, sql, *args):
+        result = self.cursor.executemany(sql, *args)
+        self._count(sql)
+        return result
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def instrumented(name, subject=None):
+    """
+    Decorates a structural operation of a manager, a queryset or a batch,
+    all of which have a ``model`` attribute. ``subject`` names the argument
+    holding the node added or moved, or the ``tree_id`` of the tree worked
+    on.
+    """
+    def decorator(func):
+        argnames = inspect.getargspec(func)[0]
+        def wrapper(self, *args, **kwargs):
+            model = self.model
+            if getattr(_state, 'operation', None) is not None or \
+                  not has_receivers(tree_operation, model):
+                return func(self, *args, **kwargs)
+
+            value = None
+            if subject in kwargs:
+                value = kwargs[subject]
+            elif subject in argnames and argnames.index(subject) <= len(args):
+                value = args[argnames.index(subject) - 1]
+            new = getattr(value, 'pk', False) is None
+
+            operation = _state.operation = Operation(name, model)
+            cursor = connection.cursor
+            connection.cursor = lambda: CountingCursor(cursor(), operation)
+            start = time.time()
+            try:
+                result = func(self, *args, **kwargs)
+            finally:
+                operation.seconds = time.time() - start
+                del connection.cursor
+                _state.operation = None
+            if isinstance(value, (int, long)):
+                operation.tree_id = value
+            elif value is not None:
+                operation.describe(value, new)
+            tree_operation.send(sender=model, operation=operation)
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__dict__.update(func.__dict__)
+        return wrapper
+    return decorator
+
+class Collector(object):
+    """
+    Sums the operations per model and name. ``operations`` keeps the last
+    ``keep`` operations.
+    """
+    def __init__(self, keep=100):
+        self.keep = keep
+        self.reset()
+
+    def connect(self, sender=None):
+        tree_operation.connect(self.receive, sender=sender, weak=False,
+            dispatch_uid='easytree-collector-%d' % id(self))
+
+    def disconnect(self, sender=None):
+        tree_operation.disconnect(self.receive, sender=sender, weak=False,
+            dispatch_uid='easytree-collector-%d' % id(self))
+
+    def reset(self):
+        self.totals = {}
+        self.operations = []
+
+    def receive(self, sender, operation, **kwargs):
+        key = (sender._meta.app_label, sender.__name__, operation.name)
+        totals = self.totals.setdefault(key, {'count': 0, 'seconds': 0.0,
+            'statements': 0, 'rows': 0})
+        totals['count'] += 1
+        totals['seconds'] += operation.seconds
+        totals['statements'] += operation.statements
+        totals['rows'] += operation.rows
+        self.operations.append(operation)
+        del self.operations[:-self.keep]
+
+    def report(self):
+        """
+        :returns: one line per model and operation, by decreasing time.
+        """
+        lines = []
+        items = sorted(self.totals.items(), key=lambda item: -item[1]['seconds'])
+        for (app_label, model_name, name), totals in items:
+            lines.append('%s.%s.%s: %d calls, %.4fs, %d statements, %d rows' % (
+                app_label, model_name, name, totals['count'], totals['seconds'],
+                totals['statements'], totals['rows']))
+        return lines
+
+collector = Collector()
@@ -0,0 +1,131 @@
+"""
+Locking of trees during structural changes.
+
+Every change of the nested set values of a tree holds a lock on the tree
+until the end of the transaction; changes renumbering the trees
+(``tree_id``) hold a lock on the whole forest of the model, and changes
+appending trees a lock on the ids of the new trees.
+
+- PostgreSQL: transaction level advisory locks, a shared lock on the forest
+  plus an exclusive lock per tree, or an exclusive lock on the forest.
+- SQLite: the database write lock, taken upfront.
+- Other backends: ``SELECT ... FOR UPDATE`` on the root nodes.
+"""
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+import threading
+import zlib
+
+qn = connection.ops.quote_name
+
+FOREST = -1
+
+_state = threading.local()
+
+def _is_postgresql():
+    return settings.DATABASE_ENGINE in ('postgresql', 'postgresql_psycopg2')
+
+def _lock_key(model):
+    return zlib.crc32(model._meta.db_table)
+
+def lock_trees(model, tree_ids):
+    """
+    Locks the trees with the given ids until the end of the transaction.
+    """
+    tree_ids = sorted(set(tree_ids))
+    if not tree_ids:
+        return
+    cursor = connection.cursor()
+    if _is_postgresql():
+        key = _lock_key(model)
+        cursor.execute('SELECT pg_advisory_xact_lock_shared(%s, %s), %s' % (key, FOREST,
+            ', '.join(['pg_advisory_xact_lock(%s, %d)' % (key, tree_id) for tree_id in tree_ids])))
+    elif settings.DATABASE_ENGINE == 'sqlite3':
+        cursor.execute('UPDATE %s SET tree_id = tree_id WHERE 1 = 0' % qn(model._meta.db_table))
+    else:
+        cursor.execute('SELECT %(pk_col)s FROM %(table)s WHERE lft = 1 AND tree_id IN (%(tree_ids)s) '
+            ' ORDER BY tree_id FOR UPDATE' % {
+                'pk_col': qn(model._meta.pk.column),
+                'table': qn(model._meta.db_table),
+                'tree_ids': ', '.join([str(tree_id) for tree_id in tree_ids])
+            })
+
+def lock_forest(model):
+    """
+    Locks all the trees of the model until the end of the transaction.
+    """
+    cursor = connection.cursor()
+    if _is_postgresql():
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)' % (_lock_key(model), FOREST))
+    elif settings.DATABASE_ENGINE == 'sqlite3':
+        cursor.execute('UPDATE %s SET tree_id = tree_id WHERE 1 = 0' % qn(model._meta.db_table))
+    else:
+        cursor.execute('SELECT %(pk_col)s FROM %(table)s WHERE lft = 1 '
+            ' ORDER BY tree_id FOR UPDATE' % {
+                'pk_col': qn(model._meta.pk.column),
+                'table': qn(model._meta.db_table)
+            })
+
+def lock_new_trees(model, tree_ids, last_tree_id):
+    """
+    Locks the ids of new trees placed after the tree ``last_tree_id``
+    (``None`` if there is no tree) until the end of the transaction. Without
+    advisory locks, there is no row to lock yet: the root of the last tree
+    is locked instead, or all the trees if there is none.
+    """
+    if _is_postgresql() or settings.DATABASE_ENGINE == 'sqlite3':
+        lock_trees(model, tree_ids)
+    elif last_tree_id is not None:
+        lock_trees(model, [last_tree_id])
+    else:
+        lock_forest(model)
+
+def is_conflict(error):
+    """
+    :returns: ``True`` if the database aborted the transaction because of a
+        deadlock or a serialization failure.
+    """
+    if getattr(error, 'pgcode', None) in ('40P01', '40001'):
+        return True
+    message = str(error).lower()
+    return 'deadlock' in message or 'database is locked' in message
+
+def is_outermost():
+    """
+    :returns: ``True`` if the running mutation was not called by another
+        one, which has then already taken the locks.
+    """
+    return getattr(_state, 'depth', 0) <= 1
+
+def is_mutating():
+    """
+    :returns: ``True`` inside a structural mutation.
+    """
+    return getattr(_state, 'depth', 0) > 0
+
+def retry_on_conflict(func):
+    """
+    Decorates a structural mutation, retrying it up to ``lock_retries``
+    times (see the EasyTreeMeta option) after a deadlock or a serialization
+    failure. The transaction is rolled back before retrying, so this is done
+    only for the outermost mutation and if the transaction is not managed.
+    """
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(_state, 'depth', 0)
+        _state.depth = depth + 1
+        try:
+            retries = self.model._easytree_meta.lock_retries
+            while True:
+                try:
+                    return func(self, *args, **kwargs)
+                except DatabaseError, e:
+                    if depth or retries <= 0 or transaction.is_managed() or not is_conflict(e):
+                        raise
+                    transaction.rollback_unless_managed()
+                    retries -= 1
+        finally:
+            _state.depth = depth
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__dict__.update(func.__dict__)
+    return wrapper
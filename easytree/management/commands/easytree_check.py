@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+from easytree.managers import EasyTreeManager
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--repair', action='store_true', dest='repair', default=False,
+            help='Rebuild the damaged trees from their parent column.'),
+    )
+    help = 'Checks the nested set values of the trees of the given models, ' \
+           'or of all the easytree models, and optionally repairs the damaged trees.'
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        models = []
+        for label in labels:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError('Models must be given as appname.ModelName: %s' % label)
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError('Unknown model: %s' % label)
+            if not isinstance(model._default_manager, EasyTreeManager):
+                raise CommandError('%s is not an easytree model.' % label)
+            models.append(model)
+        if not labels:
+            models = [model for model in get_models()
+                if isinstance(model._default_manager, EasyTreeManager)]
+
+        damaged_models = []
+        for model in models:
+            manager = model._default_manager
+            if manager.get_first_model() is not model:
+                # the trees are stored in the table of the parent model
+                continue
+            label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+            damaged = manager.check()
+            if not damaged:
+                if verbosity > 1:
+                    print '%s: ok' % label
+                continue
+            for tree_id, problems in sorted(damaged.items()):
+                print '%s: tree %s: %s' % (label, tree_id, ', '.join(problems))
+            if not options.get('repair'):
+                damaged_models.append(label)
+                continue
+            parent_field = model._easytree_meta.parent_field
+            if not parent_field and 'parent_id' not in [f.column for f in model._meta.fields]:
+                raise CommandError('%s has no parent column to rebuild the trees from.' % label)
+            for tree_id in sorted(damaged):
+                manager.rebuild(tree_id=tree_id)
+            remaining = manager.check()
+            if remaining:
+                damaged_models.append(label)
+                print '%s: trees %s could not be repaired' % (label,
+                    ', '.join([str(tree_id) for tree_id in sorted(remaining)]))
+            else:
+                print '%s: repaired trees %s' % (label,
+                    ', '.join([str(tree_id) for tree_id in sorted(damaged)]))
+
+        if damaged_models:
+            raise CommandError('Damaged trees found in %s.' % ', '.join(damaged_models))
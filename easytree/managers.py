@@ -1,9 +1,19 @@
+from __future__ import with_statement
 from django.db import models
-from django.db.models.signals import pre_save, post_save
-from django.db import transaction, connection
-from easytree import utils
-from easytree.exceptions import InvalidMoveToDescendant, MissingNodeOrderBy, InvalidPosition
-from easytree.signals import node_moved
+from django.db.models.signals import pre_save, post_save, post_syncdb
+from django.conf import settings
+from django.db import transaction, connection, DatabaseError
+from django.db.backends.util import truncate_name
+from django.utils.functional import SimpleLazyObject
+from easytree import locking, utils
+from easytree.batch import TreeBatch, get_batch
+from easytree.cache import cached, get_tree_cache
+from easytree.closure import get_closure
+from easytree.exceptions import EasyTreeException, InvalidMoveToDescendant, MissingNodeOrderBy, \
+    InvalidPosition
+from easytree.instrumentation import instrumented
+from easytree.signals import node_moved, node_pre_move, has_receivers
+from easytree.versions import get_versions
 from django.db.models import Q
 import logging
 import operator
@@ -15,9 +25,20 @@ def move_post_save(sender, instance, created, **kwargs):
     relative_to = getattr(instance, 'easytree_relative_to', None)
     relative_position = getattr(instance, 'easytree_relative_position', None) 
     
+    closure = get_closure(sender.objects)
+    if created and closure is not None:
+        # save_base has already committed the new row
+        closure.insert_node(instance)
+        transaction.commit_unless_managed()
+
     if relative_to and not created:
         logging.debug(u'move_post_save: moved %s to %s | %s' % (unicode(instance), unicode(relative_to), (relative_position)) )
         sender.objects.move(instance, relative_to, pos=relative_position)
+
+    tree_cache = get_tree_cache(sender.objects)
+    if tree_cache is not None and instance.tree_id is not None:
+        tree_cache.record([instance.tree_id])
+        sender.objects._flush_cache()
     
     # in case of saving models twice
     instance.easytree_relative_to = None
@@ -42,13 +63,97 @@ def calculate_lft_rght(sender, instance, **kwargs):
              logging.debug('calculate_lft_rght: added new root: %s | %s' % (unicode(instance), relative_position))
              sender.objects.add_root(new_object=instance)
 
+    elif instance.tree_id is not None:
+        versions = get_versions(sender.objects)
+        if versions is not None:
+            versions.touch([instance.tree_id])
+
+def create_indexes(sender, created_models, **kwargs):
+    # also sent by flush, for all the models
+    cursor = connection.cursor()
+    for model in models.get_models(sender):
+        if model not in created_models:
+            continue
+        manager = model._default_manager
+        if isinstance(manager, EasyTreeManager) and manager.get_first_model() is model:
+            for sql in manager.get_index_sql():
+                try:
+                    cursor.execute(sql)
+                except DatabaseError:
+                    # the index exists, on backends without IF NOT EXISTS
+                    pass
+
 class EasyTreeQuerySet(models.query.QuerySet):
     """
     Custom queryset for the tree node manager.
 
-    Needed only for the customized delete method.
+    Provides the customized delete method, in-memory tree materialization
+    and prefetching of tree relations.
     """
 
+    _prefetch_ancestors = False
+    _prefetch_children = False
+    _prefetch_children_depth = 1
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_prefetch_ancestors', self._prefetch_ancestors)
+        kwargs.setdefault('_prefetch_children', self._prefetch_children)
+        kwargs.setdefault('_prefetch_children_depth', self._prefetch_children_depth)
+        return super(EasyTreeQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        if not (self._prefetch_ancestors or self._prefetch_children):
+            return super(EasyTreeQuerySet, self).iterator()
+        nodes = list(super(EasyTreeQuerySet, self).iterator())
+        if self._prefetch_children:
+            self.model.objects.prefetch_children_for(nodes, self._prefetch_children_depth)
+        if self._prefetch_ancestors:
+            ancestors = self.model.objects.get_ancestors_for_nodes(nodes)
+            for node in nodes:
+                node._cached_ancestors = ancestors[node]
+                if node._cached_ancestors:
+                    node._cached_parent_obj = node._cached_ancestors[-1]
+        return iter(nodes)
+
+    def prefetch_ancestors(self):
+        """
+        Fetches the ancestors of all the nodes in the queryset with a single
+        additional query and caches them on each node, so that
+        ``ancestors()`` and ``make_materialized_path()`` don't hit the
+        database.
+        """
+        return self._clone(_prefetch_ancestors=True)
+
+    def prefetch_children(self, depth=1):
+        """
+        Fetches the children of all the nodes in the queryset with a single
+        additional range query and caches them on each node, so that
+        ``children()`` doesn't hit the database.
+
+        With ``depth`` greater than 1 the children of the children are
+        cached too, down to ``depth`` levels; ``None`` caches all the
+        descendants.
+        """
+        return self._clone(_prefetch_children=True, _prefetch_children_depth=depth)
+
+    def get_cached_tree(self):
+        """
+        Evaluates the queryset ordered by ``tree_id`` and ``lft`` and links the
+        returned nodes to each other, so that their ``children()``,
+        ``ancestors()``, ``siblings()`` and ``is_root()`` helpers are served
+        from memory.
+
+        Children are cached as returned by the queryset: filter it by whole
+        subtrees to get complete children lists.
+
+        :returns: A *list* of nodes ordered as DFS.
+        """
+        nodes = list(self.order_by('tree_id', 'lft'))
+        utils.link_tree_nodes(nodes)
+        return nodes
+
+    @locking.retry_on_conflict
+    @instrumented('delete')
     def delete(self, removed_ranges=None):
         """
         Custom delete method, will remove all descendant nodes to ensure a
@@ -56,6 +161,42 @@ class EasyTreeQuerySet(models.query.QuerySet):
 
         :returns: ``None``
         """
+        if removed_ranges is None and not transaction.is_managed():
+            # Django's delete commits unless the transaction is managed,
+            # which would release the locks of the trees before their gaps
+            # are closed: delete the nodes and close the gaps together
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                try:
+                    self._delete(removed_ranges)
+                    transaction.commit()
+                except:
+                    transaction.rollback()
+                    raise
+            finally:
+                transaction.leave_transaction_management()
+        else:
+            self._delete(removed_ranges)
+
+    def _delete(self, removed_ranges):
+        if removed_ranges is None:
+            self.model.objects._write_batch()
+        if removed_ranges is None and locking.is_outermost():
+            # the nodes may be moved to other trees while waiting for the
+            # locks: lock until their trees are all held
+            locked = set()
+            while True:
+                tree_ids = set(self.order_by().values_list('tree_id', flat=True).distinct())
+                if not tree_ids - locked:
+                    break
+                self.model.objects.lock_trees(*(tree_ids - locked))
+                locked.update(tree_ids)
+        closure = get_closure(self.model.objects)
+        if closure is not None:
+            closure.delete(self)
+            self.model.objects._flush_cache()
+            return
         if removed_ranges is not None:
             # we already know the children, let's call the default django
             # delete method and let it handle the removal of the user's
@@ -63,42 +204,41 @@ class EasyTreeQuerySet(models.query.QuerySet):
             super(EasyTreeQuerySet, self).delete()
             cursor = connection.cursor()
 
-            # Now closing the gap (Celko's trees book, page 62)
-            # We do this for every gap that was left in the tree when the nodes
-            # were removed.  If many nodes were removed, we're going to update
-            # the same nodes over and over again. This would be probably
-            # cheaper precalculating the gapsize per intervals, or just do a
-            # complete reordering of the tree (uses COUNT)...
-            for tree_id, drop_lft, drop_rgt in sorted(removed_ranges, reverse=True):
-                sql, params = self.model.objects._get_close_gap_sql(drop_lft, drop_rgt,
-                                                            tree_id)
+            # Now closing the gaps (Celko's trees book, page 62) with a
+            # single UPDATE per tree: every remaining value is shifted by the
+            # total width of the removed ranges on its left.
+            # Sparse trees keep the gaps, only the parents left without
+            # children are shrunk back to leaves.
+            trees = {}
+            for tree_id, drop_lft, drop_rgt in sorted(removed_ranges):
+                trees.setdefault(tree_id, []).append((drop_lft, drop_rgt))
+            for tree_id, ranges in trees.items():
+                if self.model._easytree_meta.spacing > 1:
+                    sql, params = self.model.objects._get_tighten_sql(
+                        'tree_id = %d AND (%s)' % (tree_id, ' OR '.join(
+                            ['lft < %d AND rgt > %d' % drop for drop in ranges])))
+                else:
+                    sql, params = self.model.objects._get_close_gaps_sql(tree_id, ranges)
                 cursor.execute(sql, params)
         else:
-            # we'll have to manually run through all the nodes that are going
-            # to be deleted and remove nodes from the list if an ancestor is
-            # already getting removed, since that would be redundant
-            removed = {}
-            for node in self.order_by('tree_id', 'lft'):
-                found = False
-                for rid, rnode in removed.items():
-                    if self.model.objects.is_descendant_of(node, rnode):
-                        found = True
-                        break
-                if not found:
-                    removed[node.id] = node
-            logging.debug('removed: %s' % str(removed))
+            # a single ordered pass finds the minimal list of nodes to remove:
+            # a node is redundant if it is inside the last range kept, since
+            # that would already remove it
+            ranges = []
+            for tree_id, lft, rgt in self.order_by('tree_id', 'lft').values_list('tree_id', 'lft', 'rgt'):
+                if ranges and ranges[-1][0] == tree_id and lft < ranges[-1][2]:
+                    continue
+                ranges.append((tree_id, lft, rgt))
+            logging.debug('removed: %s' % str(ranges))
             # ok, got the minimal list of nodes to remove...
             # we must also remove their descendants
-            toremove = []
-            ranges = []
-            for id, node in removed.items():
-                toremove.append(
-                  Q(lft__range=(node.lft, node.rgt))&Q(tree_id=node.tree_id))
-                ranges.append((node.tree_id, node.lft, node.rgt))
+            toremove = [Q(lft__range=(lft, rgt))&Q(tree_id=tree_id)
+                for tree_id, lft, rgt in ranges]
             if toremove:
                 self.model.objects.filter(
                     reduce(operator.or_, toremove)).delete(removed_ranges=ranges)
-                    
+            self.model.objects._flush_cache()
+
 class EasyTreeManager(models.Manager):
     
     def get_query_set(self):
@@ -117,14 +257,206 @@ class EasyTreeManager(models.Manager):
         super(EasyTreeManager, self).contribute_to_class(model, name)
         pre_save.connect(calculate_lft_rght, sender=model)
         post_save.connect(move_post_save, sender=model)
+        post_syncdb.connect(create_indexes, dispatch_uid='easytree.managers.create_indexes')
         
     def get_first_model(self):
         return utils.get_toplevel_model(self.model)
+
+    def lock_trees(self, *tree_ids):
+        """
+        Locks the trees with the given ids until the end of the current
+        transaction, as done by every change of their structure.
+
+        See: :mod:`easytree.locking`
+        """
+        locking.lock_trees(self.get_first_model(), tree_ids)
+        self._record_changes(tree_ids)
+
+    def _lock_new_trees(self, count=1, after=0):
+        """
+        Locks the ids of ``count`` new trees placed after the last tree, or
+        after the tree ``after`` if it comes later, as done by the changes
+        appending trees. The last tree is read again once the ids are
+        locked, until it doesn't change.
+
+        :returns: the ids of the new trees.
+        """
+        if count <= 0:
+            return []
+        spacing = self.model._easytree_meta.tree_id_spacing
+        locked = set()
+        while True:
+            last_root = self.get_last_root_node()
+            last_tree_id = last_root and last_root.tree_id
+            first = max(last_tree_id or 0, after) + spacing
+            tree_ids = range(first, first + count * spacing, spacing)
+            if locked.issuperset(tree_ids):
+                return tree_ids
+            locking.lock_new_trees(self.get_first_model(), tree_ids, last_tree_id)
+            self._record_changes(tree_ids, forest=True)
+            locked.update(tree_ids)
+
+    def lock_forest(self):
+        """
+        Locks all the trees until the end of the current transaction, as
+        done by the changes adding, removing or renumbering trees.
+
+        See: :mod:`easytree.locking`
+        """
+        locking.lock_forest(self.get_first_model())
+        self._record_changes(all_trees=True)
+
+    def _record_changes(self, tree_ids=(), all_trees=False, forest=False):
+        """
+        Counts a change of the given trees, or of all the trees, in the
+        version model and records them for the invalidation of the cache.
+        ``forest`` counts a change of the forest as well.
+        """
+        versions = get_versions(self)
+        if versions is not None:
+            versions.touch(tree_ids, all_trees, forest)
+        tree_cache = get_tree_cache(self)
+        if tree_cache is not None:
+            tree_cache.record(tree_ids, renumbered=all_trees)
+
+    def _flush_cache(self):
+        """
+        Invalidates the cached reads of the trees changed, once the changes
+        are committed.
+
+        See: :mod:`easytree.cache`
+        """
+        tree_cache = get_tree_cache(self)
+        if tree_cache is None:
+            return
+        tree_cache.flush()
+
+    def batch(self):
+        """
+        :returns: a context manager deferring the adds and moves of nodes
+            done inside it, the trees are renumbered once when it exits::
+
+                with MyTreeModel.objects.batch():
+                    for node in nodes:
+                        node.save()
+                    MyTreeModel.objects.move(node, other_node, 'last-child')
+
+        With the closure storage, nothing is deferred and the block only
+        runs in a single transaction.
+
+        See: :mod:`easytree.batch`, :class:`easytree.closure.ClosureBatch`
+        """
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_batch()
+        return get_batch(self.get_first_model()) or TreeBatch(self)
+
+    def _write_batch(self):
+        """
+        Writes the changes recorded by the running batch, if any, before an
+        operation working on the stored values.
+        """
+        batch = get_batch(self.get_first_model())
+        if batch is not None:
+            batch.write()
+
+    def move_many(self, moves):
+        """
+        Applies a list of ``(target, relative_to, pos)`` moves in order, in a
+        batch: the trees are renumbered once, in a single transaction, and
+        the ``node_moved`` signals are sent at the end.
+
+        The batch doesn't run the validators, so every move is validated
+        first with :meth:`validate_move`, against the trees before the
+        moves: nothing is moved if one of them is invalid.
+
+        See: :meth:`batch`
+        """
+        for target, dest, pos in moves:
+            self.fix_move_vars(target, dest, pos)
+        with self.batch():
+            for target, dest, pos in moves:
+                self.move(target, dest, pos)
+
+    def reorder_children(self, parent, children):
+        """
+        Reorders the children of ``parent`` (or the root nodes, if
+        ``parent`` is ``None``) with :meth:`move_many`. ``children`` must
+        list all of them, once each, in their new order.
+        """
+        if parent is None:
+            siblings = self.get_root_nodes()
+        else:
+            siblings = self.get_children_for(parent)
+        siblings = list(siblings.order_by('tree_id', 'lft').values_list('pk', flat=True))
+        current = set(siblings)
+        pks = [node.pk for node in children]
+        if not current.issuperset(pks):
+            raise InvalidPosition(u'Not among the children: %s' % u', '.join(
+                [unicode(node) for node in children if node.pk not in current]))
+        if len(set(pks)) != len(pks) or len(pks) != len(current):
+            raise InvalidPosition('The children must be listed once each, all of them.')
+        if not children:
+            return
+
+        # the first node goes on the left of the current first one, the
+        # others on the right of the previous one
+        first = dict([(node.pk, node) for node in children])[siblings[0]]
+        moves = []
+        for index, node in enumerate(children):
+            if index:
+                moves.append((node, children[index - 1], 'right'))
+            elif node.pk != first.pk:
+                moves.append((node, first, 'left'))
+        self.move_many(moves)
+
+    def _lock_nodes(self, nodes, needs_forest=None):
+        """
+        Locks the trees of the given nodes, or all the trees if
+        ``needs_forest(nodes)`` is true, and reloads the nodes once the locks
+        are held.
+
+        :returns: the reloaded nodes.
+        """
+        cls = self.get_first_model()
+
+        def reload(nodes):
+            loaded = cls.objects.in_bulk([node.pk for node in nodes])
+            for node in nodes:
+                if node.pk not in loaded:
+                    # deleted while waiting for the lock
+                    raise cls.DoesNotExist('%s matching query does not exist.'
+                        % cls._meta.object_name)
+            return [loaded[node.pk] for node in nodes]
+
+        if needs_forest is not None and needs_forest(nodes):
+            self.lock_forest()
+            return reload(nodes)
+        locked = set()
+        while True:
+            tree_ids = set([node.tree_id for node in nodes]) - locked
+            if not tree_ids:
+                break
+            self.lock_trees(*tree_ids)
+            locked.update(tree_ids)
+            nodes = reload(nodes)
+        if needs_forest is not None and needs_forest(nodes):
+            self.lock_forest()
+            nodes = reload(nodes)
+        return nodes
         
     def get_descendant_count(self, target):
         """
         :returns: the number of descendants of a node.
+
+        Sparse trees (see the ``spacing`` option) and the closure storage
+        need a query.
         """
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_descendant_count(target)
+        if self.model._easytree_meta.spacing > 1:
+            return self.get_descendants_for(target).count()
         return (target.rgt - target.lft - 1) / 2
 
     def get_ancestors_for(self, target):
@@ -139,11 +471,101 @@ class EasyTreeManager(models.Manager):
             return cls.objects.none()
         if not target.rgt:
             return cls.objects.none()
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_ancestors_for(target)
         return cls.objects.filter(
             tree_id=target.tree_id,
             lft__lt=target.lft,
             rgt__gt=target.rgt)
             
+    def get_ancestors_for_nodes(self, nodes):
+        """
+        :returns: A dictionary mapping each of the given nodes to the list of
+            its ancestors, starting by the root node and descending to the
+            parent. The ancestors of all the nodes are fetched with a single
+            query.
+
+        Example::
+
+           MyTreeModel.objects.get_ancestors_for_nodes(search_results)
+        """
+        cls = self.get_first_model()
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_ancestors_for_nodes(nodes)
+
+        ancestors = {}
+        trees = {}
+        for node in nodes:
+            ancestors[node] = []
+            if not self.is_root(node):
+                trees.setdefault(node.tree_id, {})[(node.lft, node.rgt)] = node
+        if not trees:
+            return ancestors
+
+        filters = []
+        for tree_id, ranges in trees.items():
+            filters.append(Q(tree_id=tree_id) & reduce(operator.or_,
+                [Q(lft__lt=lft, rgt__gt=rgt) for lft, rgt in ranges.keys()]))
+
+        ranges_ancestors = {}
+        for ancestor in cls.objects.filter(reduce(operator.or_, filters)).order_by('tree_id', 'lft'):
+            for lft, rgt in trees[ancestor.tree_id].keys():
+                if ancestor.lft < lft and ancestor.rgt > rgt:
+                    ranges_ancestors.setdefault((ancestor.tree_id, lft, rgt), []).append(ancestor)
+
+        for node in ancestors.keys():
+            ancestors[node] = ranges_ancestors.get((node.tree_id, node.lft, node.rgt), [])
+        return ancestors
+
+    def prefetch_children_for(self, nodes, depth=1):
+        """
+        Fetches the descendants of the given nodes down to ``depth`` levels
+        (all of them if ``depth`` is ``None``) with a single query and caches
+        them as children lists on the nodes.
+
+        See: :meth:`easytree.managers.EasyTreeQuerySet.prefetch_children`
+        """
+        cls = self.get_first_model()
+        closure = get_closure(self)
+        if closure is not None:
+            tree = closure.prefetch_children_for(nodes, depth)
+        else:
+            filters = []
+            for node in nodes:
+                if self.is_leaf(node):
+                    continue
+                lookups = {'tree_id': node.tree_id, 'lft__range': (node.lft+1, node.rgt-1)}
+                if depth is not None:
+                    lookups['depth__lte'] = node.depth + depth
+                filters.append(Q(**lookups))
+
+            tree = {}
+            if filters:
+                for descendant in cls.objects.filter(reduce(operator.or_, filters)):
+                    tree[descendant.pk] = descendant
+            for node in nodes:
+                tree[node.pk] = node
+            tree = tree.values()
+            tree.sort(key=lambda node: (node.tree_id, node.lft))
+            utils.link_tree_nodes(tree)
+
+        # only the nodes within the depth limit have all their children cached
+        complete = set()
+        for node in nodes:
+            stack = [node]
+            while stack:
+                current = stack.pop()
+                if depth is None or current.depth - node.depth < depth:
+                    complete.add(current.pk)
+                    stack.extend(current._cached_children)
+        for node in tree:
+            # the closure storage can't tell the leaves without a query
+            if node.pk not in complete and (closure is not None or not self.is_leaf(node)):
+                del node._cached_children
+
+    @cached
     def get_descendants_for(self, target):
         """
         :returns: A queryset of all the node's descendants as DFS, doesn't
@@ -152,6 +574,9 @@ class EasyTreeManager(models.Manager):
         See: :meth:`easytree.managers.EasyTreeManager.get_descendants_for`
         """
         cls = self.get_first_model()
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_descendants_for(target)
         if self.is_leaf(target):
             return cls.objects.none()
         return self.get_tree(target).exclude(pk=target.id)
@@ -163,9 +588,48 @@ class EasyTreeManager(models.Manager):
 
         See: :meth:`easytree.managers.EasyTreeManager.is_descendant_of`
         """
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.is_descendant_of(target, node)
         return target.tree_id == node.tree_id and \
                target.lft > node.lft and \
                target.rgt < node.rgt
+
+    def is_ancestor_of(self, target, node):
+        """
+        :returns: ``True`` if the node is an ancestor of another node given
+            as an argument, else, returns ``False``
+        """
+        return self.is_descendant_of(node, target)
+
+    def is_sibling_of(self, target, node):
+        """
+        :returns: ``True`` if the node is a sibling of another node given
+            as an argument, else, returns ``False``
+
+        Roots and nodes with a cached parent are compared without queries;
+        otherwise a single query checks that no ancestor of one node at the
+        parent's depth excludes the other.
+        """
+        if target.depth != node.depth:
+            return False
+        if self.is_root(target):
+            return self.is_root(node)
+        if target.tree_id != node.tree_id:
+            return False
+        try:
+            return target._cached_parent_obj.pk == node._cached_parent_obj.pk
+        except AttributeError:
+            pass
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.is_sibling_of(target, node)
+        cls = self.get_first_model()
+        return cls.objects.filter(
+            tree_id=target.tree_id,
+            depth=target.depth-1,
+            lft__lt=min(target.lft, node.lft),
+            rgt__gt=max(target.rgt, node.rgt)).count() == 1
                
     def get_parent_for(self, target, update=False):
         """
@@ -174,8 +638,6 @@ class EasyTreeManager(models.Manager):
 
         See: :meth:`easytree.managers.EasyTreeManager.get_parent_for`
         """
-        if self.is_root(target):
-            return None
         try:
             if update:
                 del target._cached_parent_obj
@@ -183,6 +645,17 @@ class EasyTreeManager(models.Manager):
                 return target._cached_parent_obj
         except AttributeError:
             pass
+        if self.is_root(target):
+            return None
+        parent_field = self.model._easytree_meta.parent_field
+        if parent_field:
+            # a primary key lookup, or served by select_related
+            if update:
+                field = self.model._meta.get_field(parent_field)
+                if hasattr(target, field.get_cache_name()):
+                    delattr(target, field.get_cache_name())
+            target._cached_parent_obj = getattr(target, parent_field)
+            return target._cached_parent_obj
         # parent = our most direct ancestor
         try: 
             target._cached_parent_obj = self.get_ancestors_for(target).reverse()[0]
@@ -250,6 +723,7 @@ class EasyTreeManager(models.Manager):
         except IndexError:
             return None
 
+    @cached
     def get_tree(self, parent=None):
         """
         :returns: A *queryset* of nodes ordered as DFS, including the parent. If
@@ -262,6 +736,9 @@ class EasyTreeManager(models.Manager):
             This metod returns a queryset.
         """
         cls = self.get_first_model()
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_tree(parent)
 
         if parent is None:
             # return the entire tree
@@ -272,6 +749,41 @@ class EasyTreeManager(models.Manager):
             tree_id=parent.tree_id,
             lft__range=(parent.lft, parent.rgt-1))
             
+    def get_cached_tree(self, parent=None):
+        """
+        :returns: A *list* of nodes ordered as DFS, including the parent. If
+                  no parent is given, all trees are returned.
+
+        The nodes are fetched with a single query and linked to each other,
+        so that their ``children()``, ``descendants()``, ``siblings()``,
+        ``ancestors()`` and ``is_root()`` helpers don't hit the database.
+        The ancestors of the parent are fetched by the same query.
+
+        Example::
+
+           MyTreeModel.objects.get_cached_tree(node)
+        """
+        cls = self.get_first_model()
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.get_cached_tree(parent)
+
+        if parent is None:
+            nodes = cls.objects.all().get_cached_tree()
+            roots = [node for node in nodes if node.depth == 1]
+            for root in roots:
+                root._cached_siblings = roots
+            return nodes
+
+        nodes = cls.objects.filter(tree_id=parent.tree_id).filter(
+            Q(lft__range=(parent.lft, parent.rgt-1)) |
+            Q(lft__lt=parent.lft, rgt__gt=parent.rgt)).get_cached_tree()
+        tree = [node for node in nodes if node.lft >= parent.lft]
+        for ancestor in nodes[:len(nodes)-len(tree)]:
+            # the children of the ancestors have not been fetched
+            del ancestor._cached_children
+        return tree
+
     def get_depth_for(self, target):
         """
         :returns: the depth (level) of the node
@@ -298,11 +810,13 @@ class EasyTreeManager(models.Manager):
         """
         :returns: True if the node is a root node (else, returns False)
 
+        Answered from the node's ``lft`` value, without queries.
+
         Example::
 
            node.is_root()
         """
-        return self.get_root(target) == target
+        return target.lft == 1
 
     def is_leaf(self, target):
         """
@@ -310,14 +824,21 @@ class EasyTreeManager(models.Manager):
 
         See: :meth:`easytree.managers.EasyTreeManager.is_leaf`
         """
+        closure = get_closure(self)
+        if closure is not None:
+            return closure.is_leaf(target)
         return target.rgt - target.lft == 1
         
+    @cached
     def get_children_for(self, target):
         """
         :returns: A queryset of all the node's children
 
         See: :meth:`easytree.managers.EasyTreeManager.get_children`
         """
+        parent_field = self.model._easytree_meta.parent_field
+        if parent_field:
+            return self.filter(**{parent_field: target.pk}).order_by('tree_id', 'lft')
         return self.get_descendants_for(target).filter(depth=target.depth+1)
 
     def get_last_child_for(self, target):
@@ -333,6 +854,8 @@ class EasyTreeManager(models.Manager):
         except IndexError:
             return None
             
+    @locking.retry_on_conflict
+    @instrumented('move', 'target')
     def move(self, target, real_dest, pos=None):
         """
         Moves the current node and all it's descendants to a new position
@@ -343,10 +866,22 @@ class EasyTreeManager(models.Manager):
         parent = None
         
         cls = self.get_first_model()
+        batch = get_batch(cls)
+        if batch is not None:
+            return batch.move(target, real_dest, pos)
+        if locking.is_outermost():
+            def needs_forest(nodes):
+                # moving a root, or to the root level, renumbers the trees
+                return self.is_root(nodes[0]) or (self.is_root(nodes[1]) and \
+                    pos not in ('first-child', 'last-child', 'sorted-child'))
+            target, real_dest = self._lock_nodes([target, real_dest], needs_forest)
         dest = real_dest
         real_pos = pos
         
         pos, dest, parent = self.fix_move_vars(target, dest, pos)
+        new_parent = parent
+        if new_parent is None and self.model._easytree_meta.parent_field:
+            new_parent = self.get_parent_for(dest)
 
         if target == dest and (
               (pos == 'left') or \
@@ -357,12 +892,18 @@ class EasyTreeManager(models.Manager):
             # special cases, not actually moving the node so no need to UPDATE
             return
 
+        closure = get_closure(self)
+        if closure is not None:
+            new_values = closure.move(target, dest, pos, real_dest, real_pos)
+            if new_values is not None:
+                self._moved(target, real_dest, real_pos, new_values)
+            return
+
         if pos == 'sorted-sibling':
-            siblings = list(self.get_sorted_pos_queryset_for(dest, \
-                self.get_siblings_for(dest), target))
-            if siblings:
+            sorted_dest = self.get_sorted_dest_for(dest, self.get_siblings_for(dest), target)
+            if sorted_dest:
                 pos = 'left'
-                dest = siblings[0]
+                dest = sorted_dest
             else:
                 pos = 'last-sibling'
         if pos in ('left', 'right', 'first-sibling'):
@@ -386,12 +927,17 @@ class EasyTreeManager(models.Manager):
             if pos == 'first-sibling':
                 dest = siblings[0]
         
+        old_parent = None
+        if self.model._easytree_meta.spacing > 1 and not self.is_root(target):
+            old_parent = self.get_parent_for(target)
+
         # ok let's move this
         cursor = connection.cursor()
         move_right = self._move_right
         gap = target.rgt - target.lft + 1
-        sql = None
+        sql, params = None, []
         dest_tree = dest.tree_id
+        in_tree = pos == 'last-child' or not self.is_root(dest)
 
         # first make a hole
         if pos == 'last-child':
@@ -400,7 +946,11 @@ class EasyTreeManager(models.Manager):
         elif self.is_root(dest):
             newpos = 1
             if pos == 'last-sibling':
-                dest_tree = self.get_siblings_for(dest).reverse()[0].tree_id + 1
+                dest_tree = self.get_siblings_for(dest).reverse()[0].tree_id + \
+                    self.model._easytree_meta.tree_id_spacing
+            elif self.model._easytree_meta.tree_id_spacing > 1:
+                # dest is the first root for 'first-sibling'
+                dest_tree, sql, params = self._get_free_tree_id(dest.tree_id)
             elif pos == 'first-sibling':
                 dest_tree = 1
                 sql, params = self._move_tree_right(1)
@@ -417,8 +967,101 @@ class EasyTreeManager(models.Manager):
                 newpos = dest.lft
                 sql, params = move_right(dest.tree_id, newpos, True, gap)
 
+        # where the subtree ends up: the gap it leaves is closed unless
+        # sparse trees move it to a hole, and the trees after a moved root
+        # shift left
+        new_lft = newpos
+        if in_tree and dest_tree == target.tree_id and newpos > target.rgt and \
+              (self.model._easytree_meta.single_statement_move or \
+               self.model._easytree_meta.spacing == 1):
+            new_lft = newpos - gap
+        new_tree_id = dest_tree
+        if self.is_root(target) and self.is_root(dest) and dest_tree > target.tree_id and \
+              self.model._easytree_meta.tree_id_spacing == 1:
+            new_tree_id = dest_tree - 1
+        new_values = {'tree_id': new_tree_id, 'lft': new_lft, 'rgt': new_lft + gap - 1,
+                      'depth': dest.depth + (parent and 1 or 0)}
+        self._send_pre_move(target, real_dest, real_pos, new_values)
+
+        if in_tree and dest_tree == target.tree_id and \
+              self.model._easytree_meta.single_statement_move:
+            # no need for a hole, relocate the subtree in a single statement
+            depthdiff = dest.depth - target.depth
+            if parent:
+                depthdiff += 1
+            sql, params = self._move_within_tree_sql(target, newpos, depthdiff)
+            cursor.execute(sql, params)
+        else:
+            self._move_to_hole(cursor, target, dest, parent, dest_tree, newpos, sql, params)
+
+        if old_parent is not None:
+            sql, params = self._get_tighten_sql('%s = %d' % (
+                qn(cls._meta.pk.column), old_parent.pk))
+            cursor.execute(sql, params)
+
+        if self.model._easytree_meta.parent_field:
+            cursor.execute('UPDATE %(table)s SET %(parent_col)s = %%s WHERE %(pk_col)s = %%s' % {
+                'table': qn(cls._meta.db_table),
+                'parent_col': qn(cls._meta.get_field(self.model._easytree_meta.parent_field).column),
+                'pk_col': qn(cls._meta.pk.column)
+            }, [new_parent and new_parent.pk, target.pk])
+            self._set_parent(target, new_parent)
+
+        self._moved(target, real_dest, real_pos, new_values)
+
+    def _send_pre_move(self, target, real_dest, real_pos, new_values):
+        """
+        Sends the ``node_pre_move`` signal, if it has receivers.
+        """
+        if not has_receivers(node_pre_move, target.__class__):
+            return
+        old_values = {}
+        for name in new_values:
+            old_values[name] = getattr(target, name)
+        node_pre_move.send(
+            sender=target.__class__,
+            node=target,
+            relative_to=real_dest,
+            relative_position=real_pos,
+            old_values=old_values,
+            new_values=dict(new_values)
+        )
+
+    def _moved(self, target, real_dest, real_pos, new_values):
+        """
+        Updates the node and the paths of a moved subtree, commits and sends
+        the ``node_moved`` signal. The nodes passed to the receivers are
+        only fetched if they are used.
+        """
+        cls = self.get_first_model()
+        for name, value in new_values.items():
+            setattr(target, name, value)
+        if self.model._easytree_meta.path_field:
+            self.update_paths_for(target)
+            
+        transaction.commit_unless_managed()
+        self._flush_cache()
+        
+        if not has_receivers(node_moved, target.__class__):
+            return
+        def lazy_node(pk):
+            return SimpleLazyObject(lambda: cls.objects.get(pk=pk))
+        node_moved.send(
+            sender=target.__class__,
+            node_moved=lazy_node(target.pk),
+            moved_to_node=lazy_node(real_dest.pk),
+            relative_position=real_pos
+        )
+            
+    def _move_to_hole(self, cursor, target, dest, parent, dest_tree, newpos, sql, params):
+        """
+        Moves a subtree making a hole at the destination, moving the subtree
+        into the hole and closing the gap left in the source tree.
+        """
+        cls = self.get_first_model()
+
         if sql:
-            cursor.execute(sql, params)   
+            cursor.execute(sql, params)
 
         # we reload 'self' because lft/rgt may have changed
 
@@ -429,15 +1072,7 @@ class EasyTreeManager(models.Manager):
             depthdiff += 1
 
         # move the tree to the hole
-        sql = "SELECT * FROM %(table)s " \
-              " WHERE tree_id = %(from_tree)d AND " \
-              "     lft BETWEEN %(fromlft)d AND %(fromrgt)d ORDER BY id ASC FOR UPDATE" % {
-                  'table': cls._meta.db_table,
-                  'from_tree': fromobj.tree_id,
-                  'fromlft': fromobj.lft,
-                  'fromrgt': fromobj.rgt
-              }
-        sql = sql + ";UPDATE %(table)s " \
+        sql = "UPDATE %(table)s " \
               " SET tree_id = %(dest_tree)d, " \
               "     lft = lft + %(jump)d , " \
               "     rgt = rgt + %(jump)d , " \
@@ -454,68 +1089,134 @@ class EasyTreeManager(models.Manager):
               }
         cursor.execute(sql, [])
 
-        # close the gap
-        sql, params = self._get_close_gap_sql(fromobj.lft,
-            fromobj.rgt, fromobj.tree_id)
-        cursor.execute(sql, params)
+        # close the gap, sparse trees keep it
+        if self.model._easytree_meta.spacing == 1:
+            sql, params = self._get_close_gap_sql(fromobj.lft,
+                fromobj.rgt, fromobj.tree_id)
+            cursor.execute(sql, params)
         
         logging.debug('%s %s' %  (dest_tree, fromobj.tree_id))
-        if self.is_root(target) and self.is_root(dest): # close gap when moving root nodes
+        if self.is_root(target) and self.is_root(dest) and \
+              self.model._easytree_meta.tree_id_spacing == 1: # close gap when moving root nodes
             sql, params = self._move_tree_left(fromobj.tree_id)
             cursor.execute(sql, params)
-            
-        transaction.commit_unless_managed()
-        
-        node_moved.send(
-            sender=target.__class__,
-            node_moved=cls.objects.get(pk=target.id), # make sure we get the updated nodes
-            moved_to_node=cls.objects.get(pk=real_dest.pk),
-            relative_position=real_pos
-        )
-            
+
+    def _move_within_tree_sql(self, target, newpos, depthdiff):
+        """
+        :returns: the statement moving a subtree to ``newpos`` inside its
+            tree, where ``newpos`` is the position a hole would have been made
+            at. Only the nodes between the old and the new position are
+            shifted, by the size of the subtree.
+        """
+        cls = self.get_first_model()
+
+        gap = target.rgt - target.lft + 1
+        if newpos > target.rgt:
+            # moving right, the nodes in between move left
+            first, last = target.rgt + 1, newpos - 1
+            jump, shift = newpos - target.rgt - 1, -gap
+        else:
+            # moving left, the nodes in between move right
+            first, last = newpos, target.lft - 1
+            jump, shift = newpos - target.lft, gap
+
+        # depth is set first, as MySQL sees the updated values of the
+        # columns assigned before
+        sql = 'UPDATE %(table)s ' \
+              ' SET depth = CASE WHEN lft BETWEEN %(lft)d AND %(rgt)d ' \
+              '                  THEN depth %(depthdiff)+d ' \
+              '                  ELSE depth END, ' \
+              '     lft = CASE WHEN lft BETWEEN %(lft)d AND %(rgt)d ' \
+              '                THEN lft %(jump)+d ' \
+              '                WHEN lft BETWEEN %(first)d AND %(last)d ' \
+              '                THEN lft %(shift)+d ' \
+              '                ELSE lft END, ' \
+              '     rgt = CASE WHEN rgt BETWEEN %(lft)d AND %(rgt)d ' \
+              '                THEN rgt %(jump)+d ' \
+              '                WHEN rgt BETWEEN %(first)d AND %(last)d ' \
+              '                THEN rgt %(shift)+d ' \
+              '                ELSE rgt END ' \
+              ' WHERE tree_id = %(tree_id)d AND ' \
+              '     (lft BETWEEN %(start)d AND %(end)d OR ' \
+              '      rgt BETWEEN %(start)d AND %(end)d)' % {
+                  'table': qn(cls._meta.db_table),
+                  'tree_id': target.tree_id,
+                  'lft': target.lft,
+                  'rgt': target.rgt,
+                  'first': first,
+                  'last': last,
+                  'jump': jump,
+                  'shift': shift,
+                  'depthdiff': depthdiff,
+                  'start': min(first, target.lft),
+                  'end': max(last, target.rgt)
+              }
+        return sql, []
+
+    @locking.retry_on_conflict
+    @instrumented('add_sibling_to', 'new_object')
     def add_sibling_to(self, target, pos=None, new_object=None):
         """
         Adds a new node as a sibling to the current node object.
+
+        The changes are committed with the new node when it is saved.
         """
         cls = self.get_first_model()
+        batch = get_batch(cls)
+        if batch is not None:
+            return batch.add(new_object, target, pos)
+        if locking.is_outermost():
+            target, = self._lock_nodes([target], lambda nodes: self.is_root(nodes[0]))
         
         pos = self.fix_add_sibling_vars(new_object, target, pos)
 
         # creating a new object
         new_object.depth = target.depth
+        if self.model._easytree_meta.path_field or self.model._easytree_meta.parent_field:
+            parent = self.get_parent_for(target)
+            self._set_path(new_object, parent)
+            self._set_parent(new_object, parent)
 
         sql = None
         if self.is_root(target):
             new_object.lft = 1
             new_object.rgt = 2
             if pos == 'sorted-sibling':
-                siblings = list(self.get_sorted_pos_queryset_for(target, \
-                    self.get_siblings(target), new_object))
-                if siblings:
+                sorted_dest = self.get_sorted_dest_for(target,
+                    self.get_siblings_for(target), new_object)
+                if sorted_dest:
                     pos = 'left'
-                    target = siblings[0]
+                    target = sorted_dest
                 else:
                     pos = 'last-sibling'
 
+            tree_id_spacing = self.model._easytree_meta.tree_id_spacing
             last_root = self.get_last_root_node()
             if pos == 'last-sibling' \
                   or (pos == 'right' and target == last_root):
-                new_object.tree_id = last_root.tree_id + 1
+                new_object.tree_id = last_root.tree_id + tree_id_spacing
+            elif tree_id_spacing > 1:
+                before = {'first-sibling': lambda: self.get_root_nodes()[0].tree_id,
+                          'left': lambda: target.tree_id,
+                          'right': lambda: self._get_next_tree_id(target.tree_id)}[pos]()
+                new_object.tree_id, sql, params = self._get_free_tree_id(before)
             else:
                 newpos = {'first-sibling': 1,
                           'left': target.tree_id,
                           'right': target.tree_id + 1}[pos]
                 sql, params = self._move_tree_right(newpos)
                 new_object.tree_id = newpos
+        elif get_closure(self) is not None:
+            return get_closure(self).add_sibling_to(target, new_object, pos)
         else:
             new_object.tree_id = target.tree_id
 
             if pos == 'sorted-sibling':
-                siblings = list(self.get_sorted_pos_queryset_for(target,
-                    self.get_siblings_for(target), new_object))
-                if siblings:
+                sorted_dest = self.get_sorted_dest_for(target,
+                    self.get_siblings_for(target), new_object)
+                if sorted_dest:
                     pos = 'left'
-                    target = siblings[0]
+                    target = sorted_dest
                 else:
                     pos = 'last-sibling'
 
@@ -542,31 +1243,51 @@ class EasyTreeManager(models.Manager):
 
             move_right = self._move_right
 
-            if pos == 'last-sibling':
-                newpos = self.get_parent_for(target).rgt
-                sql, params = move_right(target.tree_id, newpos, False, 2)
-            elif pos == 'first-sibling':
-                newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos-1, False, 2)
-            elif pos == 'left':
-                newpos = target.lft
-                sql, params = move_right(target.tree_id, newpos, True, 2)
-
-            new_object.lft = newpos
-            new_object.rgt = newpos + 1
+            if self.model._easytree_meta.spacing > 1:
+                if pos == 'last-sibling':
+                    parent = self.get_parent_for(target)
+                    sql, params = self._fit_leaf(new_object, target.tree_id, parent.rgt, parent)
+                else:
+                    sql, params = self._fit_leaf(new_object, target.tree_id, target.lft)
+            else:
+                if pos == 'last-sibling':
+                    newpos = self.get_parent_for(target).rgt
+                    sql, params = move_right(target.tree_id, newpos, False, 2)
+                elif pos == 'first-sibling':
+                    newpos = target.lft
+                    sql, params = move_right(target.tree_id, newpos-1, False, 2)
+                elif pos == 'left':
+                    newpos = target.lft
+                    sql, params = move_right(target.tree_id, newpos, True, 2)
+
+                new_object.lft = newpos
+                new_object.rgt = newpos + 1
 
         # saving the instance before returning it
         if sql:
             cursor = connection.cursor()
             cursor.execute(sql, params)
-            
-        transaction.commit_unless_managed()
         
+    @locking.retry_on_conflict
+    @instrumented('add_child_to', 'new_object')
     def add_child_to(self, target, new_object=None, pos=None):
         """
         Adds a child to the node.
+
+        The changes are committed with the new node when it is saved.
         """
         cls = self.get_first_model()
+        batch = get_batch(cls)
+        if batch is not None:
+            return batch.add(new_object, target, pos, 'child')
+        passed = target
+        if locking.is_outermost():
+            target, = self._lock_nodes([target])
+        closure = get_closure(self)
+        if closure is not None:
+            if pos is None:
+                pos = self.model._easytree_meta.node_order_by and 'sorted-child' or 'last-child'
+            return closure.add_child_to(target, new_object, pos)
         
         if not self.is_leaf(target):
             # there are child nodes, delegate insertion to add_sibling
@@ -579,30 +1300,49 @@ class EasyTreeManager(models.Manager):
             last_child._cached_parent_obj = target
             return self.add_sibling_to(last_child, new_object=new_object, pos=pos)
 
-        # we're adding the first child of this node
-        sql, params = self._move_right(target.tree_id, target.rgt, False, 2)
-
         # creating a new object
         new_object.tree_id = target.tree_id
         new_object.depth = target.depth + 1
-        new_object.lft = target.lft+1
-        new_object.rgt = target.lft+2
 
-        # this is just to update the cache
-        target.rgt = target.rgt+2
-        
+        # we're adding the first child of this node
+        if self.model._easytree_meta.spacing > 1:
+            sql, params = self._fit_leaf(new_object, target.tree_id,
+                target.rgt, target, target.lft)
+        else:
+            sql, params = self._move_right(target.tree_id, target.rgt, False, 2)
+            new_object.lft = target.lft+1
+            new_object.rgt = target.lft+2
+            target.rgt = target.rgt+2
+        # this is just to update the cache of the given instance
+        passed.lft, passed.rgt = target.lft, target.rgt
+
         new_object._cached_parent_obj = target
+        self._set_path(new_object, target)
+        self._set_parent(new_object, target)
 
-        cursor = connection.cursor()
-        cursor.execute(sql, params)
-        transaction.commit_unless_managed()
+        if sql:
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
         
+    @locking.retry_on_conflict
+    @instrumented('add_root', 'new_object')
     def add_root(self, new_object=None):
         """
         Adds a root node to the tree.
+
+        The changes are committed with the new node when it is saved.
         """
         
         cls = self.get_first_model()
+        batch = get_batch(cls)
+        if batch is not None:
+            return batch.add(new_object)
+        if locking.is_outermost():
+            if self.model._easytree_meta.node_order_by:
+                # a sorted root may shift the trees on its right
+                self.lock_forest()
+            else:
+                self._lock_new_trees()
 
         # do we have a root node already?
         last_root = self.get_last_root_node()
@@ -615,19 +1355,179 @@ class EasyTreeManager(models.Manager):
         if last_root:
             
             # adding the new root node as the last one
-            newtree_id = last_root.tree_id + 1
+            newtree_id = last_root.tree_id + self.model._easytree_meta.tree_id_spacing
         else:
             # adding the first root node
-            newtree_id = 1
+            newtree_id = self.model._easytree_meta.tree_id_spacing
 
-        new_object
         new_object.depth = 1
         new_object.tree_id = newtree_id
         new_object.lft = 1
         new_object.rgt = 2
+        self._set_path(new_object, None)
+        self._set_parent(new_object, None)
         
-        transaction.commit_unless_managed()        
-        
+    @locking.retry_on_conflict
+    @instrumented('bulk_load')
+    def bulk_load(self, data, parent=None, batch_size=500):
+        """
+        Loads many new nodes at once, computing their ``lft``, ``rgt``,
+        ``depth`` and ``tree_id`` values in memory and inserting them with
+        multi-row INSERT statements of ``batch_size`` rows.
+
+        ``data`` is a list of dictionaries with the field values of a node
+        under ``'data'`` and the list of its children under ``'children'``::
+
+            MyTreeModel.objects.bulk_load([
+                {'data': {'title': 'games'}, 'children': [
+                    {'data': {'title': 'action'}},
+                    {'data': {'title': 'rpg'}},
+                ]},
+            ])
+
+        The nodes are appended as new trees, or as the last children of
+        ``parent``. The ``pre_save`` and ``post_save`` signals are not sent
+        and validators are not run.
+
+        :returns: the number of nodes inserted.
+        """
+        cls = self.get_first_model()
+        if cls is not self.model:
+            raise EasyTreeException('bulk_load does not support multi-table inheritance.')
+        self._write_batch()
+
+        children = {}
+        def make_nodes(entries):
+            nodes = []
+            for entry in entries:
+                node = cls(**entry.get('data', {}))
+                children[id(node)] = make_nodes(entry.get('children', []))
+                nodes.append(node)
+            return nodes
+        nodes = make_nodes(data)
+        get_children = lambda node: children[id(node)]
+
+        closure = get_closure(self)
+        if closure is not None:
+            if parent is not None:
+                parent, = self._lock_nodes([parent])
+            else:
+                self._lock_new_trees(len(nodes))
+            count = closure.bulk_load(nodes, get_children, parent, batch_size)
+            transaction.commit_unless_managed()
+            self._flush_cache()
+            return count
+
+        spacing = self.model._easytree_meta.spacing
+        if parent is not None:
+            parent, = self._lock_nodes([parent])
+            numbered = utils.number_tree(nodes, get_children,
+                lft=parent.rgt+spacing-1, depth=parent.depth+1, spacing=spacing)
+            if not numbered:
+                return 0
+            # make a hole for all the nodes at once
+            last_rgt = max([row[2] for row in numbered])
+            sql, params = self._move_right(parent.tree_id, parent.rgt, False,
+                last_rgt + spacing - parent.rgt)
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            for row in numbered:
+                row[0].tree_id = parent.tree_id
+                if row[4] is None:
+                    row[4] = parent
+        else:
+            numbered = []
+            for root, tree_id in zip(nodes, self._lock_new_trees(len(nodes))):
+                tree = utils.number_tree([root], get_children, spacing=spacing)
+                for row in tree:
+                    row[0].tree_id = tree_id
+                numbered.extend(tree)
+
+        for node, lft, rgt, depth, node_parent in numbered:
+            node.lft, node.rgt, node.depth = lft, rgt, depth
+            self._set_path(node, node_parent)
+            self._set_parent(node, node_parent)
+
+        self._insert_nodes([row[0] for row in numbered], batch_size)
+        if self.model._easytree_meta.parent_field:
+            self._link_inserted_nodes(numbered, batch_size)
+        transaction.commit_unless_managed()
+        self._flush_cache()
+        return len(numbered)
+
+    def bulk_load_pairs(self, rows, parent=None, batch_size=500):
+        """
+        Loads many new nodes at once from a stream of ``(key, parent_key,
+        data)`` tuples, where ``data`` is a dictionary with the field values
+        of the node and ``parent_key`` is ``None`` for the top level nodes.
+        Siblings keep the order of the stream.
+
+        See: :meth:`easytree.managers.EasyTreeManager.bulk_load`
+        """
+        entries = {}
+        top_level = []
+        pairs = []
+        for key, parent_key, data in rows:
+            entries[key] = {'data': data, 'children': []}
+            pairs.append((key, parent_key))
+        for key, parent_key in pairs:
+            if parent_key is None:
+                top_level.append(entries[key])
+            else:
+                entries[parent_key]['children'].append(entries[key])
+        return self.bulk_load(top_level, parent=parent, batch_size=batch_size)
+
+    def _insert_nodes(self, nodes, batch_size):
+        cls = self.get_first_model()
+        fields = [f for f in cls._meta.local_fields if not isinstance(f, models.AutoField)]
+
+        placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+        sql = 'INSERT INTO %(table)s (%(columns)s) VALUES ' % {
+            'table': qn(cls._meta.db_table),
+            'columns': ', '.join([qn(f.column) for f in fields])
+        }
+        cursor = connection.cursor()
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start:start+batch_size]
+            params = []
+            for node in batch:
+                params.extend([f.get_db_prep_save(f.pre_save(node, True)) for f in fields])
+            cursor.execute(sql + ', '.join([placeholders] * len(batch)), params)
+
+    def _link_inserted_nodes(self, numbered, batch_size):
+        """
+        Sets the parent of the nodes inserted under other new nodes, whose
+        primary keys were unknown: the keys are read back by ``lft`` from
+        the ranges inserted.
+        """
+        cls = self.get_first_model()
+        ranges = {}
+        for node, lft, rgt, depth, parent in numbered:
+            first, last = ranges.get(node.tree_id, (lft, rgt))
+            ranges[node.tree_id] = (min(first, lft), max(last, rgt))
+        pks = {}
+        for tree_id, (first, last) in ranges.items():
+            for pk, lft in self.filter(tree_id=tree_id, lft__range=(first, last)) \
+                  .values_list('pk', 'lft'):
+                pks[(tree_id, lft)] = pk
+        for node, lft, rgt, depth, parent in numbered:
+            node.pk = pks[(node.tree_id, lft)]
+
+        column = cls._meta.get_field(self.model._easytree_meta.parent_field).column
+        sql = 'UPDATE %(table)s SET %(parent_col)s = %%s WHERE %(pk_col)s = %%s' % {
+            'table': qn(cls._meta.db_table),
+            'parent_col': qn(column),
+            'pk_col': qn(cls._meta.pk.column)
+        }
+        params = []
+        for node, lft, rgt, depth, parent in numbered:
+            if parent is not None and parent.lft >= ranges[node.tree_id][0]:
+                self._set_parent(node, parent)
+                params.append((parent.pk, node.pk))
+        cursor = connection.cursor()
+        for start in range(0, len(params), batch_size):
+            cursor.executemany(sql, params[start:start+batch_size])
+
     def get_sorted_pos_queryset_for(self, target, siblings, newobj):
         """
         :returns: The position a new node will be inserted related to the
@@ -646,19 +1546,100 @@ class EasyTreeManager(models.Manager):
                 [Q(**{'%s__gt' % field: value})]))
             fields.append((field, value))
         return siblings.filter(reduce(operator.or_, filters))
+
+    def get_sorted_dest_for(self, target, siblings, newobj):
+        """
+        :returns: The first of the ``siblings`` that sorts after ``newobj``,
+        which the node is placed on the left of, or ``None`` if it goes
+        last. Fetched with a single ``LIMIT 1`` query walking the siblings in
+        order on the ``(tree_id, depth, lft)`` index.
+        """
+        try:
+            return self.get_sorted_pos_queryset_for(target, siblings, newobj) \
+                .order_by('tree_id', 'lft')[0]
+        except IndexError:
+            return None
+
+    @locking.retry_on_conflict
+    @instrumented('resort_siblings', 'target')
+    def resort_siblings(self, target):
+        """
+        Sorts the siblings of ``target``, including itself, by
+        :attr:`node_order_by`, e.g. after the values of these fields were
+        changed. Every subtree keeps its size and is shifted to its new
+        position with a single UPDATE; sorting root nodes swaps their
+        ``tree_id`` values; with the closure storage, only the positions of
+        the siblings are updated. The ``node_moved`` signal is not sent.
+        """
+        cls = self.get_first_model()
+        node_order_by = list(self.model._easytree_meta.node_order_by)
+        if not node_order_by:
+            raise MissingNodeOrderBy('Missing node_order_by attribute.')
+        self._write_batch()
+        target, = self._lock_nodes([target], lambda nodes: self.is_root(nodes[0]))
+
+        siblings = list(self.get_siblings_for(target).order_by('tree_id', 'lft'))
+        ordered = list(self.get_siblings_for(target).order_by(*(node_order_by + ['tree_id', 'lft'])))
+
+        cursor = connection.cursor()
+        if self.is_root(target):
+            renumbered = [(node.tree_id, sibling.tree_id)
+                for node, sibling in zip(ordered, siblings) if node.tree_id != sibling.tree_id]
+            if renumbered:
+                cursor.execute('UPDATE %(table)s SET tree_id = CASE tree_id %(cases)s END '
+                    ' WHERE tree_id IN (%(tree_ids)s)' % {
+                        'table': qn(cls._meta.db_table),
+                        'cases': ' '.join(['WHEN %d THEN %d' % item for item in renumbered]),
+                        'tree_ids': ', '.join([str(item[0]) for item in renumbered])
+                    })
+        elif get_closure(self) is not None:
+            get_closure(self).resort_siblings(siblings, ordered)
+        else:
+            # the free values between siblings of sparse trees stay in place
+            gaps = [node.lft - previous.rgt - 1
+                for previous, node in zip(siblings, siblings[1:])] + [0]
+            position = siblings[0].lft
+            shifts = []
+            for node, gap in zip(ordered, gaps):
+                if node.lft != position:
+                    shifts.append((node.lft, node.rgt, position - node.lft))
+                position += node.rgt - node.lft + 1 + gap
+            if shifts:
+                cases = lambda column: ' '.join(['WHEN %s BETWEEN %d AND %d THEN %d' % (
+                    column, lft, rgt, shift) for lft, rgt, shift in shifts])
+                cursor.execute('UPDATE %(table)s '
+                    ' SET lft = lft + CASE %(lft_cases)s ELSE 0 END, '
+                    '     rgt = rgt + CASE %(rgt_cases)s ELSE 0 END '
+                    ' WHERE tree_id = %(tree_id)d AND lft BETWEEN %(first)d AND %(last)d' % {
+                        'table': qn(cls._meta.db_table),
+                        'lft_cases': cases('lft'),
+                        'rgt_cases': cases('rgt'),
+                        'tree_id': target.tree_id,
+                        'first': siblings[0].lft,
+                        'last': siblings[-1].rgt
+                    })
+        transaction.commit_unless_managed()
+        self._flush_cache()
+
+    def get_index_sql(self):
+        """
+        :returns: The statements creating the composite index on
+        ``(tree_id, depth, lft)`` used to list children and siblings in
+        order. They are run by ``syncdb`` when the table is created; run
+        them by hand for existing tables.
+        """
+        cls = self.get_first_model()
+        table = cls._meta.db_table
+        name = truncate_name('%s_tree_depth_lft' % table, connection.ops.max_name_length())
+        if_not_exists = ''
+        if settings.DATABASE_ENGINE in ('postgresql', 'postgresql_psycopg2', 'sqlite3'):
+            if_not_exists = 'IF NOT EXISTS '
+        return ['CREATE INDEX %s%s ON %s (tree_id, depth, lft)' % (if_not_exists, qn(name), qn(table))]
         
     def _get_close_gap_sql(self, drop_lft, drop_rgt, tree_id):
         cls = self.get_first_model()
 
-        sql = 'SELECT * FROM %(table)s ' \
-              ' WHERE (lft > %(drop_lft)d ' \
-              '     OR rgt > %(drop_lft)d) AND '\
-              '     tree_id=%(tree_id)d ORDER BY id ASC FOR UPDATE' % {
-                  'table': cls._meta.db_table,
-                  'drop_lft': drop_lft,
-                  'tree_id': tree_id
-              }
-        sql = sql + ";" + 'UPDATE %(table)s ' \
+        sql = 'UPDATE %(table)s ' \
               ' SET lft = CASE ' \
               '           WHEN lft > %(drop_lft)d ' \
               '           THEN lft - %(gapsize)d ' \
@@ -677,6 +1658,112 @@ class EasyTreeManager(models.Manager):
               }
         return sql, []
                 
+    def _get_close_gaps_sql(self, tree_id, ranges):
+        cls = self.get_first_model()
+
+        # ranges are sorted and disjoint: a value right of several ranges
+        # moves left by their total width
+        shifts = []
+        gapsize = 0
+        for drop_lft, drop_rgt in ranges:
+            gapsize += drop_rgt - drop_lft + 1
+            shifts.insert(0, (drop_rgt, gapsize))
+
+        def shift(column):
+            return 'CASE %s ELSE %s END' % (' '.join(
+                ['WHEN %s > %d THEN %s - %d' % (column, drop_rgt, column, gapsize)
+                    for drop_rgt, gapsize in shifts]), column)
+
+        sql = 'UPDATE %(table)s ' \
+              ' SET lft = %(lft)s, ' \
+              '     rgt = %(rgt)s ' \
+              ' WHERE rgt > %(drop_lft)d AND '\
+              '     tree_id=%(tree_id)d' % {
+                  'table': cls._meta.db_table,
+                  'lft': shift('lft'),
+                  'rgt': shift('rgt'),
+                  'drop_lft': ranges[0][0],
+                  'tree_id': tree_id
+              }
+        return sql, []
+
+    def _fit_leaf(self, new_object, tree_id, before, parent=None, after=None):
+        """
+        Places a new leaf between the value ``after`` (looked up if not
+        given) and the value ``before`` of a sparse tree. If the free values
+        between them are exhausted, the ``parent`` ending at ``before`` is
+        extended into the free values following it, or the tree is widened
+        by ``2 * spacing`` at ``before``.
+
+        :returns: the statement making room for the leaf, if any.
+        """
+        cls = self.get_first_model()
+        spacing = self.model._easytree_meta.spacing
+
+        if after is None:
+            after = self._get_value_before(tree_id, before)
+        sql, params = None, []
+        if before - after < 3 and parent is not None:
+            end = after + 2 * spacing + 1
+            following = self._get_value_after(tree_id, parent.rgt)
+            if following is not None:
+                end = min(end, following - 1)
+            if end - after >= 3:
+                sql = 'UPDATE %(table)s SET rgt = %(rgt)d WHERE %(pk_col)s = %(pk)d' % {
+                    'table': qn(cls._meta.db_table),
+                    'pk_col': qn(cls._meta.pk.column),
+                    'rgt': end,
+                    'pk': parent.pk
+                }
+                before = parent.rgt = end
+        if before - after < 3:
+            sql, params = self._move_right(tree_id, before, True, 2 * spacing)
+            before = before + 2 * spacing
+            if parent is not None:
+                parent.rgt = before
+
+        new_object.lft = after + min(spacing, (before - after - 1) / 2)
+        new_object.rgt = new_object.lft + 1
+        return sql, params
+
+    def _get_value_before(self, tree_id, value):
+        cls = self.get_first_model()
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(CASE WHEN rgt < %(value)d THEN rgt ELSE lft END) '
+            ' FROM %(table)s WHERE tree_id = %(tree_id)d AND lft < %(value)d' % {
+                'table': qn(cls._meta.db_table),
+                'tree_id': tree_id,
+                'value': value
+            })
+        return cursor.fetchone()[0]
+
+    def _get_value_after(self, tree_id, value):
+        cls = self.get_first_model()
+        cursor = connection.cursor()
+        cursor.execute('SELECT MIN(CASE WHEN lft > %(value)d THEN lft ELSE rgt END) '
+            ' FROM %(table)s WHERE tree_id = %(tree_id)d AND rgt > %(value)d' % {
+                'table': qn(cls._meta.db_table),
+                'tree_id': tree_id,
+                'value': value
+            })
+        return cursor.fetchone()[0]
+
+    def _get_tighten_sql(self, where):
+        """
+        :returns: the statement turning the nodes matching ``where`` that
+            have no descendants left back into tight leaves.
+        """
+        cls = self.get_first_model()
+        sql = 'UPDATE %(table)s SET rgt = lft + 1 ' \
+              ' WHERE rgt > lft + 1 AND (%(where)s) AND NOT EXISTS (' \
+              '     SELECT 1 FROM %(table)s child ' \
+              '     WHERE child.tree_id = %(table)s.tree_id AND ' \
+              '         child.lft > %(table)s.lft AND child.lft < %(table)s.rgt)' % {
+                  'table': qn(cls._meta.db_table),
+                  'where': where
+              }
+        return sql, []
+
     def _move_right(self, tree_id, rgt, lftmove=False, incdec=2):
         cls = self.get_first_model()
 
@@ -685,13 +1772,7 @@ class EasyTreeManager(models.Manager):
         else:
             lftop = '>'
         
-        sql = 'SELECT * FROM %(table)s ' \
-              ' WHERE rgt >= %(parent_rgt)d AND ' \
-              '       tree_id = %(tree_id)s ORDER BY id ASC FOR UPDATE' % {
-                  'table': cls._meta.db_table,
-                  'parent_rgt': rgt,
-                  'tree_id': tree_id}
-        sql = sql + ';UPDATE %(table)s ' \
+        sql = 'UPDATE %(table)s ' \
               ' SET lft = CASE WHEN lft %(lftop)s %(parent_rgt)d ' \
               '                THEN lft %(incdec)+d ' \
               '                ELSE lft END, ' \
@@ -728,7 +1809,211 @@ class EasyTreeManager(models.Manager):
                   'tree_id': tree_id
               }
         return sql, []
+
+    def _get_next_tree_id(self, tree_id):
+        """
+        :returns: the id of the tree following the tree ``tree_id``.
+        """
+        cls = self.get_first_model()
+        cursor = connection.cursor()
+        cursor.execute('SELECT MIN(tree_id) FROM %(table)s '
+            ' WHERE lft = 1 AND tree_id > %(tree_id)d' % {
+                'table': qn(cls._meta.db_table),
+                'tree_id': tree_id
+            })
+        return cursor.fetchone()[0]
+
+    def _get_free_tree_id(self, before):
+        """
+        Picks the id of a new tree placed before the tree ``before``, in the
+        middle of the unused ids between it and the previous tree. If there
+        are none, the trees from ``before`` up to the next unused id are
+        shifted right by one, leaving the other trees untouched.
+
+        :returns: the tree id and the statement making room for it, if any.
+        """
+        cls = self.get_first_model()
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(tree_id) FROM %(table)s '
+            ' WHERE lft = 1 AND tree_id < %(before)d' % {
+                'table': qn(cls._meta.db_table),
+                'before': before
+            })
+        after = cursor.fetchone()[0] or 0
+        if before - after > 1:
+            return after + (before - after) / 2, None, []
+        cursor.execute('SELECT MIN(tree_id) FROM %(table)s '
+            ' WHERE lft = 1 AND tree_id >= %(before)d AND tree_id + 1 NOT IN '
+            '  (SELECT tree_id FROM %(table)s WHERE lft = 1)' % {
+                'table': qn(cls._meta.db_table),
+                'before': before
+            })
+        last = cursor.fetchone()[0]
+        sql = 'UPDATE %(table)s ' \
+              ' SET tree_id = tree_id+1 ' \
+              ' WHERE tree_id BETWEEN %(before)d AND %(last)d' % {
+                  'table': qn(cls._meta.db_table),
+                  'before': before,
+                  'last': last
+              }
+        return before, sql, []
     
+    """ Materialized paths """
+
+    def _make_path(self, node, parent):
+        opts = self.model._easytree_meta
+        source = unicode(getattr(node, opts.path_source))
+        if parent is None:
+            if opts.path_include_root:
+                return source
+            return u''
+        parent_path = getattr(parent, opts.path_field)
+        if parent_path:
+            return opts.path_sep.join([parent_path, source])
+        return source
+
+    def _concat_sql(self, *parts):
+        """
+        :returns: an SQL expression concatenating the given SQL expressions;
+            ``||`` is a logical OR on MySQL.
+        """
+        if settings.DATABASE_ENGINE == 'mysql':
+            return 'CONCAT(%s)' % ', '.join(parts)
+        return ' || '.join(parts)
+
+    def _set_path(self, node, parent):
+        path_field = self.model._easytree_meta.path_field
+        if path_field:
+            setattr(node, path_field, self._make_path(node, parent))
+
+    def _set_parent(self, node, parent):
+        parent_field = self.model._easytree_meta.parent_field
+        if parent_field:
+            setattr(node, parent_field, parent)
+            node._cached_parent_obj = parent
+
+    def get_by_path(self, path):
+        """
+        :returns: the node stored with the given materialized path, looked
+            up by equality on the ``path_field`` column.
+
+        Example::
+
+           MyTreeModel.objects.get_by_path('news/sports')
+        """
+        return self.get(**{self.model._easytree_meta.path_field: path})
+
+    def update_paths_for(self, target):
+        """
+        Rewrites the materialized path of a node and of all its descendants
+        with a single UPDATE, replacing the stored path prefix of the node
+        with the one derived from its current parent.
+
+        Call it after changing the ``path_source`` field of a node, whether
+        it has descendants or not: saving the node doesn't update its own
+        path.
+        """
+        cls = self.get_first_model()
+        opts = self.model._easytree_meta
+
+        old_path = getattr(target, opts.path_field)
+        new_path = self._make_path(target, self.get_parent_for(target, True))
+
+        new_prefix = u''
+        if new_path:
+            new_prefix = new_path + opts.path_sep
+        cut = 1
+        if old_path:
+            cut = len(old_path) + len(opts.path_sep) + 1
+
+        path = qn(cls._meta.get_field(opts.path_field).column)
+        closure = get_closure(self)
+        if closure is not None:
+            subtree = closure.get_subtree_sql(target)
+        else:
+            subtree = 'tree_id = %d AND lft BETWEEN %d AND %d' % (
+                target.tree_id, target.lft, target.rgt)
+        sql = 'UPDATE %(table)s ' \
+              ' SET %(path)s = CASE WHEN %(pk_col)s = %%s THEN %%s ' \
+              '     ELSE %(new_path)s END ' \
+              ' WHERE %(subtree)s' % {
+                  'table': qn(cls._meta.db_table),
+                  'path': path,
+                  'pk_col': qn(cls._meta.pk.column),
+                  'new_path': self._concat_sql('%s', 'SUBSTR(%s, %d)' % (path, cut)),
+                  'subtree': subtree
+              }
+        cursor = connection.cursor()
+        cursor.execute(sql, [target.pk, new_path, new_prefix])
+        setattr(target, opts.path_field, new_path)
+
+    def rebuild_paths(self, tree_id=None):
+        """
+        Recomputes the materialized paths of all the nodes, or of the nodes
+        of a single tree, with one UPDATE per tree level.
+        """
+        cls = self.get_first_model()
+        opts = self.model._easytree_meta
+        self._write_batch()
+
+        table = qn(cls._meta.db_table)
+        path = qn(cls._meta.get_field(opts.path_field).column)
+        source = qn(cls._meta.get_field(opts.path_source).column)
+        tree_filter = ''
+        if tree_id is not None:
+            tree_filter = ' AND %s.tree_id = %d' % (table, tree_id)
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT MAX(depth) FROM %s WHERE 1 = 1%s' % (table, tree_filter))
+        max_depth = cursor.fetchone()[0] or 0
+
+        if opts.path_include_root:
+            root_path = source
+        else:
+            root_path = "''"
+        cursor.execute('UPDATE %s SET %s = %s WHERE depth = 1%s' % (
+            table, path, root_path, tree_filter))
+
+        if get_closure(self) is not None:
+            parent_where = 'parent.%s = %s.%s' % (qn(cls._meta.pk.column), table,
+                qn(cls._meta.get_field(opts.parent_field).column))
+        else:
+            parent_where = 'parent.lft < %(table)s.lft AND parent.rgt > %(table)s.rgt' % {
+                'table': table}
+        for depth in range(2, max_depth + 1):
+            if depth == 2 and not opts.path_include_root:
+                cursor.execute('UPDATE %s SET %s = %s WHERE depth = 2%s' % (
+                    table, path, source, tree_filter))
+                continue
+            values = {
+                'table': table,
+                'path': path,
+                'depth': depth,
+                'parent_depth': depth - 1,
+                'parent_where': parent_where,
+                'tree_filter': tree_filter
+            }
+            if settings.DATABASE_ENGINE == 'mysql':
+                # MySQL can't select from the updated table in a subquery
+                values['new_path'] = self._concat_sql('parent.%s' % path, '%s',
+                    '%s.%s' % (table, source))
+                sql = 'UPDATE %(table)s JOIN %(table)s parent ' \
+                      ' ON parent.tree_id = %(table)s.tree_id AND ' \
+                      '    parent.depth = %(parent_depth)d AND %(parent_where)s ' \
+                      ' SET %(table)s.%(path)s = %(new_path)s ' \
+                      ' WHERE %(table)s.depth = %(depth)d%(tree_filter)s' % values
+            else:
+                values['new_path'] = self._concat_sql(
+                    '(SELECT parent.%(path)s FROM %(table)s parent ' \
+                    '  WHERE parent.tree_id = %(table)s.tree_id AND ' \
+                    '      parent.depth = %(parent_depth)d AND ' \
+                    '      %(parent_where)s)' % values, '%s', source)
+                sql = 'UPDATE %(table)s ' \
+                      ' SET %(path)s = %(new_path)s ' \
+                      ' WHERE depth = %(depth)d%(tree_filter)s' % values
+            cursor.execute(sql, [opts.path_sep])
+        transaction.commit_unless_managed()
+
     """ Validation """
     
     def validate_root(self, target, related, pos=None, **kwargs):
@@ -841,63 +2126,156 @@ class EasyTreeManager(models.Manager):
                 
         return self.validate_move(target, related, pos)
 
-    def rebuild(self):
+    @locking.retry_on_conflict
+    @instrumented('rebuild', 'tree_id')
+    def rebuild(self, tree_id=None, batch_size=500):
         """
         Rebuilds whole tree in database using parent.
+
+        All the ``(pk, parent_id)`` pairs, from the ``parent_field`` column
+        if set, are read with a single query, the nested set values are
+        computed in memory and written back with batched UPDATE statements
+        of ``batch_size`` rows. Siblings keep their current order.
+
+        If ``tree_id`` is given only the nodes of that tree are rebuilt;
+        nodes whose parent is not in the tree are moved to new trees.
+        Nodes that cannot be reached from a root, e.g. because of a cycle
+        in the parents, get ``tree_id`` 0.
+
+        With the closure storage, the closure rows of the nodes are written
+        again as well.
         """
         opts = self.model._meta
+        self._write_batch()
+        if tree_id is None:
+            self.lock_forest()
+        else:
+            self.lock_trees(tree_id)
+
+        where, params = '', []
+        if tree_id is not None:
+            where, params = 'WHERE tree_id = %s', [tree_id]
 
         cursor = connection.cursor()
-        cursor.execute('UPDATE %(table)s SET lft = 0, rgt = 0, depth = 1, tree_id = 0' % {
+        parent_col = 'parent_id'
+        if self.model._easytree_meta.parent_field:
+            parent_col = opts.get_field(self.model._easytree_meta.parent_field).column
+        cursor.execute('SELECT %(id_col)s, %(parent_col)s FROM %(table)s %(where)s ORDER BY tree_id, lft, %(id_col)s' % {
+            'id_col': qn(opts.pk.column),
+            'parent_col': qn(parent_col),
             'table': qn(opts.db_table),
-        })
+            'where': where,
+        }, params)
+
+        pks = []
+        parents = {}
+        children = {}
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            for pk, parent_id in rows:
+                pks.append(pk)
+                parents[pk] = parent_id
+                children.setdefault(parent_id, []).append(pk)
+            rows = cursor.fetchmany(batch_size)
+
+        roots = [pk for pk in pks if parents[pk] not in parents]
+        tree_id_spacing = self.model._easytree_meta.tree_id_spacing
+        if tree_id is None:
+            tree_ids = range(tree_id_spacing, (len(roots) + 1) * tree_id_spacing, tree_id_spacing)
+        else:
+            tree_ids = [tree_id] + self._lock_new_trees(len(roots) - 1, after=tree_id)
 
-        cursor.execute('SELECT %(id_col)s FROM %(table)s WHERE parent_id is NULL' % {
-            'id_col': qn(opts.pk.column),
+        get_children = lambda pk: children.get(pk, [])
+        closure = get_closure(self)
+        if closure is not None:
+            values = closure.rebuild(pks, get_children, zip(roots, tree_ids), batch_size)
+        else:
+            spacing = self.model._easytree_meta.spacing
+            values = []
+            reached = set()
+            for root, root_tree_id in zip(roots, tree_ids):
+                for pk, left, right, level, parent in utils.number_tree([root], get_children, spacing=spacing):
+                    values.append((left, right, level, root_tree_id, pk))
+                    reached.add(pk)
+            for pk in pks:
+                if pk not in reached:
+                    values.append((0, 0, 1, 0, pk))
+
+        sql = 'UPDATE %(table)s SET lft = %%s, rgt = %%s, depth = %%s, tree_id = %%s WHERE %(pk_col)s = %%s' % {
             'table': qn(opts.db_table),
-        })
+            'pk_col': qn(opts.pk.column),
+        }
+        for start in range(0, len(values), batch_size):
+            cursor.executemany(sql, values[start:start+batch_size])
 
-        idx = 0
-        for (pk, ) in cursor.fetchall():
-            idx += 1
-            self._rebuild_helper(pk, 1, idx)
+        if self.model._easytree_meta.path_field:
+            if tree_id is None:
+                self.rebuild_paths()
+            else:
+                for rebuilt_tree_id in tree_ids:
+                    self.rebuild_paths(tree_id=rebuilt_tree_id)
         transaction.commit_unless_managed()
+        self._flush_cache()
 
-    def _rebuild_helper(self, pk, left, tree_id, level=1):
-        opts = self.model._meta
-        right = left + 1
-
+    def check(self):
+        """
+        Checks the nested set values of all the trees with a single query,
+        without loading the nodes. The problems reported per tree are:
+
+        - ``'interval'``: nodes with ``rgt <= lft``.
+        - ``'root'``: no node with ``lft = 1``, or not exactly one node with
+          ``depth = 1``.
+        - ``'duplicate'``: ``lft`` and ``rgt`` values used more than once.
+        - ``'gap'``: unused values, on dense trees (``spacing = 1``).
+        - ``'nesting'``: overlapping intervals, or depths not matching the
+          number of ancestors, found by walking the ``lft`` and ``rgt``
+          values of each tree in order with a window function.
+
+        With the closure storage, the ``lft`` of a node is its position
+        among its siblings and the problems are:
+
+        - ``'interval'``: nodes with ``rgt <> lft + 1``.
+        - ``'root'``: not exactly one root node (no parent, ``lft = 1`` and
+          ``depth = 1``), or positions not matching the presence of a
+          parent.
+        - ``'duplicate'``: siblings at the same position.
+        - ``'nesting'``: ``tree_id`` or ``depth`` not matching the parent.
+        - ``'closure'``: missing or extra closure rows.
+
+        :returns: A dictionary of the damaged tree ids and the sorted list
+            of their problems, empty if all the trees are valid.
+        """
+        cls = self.get_first_model()
+        table = qn(cls._meta.db_table)
+        events = '(SELECT tree_id, depth, lft AS value, 1 AS kind FROM %(table)s ' \
+                 ' UNION ALL SELECT tree_id, depth, rgt, 0 FROM %(table)s)' % {'table': table}
+        checks = [
+            "SELECT tree_id, 'interval' AS problem FROM %(table)s WHERE rgt <= lft",
+            "SELECT tree_id, 'root' AS problem FROM %(table)s GROUP BY tree_id "
+            " HAVING MIN(lft) <> 1 OR SUM(CASE WHEN depth = 1 THEN 1 ELSE 0 END) <> 1",
+            "SELECT tree_id, 'duplicate' AS problem FROM %(events)s duplicates "
+            " GROUP BY tree_id, value HAVING COUNT(*) > 1",
+            # the running count of open intervals is the depth of every
+            # node at its lft, and one less right after its rgt; duplicate
+            # values are ordered closing first so the result is stable
+            "SELECT tree_id, 'nesting' AS problem FROM "
+            " (SELECT tree_id, depth, kind, SUM(2 * kind - 1) OVER "
+            "   (PARTITION BY tree_id ORDER BY value, kind ROWS UNBOUNDED PRECEDING) AS level "
+            "  FROM %(events)s events) levels "
+            " WHERE level <> depth - 1 + kind",
+        ]
+        if self.model._easytree_meta.spacing == 1:
+            checks.append("SELECT tree_id, 'gap' AS problem FROM %(table)s GROUP BY tree_id "
+                " HAVING MAX(rgt) <> 2 * COUNT(*)")
+        sql = ' UNION ALL '.join(checks) % {'table': table, 'events': events}
+        closure = get_closure(self)
+        if closure is not None:
+            sql = closure.get_check_sql()
         cursor = connection.cursor()
-        cursor.execute('SELECT %(id_col)s FROM %(table)s WHERE parent_id = %(parent)d' % {
-            'id_col': qn(opts.pk.column),
-            'table': qn(opts.db_table),
-            'parent': pk,
-        })
-
-        for (child_id, ) in cursor.fetchall():
-            right = self._rebuild_helper(child_id, right, tree_id, level+1)
-
-        cursor.execute("""
-            UPDATE %(table)s
-            SET
-                %(left_col)s = %(left)d,
-                %(right_col)s = %(right)d,
-                %(level_col)s = %(level)d,
-                %(tree_id_col)s = %(tree_id)d
-            WHERE
-                %(pk_col)s = %(pk)s
-        """ % {
-            'table': qn(opts.db_table),
-            'pk_col': qn(opts.pk.column),
-            'left_col': "lft",
-            'right_col': "rgt",
-            'level_col': "depth",
-            'tree_id_col': "tree_id",
-            'pk': pk,
-            'left': left,
-            'right': right,
-            'level': level,
-            'tree_id': tree_id
-        })
-
-        return right + 1
\ No newline at end of file
+        cursor.execute('SELECT DISTINCT tree_id, problem FROM (%s) problems' % sql)
+        damaged = {}
+        for tree_id, problem in cursor.fetchall():
+            damaged.setdefault(tree_id, []).append(problem)
+        for problems in damaged.values():
+            problems.sort()
+        return damaged
\ No newline at end of file
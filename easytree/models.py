@@ -1,5 +1,6 @@
 from django.db import models
 from django.db.models.base import ModelBase
+from easytree.closure import get_closure
 import logging
 
 class EasyTreeOptions(object):
@@ -12,6 +13,19 @@ class EasyTreeOptions(object):
     validators = []
     max_depth = 0
     raw_relative_to = False
+    path_field = None
+    path_source = None
+    path_sep = '/'
+    path_include_root = True
+    single_statement_move = False
+    spacing = 1
+    tree_id_spacing = 1
+    parent_field = None
+    closure_model = None
+    version_model = None
+    lock_retries = 3
+    cache_backend = None
+    cache_timeout = 300
 
     def __init__(self, opts):
         if opts:       
@@ -48,40 +62,105 @@ class BaseEasyTree(models.Model):
     def make_materialized_path(self, field, sep, include_root):
         """
         Helper to make a materialized path to this node.
+
+        Returns the stored path if the arguments match the ``path_field``
+        options in EasyTreeMeta.
         """
-        parents = self.__class__.objects.get_ancestors_for(self)
+        opts = self._easytree_meta
+        if opts.path_field and (opts.path_source, opts.path_sep, opts.path_include_root) == \
+              (field, sep, include_root):
+            return getattr(self, opts.path_field)
+        parents = self.ancestors()
         return sep.join([getattr(parent, field) for parent in list(parents) + [self] \
             if not self.__class__.objects.is_root(parent) or include_root] )
     
+    def _cached_queryset(self, nodes):
+        """
+        :returns: a queryset of nodes cached by ``get_cached_tree`` or
+            ``prefetch_children``, already evaluated: iterating it doesn't hit
+            the database, filtering it runs a query on the same nodes.
+        """
+        manager = self.__class__.objects
+        queryset = manager.filter(pk__in=[node.pk for node in nodes])
+        closure = get_closure(manager)
+        if closure is not None:
+            queryset = closure.order_dfs(queryset)
+        else:
+            queryset = queryset.order_by('tree_id', 'lft')
+        queryset._result_cache = list(nodes)
+        return queryset
+
+    def _cached_descendants(self):
+        descendants = []
+        for child in self._cached_children:
+            descendants.append(child)
+            descendants.extend(child._cached_descendants())
+        return descendants
+
     def tree(self):
         """ Returns a queryset of this node and all decendants """
+        if hasattr(self, '_cached_children'):
+            return self._cached_queryset([self] + self._cached_descendants())
         return self.__class__.objects.get_tree(parent=self)
     
     def descendants(self):
         """ Returns all decendants of this node """
+        if hasattr(self, '_cached_children'):
+            return self._cached_queryset(self._cached_descendants())
         return self.__class__.objects.get_descendants_for(self)
     
     def children(self):
         """ Returns the children of this node """
-        return self.__class__.objects.get_children_for(self)
+        try:
+            return self._cached_queryset(self._cached_children)
+        except AttributeError:
+            return self.__class__.objects.get_children_for(self)
     
     def siblings(self):
         """
         Returns the siblings of this node, including this node.
         """
-        return self.__class__.objects.get_siblings_for(self)
+        try:
+            return self._cached_queryset(self._cached_siblings)
+        except AttributeError:
+            pass
+        try:
+            return self._cached_queryset(self._cached_parent_obj._cached_children)
+        except AttributeError:
+            return self.__class__.objects.get_siblings_for(self)
         
     def ancestors(self):
         """ Returns all ancestors of this node """
-        return self.__class__.objects.get_ancestors_for(self)
+        try:
+            return self._cached_queryset(self._cached_ancestors)
+        except AttributeError:
+            return self.__class__.objects.get_ancestors_for(self)
     
     def is_root(self):
         """ Returns True if this is a root node """
+        if hasattr(self, '_cached_ancestors'):
+            return not self._cached_ancestors
         return self.__class__.objects.is_root(self)
     
     def is_leaf(self):
         """ Returns True if this is a leaf node """
         return self.__class__.objects.is_leaf(self)
+
+    def is_descendant_of(self, node):
+        """ Returns True if this node is a descendant of the given node """
+        return self.__class__.objects.is_descendant_of(self, node)
+
+    def is_ancestor_of(self, node):
+        """ Returns True if this node is an ancestor of the given node """
+        return self.__class__.objects.is_ancestor_of(self, node)
+
+    def is_sibling_of(self, node):
+        """ Returns True if this node is a sibling of the given node """
+        return self.__class__.objects.is_sibling_of(self, node)
+
+    def get_descendant_count(self):
+        """ Returns the number of descendants of this node """
+        return self.__class__.objects.get_descendant_count(self)
     
     class Meta:
         abstract = True
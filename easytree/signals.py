@@ -1,3 +1,19 @@
 from django import dispatch
+from django.dispatch.dispatcher import _make_id
 
 node_moved = dispatch.Signal(providing_args=["node_moved", "moved_to_node", "relative_position"])
+
+# sent before the statements moving a node run, with dicts of the
+# ``tree_id``, ``lft``, ``rgt`` and ``depth`` of the node before and after
+node_pre_move = dispatch.Signal(providing_args=["node", "relative_to", "relative_position",
+                                                "old_values", "new_values"])
+
+# sent after a structural operation with an easytree.instrumentation.Operation
+tree_operation = dispatch.Signal(providing_args=["operation"])
+
+def has_receivers(signal, sender):
+    """
+    :returns: ``True`` if a receiver is connected to the signal for the
+        sender, so that callers can skip building its arguments.
+    """
+    return bool(signal.receivers) and bool(signal._live_receivers(_make_id(sender)))
@@ -5,9 +5,10 @@ import itertools, copy
 
 register = Library()
 
-def results(cl):
+def results(cl, objects=None):
     
-    objects = cl.model.objects.filter(pk__in=[o.pk for o in cl.result_list]).order_by('tree_id', 'lft')
+    if objects is None:
+        objects = cl.model.objects.filter(pk__in=[o.pk for o in cl.result_list]).order_by('tree_id', 'lft')
         
     if cl.formset:
         pk_forms = dict([(form.instance.pk, form) for form in cl.formset.forms])
@@ -25,6 +26,21 @@ def result_list(cl):
             
 result_list = register.inclusion_tag("admin/easytree_change_list_results.html")(result_list)
 
+def lazy_result_list(cl):
+    """
+    The rows of the lazy changelist, taken from the page of the changelist
+    as they are, with the number of descendants of each node.
+    """
+    rows = list(results(cl, cl.result_list))
+    for row in rows:
+        row['descendant_count'] = cl.model_admin.get_descendant_count(row['object'])
+        row['is_leaf'] = cl.model_admin.is_leaf(row['object'])
+    return {'cl': cl,
+            'result_headers': list(result_headers(cl)),
+            'results': rows}
+
+lazy_result_list = register.inclusion_tag("admin/easytree_lazy_change_list_results.html")(lazy_result_list)
+
 def previous_current_next(items):
     """
     From http://www.wordaligned.org/articles/zippy-triples-served-with-python
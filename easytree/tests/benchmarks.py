@@ -0,0 +1,407 @@
+"""
+Benchmarks for tree operations, run against the easytree test models.
+
+Usage::
+
+    DJANGO_SETTINGS_MODULE=easytree.tests.settings python -m easytree.tests.benchmarks
+
+A test database is created and destroyed; every benchmark runs inside a
+transaction that is rolled back.
+
+The comparisons of the move engines, the spacing and the storages are
+printed by default. With ``--suite``, every operation is measured instead on
+deep, wide and random trees of the given sizes, and the results can be
+written as JSON to compare two commits::
+
+    python -m easytree.tests.benchmarks --suite --sizes 100,1000 --json before.json
+    python -m easytree.tests.benchmarks --suite --sizes 100,1000 --json after.json
+    python -m easytree.tests.benchmarks --compare before.json after.json
+
+Use settings with ``DATABASE_ENGINE = 'sqlite3'`` or ``'postgresql_psycopg2'``
+to measure either backend.
+"""
+from django.conf import settings
+from django.db import connection, transaction, reset_queries
+from django.utils import simplejson
+from easytree.tests.models import TestNode, SparseTestNode, SortedTestNode, LinkedTestNode, \
+    ClosureTestNode, ClosureTestNodeClosure
+import optparse
+import random
+import sys
+import time
+
+def rows_written(*models):
+    """
+    :returns: the number of rows of the models' tables inserted, updated or
+        deleted so far in the current transaction (PostgreSQL) or
+        connection (SQLite, all tables).
+    """
+    cursor = connection.cursor()
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        return connection.connection.total_changes
+    cursor.execute('SELECT SUM(n_tup_ins + n_tup_upd + n_tup_del) '
+        ' FROM pg_stat_xact_user_tables WHERE relname IN (%s)' % ', '.join(['%s'] * len(models)),
+        [model._meta.db_table for model in models])
+    return int(cursor.fetchone()[0] or 0)
+
+def make_tree(model, fanout, depth):
+    """
+    Loads a tree with ``fanout`` children per node and ``depth`` levels.
+
+    :returns: the number of nodes.
+    """
+    counter = [0]
+    def entry(level):
+        counter[0] += 1
+        children = []
+        if level < depth:
+            children = [entry(level + 1) for i in range(fanout)]
+        return {'data': {'title': 'node %d' % counter[0]}, 'children': children}
+    if model._easytree_meta.closure_model:
+        # the closure storage can not bulk load, save the nodes one by one
+        def save(data, parent=None):
+            node = model(**data['data'])
+            if parent is not None:
+                node.easytree_relative_to = parent
+                node.easytree_relative_position = 'last-child'
+            node.save()
+            for child in data['children']:
+                save(child, model.objects.get(pk=node.pk))
+        save(entry(1))
+        return counter[0]
+    return model.objects.bulk_load([entry(1)])
+
+def measure(model, func, *args, **kwargs):
+    """
+    :returns: the wall time and the rows written by ``func``.
+    """
+    rows = rows_written(model)
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start, rows_written(model) - rows
+
+def bench_move(fanout=10, depth=4):
+    """
+    Compares the single statement move with moving subtrees to a hole,
+    swapping two children of the root and moving the first child of the
+    root across the tree and back.
+    """
+    results = []
+    for single_statement_move in (False, True):
+        TestNode._easytree_meta.single_statement_move = single_statement_move
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            size = make_tree(TestNode, fanout, depth)
+            children = list(TestNode.objects.filter(depth=2).order_by('lft'))
+            first, last = children[0], children[-1]
+            second, third = children[1], children[2]
+            moves = [
+                ('second child to third', second, third, 'right'),
+                ('first child to last', first, last, 'right'),
+                ('back to first', first, last, 'first-sibling'),
+                ('first child under last', first, last, 'last-child'),
+            ]
+            for name, target, dest, pos in moves:
+                target = TestNode.objects.get(pk=target.pk)
+                dest = TestNode.objects.get(pk=dest.pk)
+                seconds, rows = measure(TestNode, TestNode.objects.move, target, dest, pos)
+                results.append((size, name, single_statement_move, seconds, rows))
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            TestNode._easytree_meta.single_statement_move = False
+    return results
+
+def bench_insert(fanout=10, depth=4, inserts=100, spacings=(1, 4, 16)):
+    """
+    Measures the rows written per insert of a node as the first child,
+    the last child or the left sibling of random nodes, with dense and
+    sparse numbering.
+    """
+    results = []
+    for spacing in spacings:
+        SparseTestNode._easytree_meta.spacing = spacing
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            size = make_tree(SparseTestNode, fanout, depth)
+            pks = list(SparseTestNode.objects.values_list('pk', flat=True))
+            rnd = random.Random(0)
+            seconds, rows = 0, 0
+            for i in range(inserts):
+                node = SparseTestNode(title='new %d' % i)
+                node.easytree_relative_to = SparseTestNode.objects.get(pk=rnd.choice(pks))
+                node.easytree_relative_position = rnd.choice(['first-child', 'last-child', 'left'])
+                if node.easytree_relative_to.lft == 1 and node.easytree_relative_position == 'left':
+                    node.easytree_relative_position = 'first-child'
+                insert_seconds, insert_rows = measure(SparseTestNode, node.save)
+                seconds += insert_seconds
+                rows += insert_rows
+            results.append((size, spacing, seconds / inserts, float(rows) / inserts))
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            SparseTestNode._easytree_meta.spacing = 4
+    return results
+
+def bench_storage(fanout=10, depth=3):
+    """
+    Compares nested sets with the closure table storage, moving leaves and
+    children of the root of a tree. The rows written include the rows of
+    the closure table.
+    """
+    results = []
+    for model, tables in ((LinkedTestNode, (LinkedTestNode,)),
+                          (ClosureTestNode, (ClosureTestNode, ClosureTestNodeClosure))):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            size = make_tree(model, fanout, depth)
+            children = list(model.objects.filter(depth=2).order_by('pk'))
+            first, last = children[0], children[-1]
+            leaf = model.objects.filter(depth=depth).order_by('pk')[0]
+            moves = [
+                ('first child to last', first, last, 'right'),
+                ('first child under last', first, last, 'last-child'),
+                ('leaf to last child', leaf, last, 'last-child'),
+            ]
+            for name, target, dest, pos in moves:
+                target = model.objects.get(pk=target.pk)
+                dest = model.objects.get(pk=dest.pk)
+                rows = rows_written(*tables)
+                start = time.time()
+                model.objects.move(target, dest, pos)
+                results.append((size, name, model._easytree_meta.closure_model and 'closure' or 'nested',
+                    time.time() - start, rows_written(*tables) - rows))
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+    return results
+
+SHAPES = ('deep', 'wide', 'random')
+
+def make_entries(shape, size, seed=0):
+    """
+    :returns: the ``bulk_load`` data of a tree of ``size`` nodes titled
+        ``'node <n>'``. ``'deep'`` trees are a chain with three leaves
+        hanging from every node, ``'wide'`` trees a root with ``size - 1``
+        children, and in ``'random'`` trees every node is a child of a
+        random earlier node.
+    """
+    rnd = random.Random(seed)
+    entries = []
+    for i in range(size):
+        entry = {'data': {'title': 'node %d' % i}, 'children': []}
+        if i:
+            if shape == 'deep':
+                parent = entries[(i - 1) / 4 * 4]
+            elif shape == 'wide':
+                parent = entries[0]
+            else:
+                parent = entries[rnd.randrange(i)]
+            parent['children'].append(entry)
+        entries.append(entry)
+    return entries[:1]
+
+def pick(model, rnd, exclude=None, **filters):
+    """
+    :returns: a random node of the model, outside of the subtree of
+        ``exclude``.
+    """
+    nodes = model.objects.filter(**filters).order_by('pk')
+    if exclude is not None:
+        nodes = nodes.exclude(tree_id=exclude.tree_id, lft__gte=exclude.lft, lft__lte=exclude.rgt)
+    return rnd.choice(list(nodes))
+
+def add(model, pos):
+    def prepare(rnd):
+        node = model(title='new node')
+        if pos is not None:
+            node.easytree_relative_to = pick(model, rnd, depth__gt=1)
+            node.easytree_relative_position = pos
+        return node.save
+    return prepare
+
+def move(model, pos):
+    def prepare(rnd):
+        target = pick(model, rnd, depth__gt=1)
+        dest = pick(model, rnd, exclude=target)
+        return lambda: model.objects.move(target, dest, pos)
+    return prepare
+
+def delete(model):
+    def prepare(rnd):
+        target = pick(model, rnd, depth__gt=1)
+        return model.objects.filter(pk=target.pk).delete
+    return prepare
+
+def read(model, method):
+    def prepare(rnd):
+        node = pick(model, rnd, depth__gt=1)
+        func = getattr(model.objects, method)
+        def run():
+            result = func(node)
+            if hasattr(result, '__iter__'):
+                list(result)
+        return run
+    return prepare
+
+def get_operations():
+    """
+    :returns: the ``(operation, position, model, prepare)`` measured by the
+        suite. ``prepare`` picks the nodes involved and returns the function
+        measured.
+    """
+    operations = [('add_root', None, TestNode, add(TestNode, None))]
+    for pos in ('first-child', 'last-child'):
+        operations.append(('add_child_to', pos, TestNode, add(TestNode, pos)))
+    for pos in ('first-sibling', 'left', 'right', 'last-sibling'):
+        operations.append(('add_sibling_to', pos, TestNode, add(TestNode, pos)))
+    operations.append(('add_child_to', 'sorted-child', SortedTestNode,
+        add(SortedTestNode, 'sorted-child')))
+    operations.append(('add_sibling_to', 'sorted-sibling', SortedTestNode,
+        add(SortedTestNode, 'sorted-sibling')))
+    for pos in ('first-sibling', 'left', 'right', 'last-sibling', 'first-child', 'last-child'):
+        operations.append(('move', pos, TestNode, move(TestNode, pos)))
+    for pos in ('sorted-sibling', 'sorted-child'):
+        operations.append(('move', pos, SortedTestNode, move(SortedTestNode, pos)))
+    operations.append(('delete', None, TestNode, delete(TestNode)))
+    operations.append(('rebuild', None, LinkedTestNode,
+        lambda rnd: LinkedTestNode.objects.rebuild))
+    operations.append(('get_tree', None, TestNode,
+        lambda rnd: lambda: list(TestNode.objects.get_tree())))
+    operations.append(('get_cached_tree', None, TestNode,
+        lambda rnd: TestNode.objects.get_cached_tree))
+    for method in ('get_tree', 'get_descendants_for', 'get_descendant_count',
+                   'get_ancestors_for', 'get_children_for', 'get_siblings_for',
+                   'get_parent_for', 'get_root', 'is_leaf', 'get_cached_tree'):
+        operations.append((method, 'node', TestNode, read(TestNode, method)))
+    return operations
+
+def bench_suite(sizes=(100, 1000), shapes=SHAPES, repeat=3):
+    """
+    Measures every operation on a fresh tree of each shape and size,
+    ``repeat`` times on the same nodes.
+
+    :returns: a list of dictionaries with the ``shape``, ``size``,
+        ``operation``, ``position`` and ``model``, the best ``seconds`` and
+        the number of ``queries`` and of ``rows`` written.
+    """
+    results = []
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    try:
+        for shape in shapes:
+            for size in sizes:
+                entries = make_entries(shape, size)
+                for operation, position, model, prepare in get_operations():
+                    seconds = []
+                    for i in range(repeat):
+                        transaction.enter_transaction_management()
+                        transaction.managed(True)
+                        try:
+                            model.objects.bulk_load(entries)
+                            func = prepare(random.Random('%s %s' % (operation, position)))
+                            rows = rows_written(model)
+                            reset_queries()
+                            start = time.time()
+                            func()
+                            seconds.append(time.time() - start)
+                            queries = len(connection.queries)
+                            rows = rows_written(model) - rows
+                        finally:
+                            transaction.rollback()
+                            transaction.leave_transaction_management()
+                    results.append({'shape': shape, 'size': size, 'operation': operation,
+                        'position': position, 'model': model.__name__,
+                        'seconds': min(seconds), 'queries': queries, 'rows': rows})
+    finally:
+        settings.DEBUG = debug
+        reset_queries()
+    return results
+
+def result_key(result):
+    return (result['shape'], result['size'], result['operation'], result['position'])
+
+def print_suite(results):
+    print '%-7s %6s  %-22s %-15s %10s %8s %8s' % ('shape', 'nodes', 'operation', 'position',
+        'seconds', 'queries', 'rows')
+    for result in results:
+        print '%-7s %6d  %-22s %-15s %10.4f %8d %8d' % (result['shape'], result['size'],
+            result['operation'], result['position'] or '', result['seconds'],
+            result['queries'], result['rows'])
+
+def compare(old, new):
+    """
+    Prints the ratio of the times and the differences of the numbers of
+    queries and rows between two runs of the suite saved as JSON.
+    """
+    old_results = dict([(result_key(result), result) for result in old['results']])
+    print '%s (%s) -> %s (%s)' % (old['label'], old['engine'], new['label'], new['engine'])
+    print '%-7s %6s  %-22s %-15s %10s %8s %8s' % ('shape', 'nodes', 'operation', 'position',
+        'time', 'queries', 'rows')
+    for result in new['results']:
+        before = old_results.get(result_key(result))
+        if before is None:
+            continue
+        print '%-7s %6d  %-22s %-15s %9.2fx %+8d %+8d' % (result['shape'], result['size'],
+            result['operation'], result['position'] or '',
+            result['seconds'] / max(before['seconds'], 1e-6),
+            result['queries'] - before['queries'], result['rows'] - before['rows'])
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [--suite [options]] | --compare OLD NEW')
+    parser.add_option('--suite', action='store_true',
+        help='measure every operation instead of the comparisons')
+    parser.add_option('--sizes', default='100,1000', help='comma separated tree sizes')
+    parser.add_option('--shapes', default=','.join(SHAPES), help='comma separated tree shapes')
+    parser.add_option('--repeat', type='int', default=3, help='runs per operation')
+    parser.add_option('--json', metavar='FILE', help='write the results of the suite to FILE')
+    parser.add_option('--label', default='', help='label stored with the results')
+    parser.add_option('--compare', action='store_true',
+        help='compare two JSON files of results')
+    options, args = parser.parse_args(argv)
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error('--compare needs two files')
+        compare(simplejson.load(open(args[0])), simplejson.load(open(args[1])))
+        return
+
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    setup_test_environment()
+    old_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        if options.suite:
+            results = bench_suite([int(size) for size in options.sizes.split(',')],
+                options.shapes.split(','), options.repeat)
+            print_suite(results)
+            if options.json:
+                output = open(options.json, 'w')
+                try:
+                    simplejson.dump({'label': options.label or options.json,
+                        'engine': settings.DATABASE_ENGINE, 'results': results},
+                        output, indent=1, sort_keys=True)
+                finally:
+                    output.close()
+            return
+        print '%8s  %-24s %-12s %10s %8s' % ('nodes', 'move', 'engine', 'seconds', 'rows')
+        for size, name, single_statement_move, seconds, rows in bench_move():
+            engine = single_statement_move and 'single' or 'hole'
+            print '%8d  %-24s %-12s %10.4f %8d' % (size, name, engine, seconds, rows)
+        print
+        print '%8s  %-8s %16s %16s' % ('nodes', 'spacing', 'seconds/insert', 'rows/insert')
+        for size, spacing, seconds, rows in bench_insert():
+            print '%8d  %-8d %16.4f %16.1f' % (size, spacing, seconds, rows)
+        print
+        print '%8s  %-24s %-12s %10s %8s' % ('nodes', 'move', 'storage', 'seconds', 'rows')
+        for size, name, storage, seconds, rows in bench_storage():
+            print '%8d  %-24s %-12s %10.4f %8d' % (size, name, storage, seconds, rows)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
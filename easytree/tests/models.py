@@ -15,3 +15,132 @@ class TestNode(BaseEasyTree):
 
     def __unicode__(self):
         return self.title
+
+class PlainTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+
+    objects = EasyTreeManager()
+
+class InheritedTestNode(PlainTestNode):
+
+    genre = models.CharField(max_length=60)
+
+    objects = EasyTreeManager()
+
+class PathTestNode(BaseEasyTree):
+
+    slug = models.CharField(max_length=60)
+    path = models.CharField(max_length=255, db_index=True, editable=False)
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    class EasyTreeMeta:
+        path_field = 'path'
+        path_source = 'slug'
+
+    def __unicode__(self):
+        return self.slug
+
+class ParentTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='child_nodes')
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    def __unicode__(self):
+        return self.title
+
+class SparseTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    class EasyTreeMeta:
+        spacing = 4
+
+    def __unicode__(self):
+        return self.title
+
+class GappedTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    class EasyTreeMeta:
+        tree_id_spacing = 16
+
+class SortedTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    class EasyTreeMeta:
+        node_order_by = ['title']
+
+class LinkedTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='child_nodes')
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    class EasyTreeMeta:
+        parent_field = 'parent'
+
+    def __unicode__(self):
+        return self.title
+
+class ClosureTestNode(BaseEasyTree):
+
+    title = models.CharField(max_length=60)
+    path = models.CharField(max_length=255, editable=False)
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='child_nodes')
+
+    objects = EasyTreeManager()
+
+    class Meta:
+        ordering=('tree_id', 'lft')
+
+    class EasyTreeMeta:
+        parent_field = 'parent'
+        closure_model = 'ClosureTestNodeClosure'
+        path_field = 'path'
+        path_source = 'title'
+
+    def __unicode__(self):
+        return self.title
+
+class ClosureTestNodeClosure(models.Model):
+
+    ancestor = models.ForeignKey(ClosureTestNode, related_name='descendant_links')
+    descendant = models.ForeignKey(ClosureTestNode, related_name='ancestor_links')
+    distance = models.PositiveIntegerField()
+
+class TestNodeVersion(models.Model):
+
+    tree_id = models.PositiveIntegerField(unique=True)
+    version = models.PositiveIntegerField()
+    modified = models.DateTimeField()
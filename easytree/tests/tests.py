@@ -1,13 +1,40 @@
+from __future__ import with_statement
 from datetime import datetime
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import F
+from django.contrib.admin.sites import AdminSite
+from django.http import HttpRequest, HttpResponse, QueryDict
+from django.utils import simplejson
+from easytree.admin import EasyTreeAdmin, EasyTreeChangeList
+from easytree.forms import BaseEasyTreeForm, EasyTreeAutocompleteWidget
+from easytree.exceptions import EasyTreeException, InvalidMoveToDescendant, InvalidPosition, \
+    SingleRootAllowed
+from django.test import TestCase, TransactionTestCase
+from easytree.tests.benchmarks import rows_written, bench_suite, get_operations, make_entries
+from easytree.cache import get_tree_cache
+from easytree.instrumentation import Collector
+from easytree.signals import node_moved, node_pre_move
+from easytree.validators import SingleRootAllowedValidator
+from StringIO import StringIO
+from easytree.tests.models import TestNode, PathTestNode, ParentTestNode, SparseTestNode, \
+    GappedTestNode, SortedTestNode, LinkedTestNode, ClosureTestNode, ClosureTestNodeClosure, \
+    TestNodeVersion, PlainTestNode, InheritedTestNode
+from easytree.versions import get_versions, condition_on_tree, FOREST
 import doctest
 import os
+import random
 import shutil
+import sys
 import time
+import traceback
 import unittest
 
+qn = connection.ops.quote_name
+
 class EasyTreeManagerTestCase(TestCase):
     """
     Unit test for EasyTreeManager
@@ -21,8 +48,1839 @@ class EasyTreeManagerTestCase(TestCase):
     def tearDown(self):
         pass
 
+class EasyTreeTestMixin(object):
+    """
+    Helpers for tests working on the tree built by the doctest::
+
+        action
+        +-- platformer
+        |   |-- platformer_2d
+        |   |-- platformer_3d
+        |   +-- platformer_4d
+        +-- shmup
+            |-- shmup_vertical
+            +-- shmup_horizontal
+        rpg
+        |-- arpg
+        +-- trpg
+    """
+    def _post_teardown(self):
+        super(EasyTreeTestMixin, self)._post_teardown()
+        # the doctest relies on primary keys starting from 1
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [TestNode]):
+            cursor.execute(sql)
+
+    def add_node(self, title, relative_to=None, pos=None, model=TestNode):
+        node = model(title=title)
+        if relative_to:
+            node.easytree_relative_to = model.objects.get(pk=relative_to.pk)
+            node.easytree_relative_position = pos
+        node.save()
+        return model.objects.get(pk=node.pk)
+
+    def build_tree(self, model=TestNode):
+        action = self.add_node('action', model=model)
+        platformer = self.add_node('platformer', action, 'last-child', model)
+        for title in ('platformer_2d', 'platformer_3d', 'platformer_4d'):
+            self.add_node(title, platformer, 'last-child', model)
+        shmup = self.add_node('shmup', action, 'last-child', model)
+        for title in ('shmup_vertical', 'shmup_horizontal'):
+            self.add_node(title, shmup, 'last-child', model)
+        rpg = self.add_node('rpg', model=model)
+        for title in ('arpg', 'trpg'):
+            self.add_node(title, rpg, 'last-child', model)
+
+    def node(self, title, model=TestNode):
+        return model.objects.get(title=title)
+
+    def titles(self, nodes):
+        return [node.title for node in nodes]
+
+    def snapshot(self, model=TestNode):
+        return [(node.title, node.tree_id, node.lft, node.rgt, node.depth)
+            for node in model.objects.order_by('tree_id', 'lft')]
+
+    def structure(self, model):
+        # trees may leave gaps between their ids, compare their order
+        nodes = list(model.objects.order_by('tree_id', 'lft'))
+        tree_ids = sorted(set([node.tree_id for node in nodes]))
+        return [(node.title, tree_ids.index(node.tree_id), node.depth) for node in nodes]
+
+    def assertValidTree(self, model=TestNode):
+        """
+        Checks the nested set numbering of every tree against the structure
+        defined by the depth of the nodes. Sparse trees may have gaps but
+        their leaves must be tight.
+        """
+        nodes = list(model.objects.order_by('tree_id', 'lft'))
+        trees = {}
+        for node in nodes:
+            trees.setdefault(node.tree_id, []).append(node)
+        for tree_id, tree in trees.items():
+            values = sorted([node.lft for node in tree] + [node.rgt for node in tree])
+            if model._easytree_meta.spacing == 1:
+                self.assertEqual(values, range(1, len(values) + 1))
+            else:
+                self.assertEqual(values[0], 1)
+                self.assertEqual(len(set(values)), len(values))
+            stack = []
+            for i, node in enumerate(tree):
+                self.assertTrue(node.lft < node.rgt)
+                while stack and stack[-1].rgt < node.lft:
+                    stack.pop()
+                self.assertEqual(node.depth, len(stack) + 1)
+                if stack:
+                    self.assertTrue(node.rgt < stack[-1].rgt)
+                stack.append(node)
+                has_children = i + 1 < len(tree) and tree[i + 1].lft < node.rgt
+                self.assertEqual(node.rgt - node.lft == 1, not has_children)
+
+    def count_queries(self, func, *args, **kwargs):
+        """
+        :returns: the number of queries run by ``func`` and its result.
+        """
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        start = len(connection.queries)
+        try:
+            result = func(*args, **kwargs)
+            return len(connection.queries) - start, result
+        finally:
+            settings.DEBUG = debug
+
+class EasyTreeTestCase(EasyTreeTestMixin, TestCase):
+    pass
+
+class CachedTreeTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.get_cached_tree
+    """
+    def setUp(self):
+        self.build_tree()
+
+    def test_forest(self):
+        count, nodes = self.count_queries(TestNode.objects.get_cached_tree)
+        self.assertEqual(count, 1)
+        self.assertEqual(self.titles(nodes), self.titles(TestNode.objects.get_tree()))
+
+        def navigate():
+            action, rpg = nodes[0], nodes[-3]
+            platformer_3d = nodes[3]
+            self.assertEqual(self.titles(action.children()), ['platformer', 'shmup'])
+            self.assertEqual(self.titles(action.descendants()), self.titles(nodes[1:8]))
+            self.assertEqual(self.titles(platformer_3d.ancestors()), ['action', 'platformer'])
+            self.assertEqual(self.titles(platformer_3d.siblings()),
+                ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+            self.assertEqual(self.titles(rpg.siblings()), ['action', 'rpg'])
+            self.assertEqual(TestNode.objects.get_parent_for(platformer_3d).title, 'platformer')
+            self.assertTrue(action.is_root())
+            self.assertFalse(platformer_3d.is_root())
+            self.assertEqual(action.descendants().count(), 7)
+        self.assertEqual(self.count_queries(navigate)[0], 0)
+
+        # the cached results are querysets like the others
+        action = nodes[0]
+        for cached, uncached in ((action.children(), self.node('action').children()),
+                                 (action.tree(), self.node('action').tree())):
+            self.assertEqual(type(cached), type(uncached))
+            self.assertEqual(self.titles(cached.filter(depth=2)), self.titles(uncached.filter(depth=2)))
+
+    def test_subtree(self):
+        count, nodes = self.count_queries(TestNode.objects.get_cached_tree,
+            self.node('shmup'))
+        self.assertEqual(count, 1)
+        self.assertEqual(self.titles(nodes), ['shmup', 'shmup_vertical', 'shmup_horizontal'])
+
+        def navigate():
+            shmup, shmup_vertical = nodes[0], nodes[1]
+            self.assertEqual(self.titles(shmup.children()), ['shmup_vertical', 'shmup_horizontal'])
+            self.assertEqual(self.titles(shmup.ancestors()), ['action'])
+            self.assertEqual(self.titles(shmup_vertical.ancestors()), ['action', 'shmup'])
+            self.assertEqual(list(shmup_vertical.children()), [])
+        self.assertEqual(self.count_queries(navigate)[0], 0)
+
+        # the children of the ancestors are not cached
+        action = nodes[0].ancestors()[0]
+        self.assertEqual(self.titles(action.children()), ['platformer', 'shmup'])
+
+class PredicatesTestCase(EasyTreeTestCase):
+    """
+    Tests for the query-free structural predicates
+    """
+    def setUp(self):
+        self.build_tree()
+
+    def test_predicates(self):
+        action, platformer, shmup, platformer_2d, platformer_3d, rpg, arpg = [
+            self.node(title) for title in ('action', 'platformer', 'shmup',
+                'platformer_2d', 'platformer_3d', 'rpg', 'arpg')]
+
+        def check():
+            self.assertTrue(action.is_root())
+            self.assertFalse(platformer.is_root())
+            self.assertTrue(platformer_2d.is_leaf())
+            self.assertFalse(platformer.is_leaf())
+            self.assertEqual(action.get_descendant_count(), 7)
+            self.assertTrue(platformer_2d.is_descendant_of(action))
+            self.assertFalse(arpg.is_descendant_of(action))
+            self.assertTrue(action.is_ancestor_of(platformer_3d))
+            self.assertFalse(platformer_3d.is_ancestor_of(action))
+            self.assertTrue(action.is_sibling_of(rpg))
+            self.assertFalse(platformer.is_sibling_of(arpg))
+        self.assertEqual(self.count_queries(check)[0], 0)
+
+        self.assertTrue(platformer.is_sibling_of(shmup))
+        self.assertTrue(platformer_2d.is_sibling_of(platformer_3d))
+        self.assertFalse(platformer_2d.is_sibling_of(self.node('shmup_vertical')))
+
+    def test_query_counts(self):
+        """
+        Adding and moving nodes must not query for roots. Two of the
+        queries lock the tree and reload the nodes; moves without signal
+        receivers don't fetch the nodes again.
+        """
+        # PostgreSQL reads the id of the new row with another query
+        insert = settings.DATABASE_ENGINE.startswith('postgresql') and 2 or 1
+        node = TestNode(title='platformer_5d')
+        node.easytree_relative_to = self.node('platformer')
+        node.easytree_relative_position = 'last-child'
+        self.assertEqual(self.count_queries(node.save)[0], 4 + insert)
+
+        node = TestNode(title='platformer_3.5d')
+        node.easytree_relative_to = self.node('platformer_3d')
+        node.easytree_relative_position = 'right'
+        self.assertEqual(self.count_queries(node.save)[0], 5 + insert)
+
+        count = self.count_queries(TestNode.objects.move,
+            self.node('shmup_vertical'), self.node('platformer_2d'), 'left')[0]
+        self.assertEqual(count, 8)
+
+        TestNode._easytree_meta.single_statement_move = True
+        try:
+            count = self.count_queries(TestNode.objects.move,
+                self.node('shmup_vertical'), self.node('platformer'), 'left')[0]
+            self.assertEqual(count, 5)
+        finally:
+            TestNode._easytree_meta.single_statement_move = False
+
+        count = self.count_queries(TestNode.objects.move,
+            self.node('arpg'), self.node('platformer'), 'last-child')[0]
+        self.assertEqual(count, 8)
+
+class BulkAncestorsTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.get_ancestors_for_nodes and prefetch_ancestors
+    """
+    def setUp(self):
+        self.build_tree()
+
+    def test_get_ancestors_for_nodes(self):
+        nodes = [self.node(title) for title in
+            ('platformer_2d', 'shmup_horizontal', 'arpg', 'rpg', 'shmup')]
+        count, ancestors = self.count_queries(TestNode.objects.get_ancestors_for_nodes, nodes)
+        self.assertEqual(count, 1)
+        self.assertEqual([self.titles(ancestors[node]) for node in nodes], [
+            ['action', 'platformer'], ['action', 'shmup'], ['rpg'], [], ['action']])
+        for node in nodes:
+            self.assertEqual(ancestors[node], list(node.ancestors()))
+
+    def test_prefetch_ancestors(self):
+        def paths():
+            return [node.make_materialized_path('title', '/', True) for node in
+                TestNode.objects.filter(depth__gte=2).prefetch_ancestors()]
+        count, result = self.count_queries(paths)
+        self.assertEqual(count, 2)
+        self.assertEqual(result, [
+            'action/platformer', 'action/platformer/platformer_2d',
+            'action/platformer/platformer_3d', 'action/platformer/platformer_4d',
+            'action/shmup', 'action/shmup/shmup_vertical',
+            'action/shmup/shmup_horizontal', 'rpg/arpg', 'rpg/trpg'])
+
+class MaterializedPathTestCase(EasyTreeTestCase):
+    """
+    Tests for the path_field EasyTreeMeta option
+    """
+    def add_path_node(self, slug, relative_to=None, pos=None):
+        node = PathTestNode(slug=slug)
+        if relative_to:
+            node.easytree_relative_to = PathTestNode.objects.get(pk=relative_to.pk)
+            node.easytree_relative_position = pos
+        node.save()
+        return PathTestNode.objects.get(pk=node.pk)
+
+    def setUp(self):
+        news = self.add_path_node('news')
+        sports = self.add_path_node('sports', news, 'last-child')
+        self.add_path_node('football', sports, 'last-child')
+        self.add_path_node('tennis', sports, 'last-child')
+        self.add_path_node('politics', sports, 'left')
+        self.add_path_node('blog')
+
+    def paths(self):
+        return [node.path for node in PathTestNode.objects.all()]
+
+    def test_add(self):
+        self.assertEqual(self.paths(), ['news', 'news/politics', 'news/sports',
+            'news/sports/football', 'news/sports/tennis', 'blog'])
+        node = PathTestNode.objects.get_by_path('news/sports/tennis')
+        self.assertEqual(node.slug, 'tennis')
+        self.assertEqual(self.count_queries(node.make_materialized_path,
+            'slug', '/', True), (0, 'news/sports/tennis'))
+
+    def test_move(self):
+        PathTestNode.objects.move(PathTestNode.objects.get_by_path('news/sports'),
+            PathTestNode.objects.get_by_path('blog'), 'last-child')
+        self.assertEqual(self.paths(), ['news', 'news/politics', 'blog',
+            'blog/sports', 'blog/sports/football', 'blog/sports/tennis'])
+
+        PathTestNode.objects.move(PathTestNode.objects.get_by_path('blog/sports'),
+            PathTestNode.objects.get_by_path('news'), 'left')
+        self.assertEqual(self.paths(), ['sports', 'sports/football',
+            'sports/tennis', 'news', 'news/politics', 'blog'])
+        for node in PathTestNode.objects.all():
+            self.assertEqual(node.path, '/'.join(
+                [ancestor.slug for ancestor in node.ancestors()] + [node.slug]))
+
+    def test_update_paths_for(self):
+        tennis = PathTestNode.objects.get_by_path('news/sports/tennis')
+        tennis.slug = 'squash'
+        tennis.save()
+        PathTestNode.objects.update_paths_for(tennis)
+        sports = PathTestNode.objects.get_by_path('news/sports')
+        sports.slug = 'games'
+        sports.save()
+        PathTestNode.objects.update_paths_for(sports)
+        self.assertEqual(self.paths(), ['news', 'news/politics', 'news/games',
+            'news/games/football', 'news/games/squash', 'blog'])
+        self.assertEqual(sports.path, 'news/games')
+
+    def test_rebuild_paths(self):
+        PathTestNode.objects.update(path='')
+        PathTestNode.objects.rebuild_paths()
+        self.assertEqual(self.paths(), ['news', 'news/politics', 'news/sports',
+            'news/sports/football', 'news/sports/tennis', 'blog'])
+
+        PathTestNode._easytree_meta.path_include_root = False
+        try:
+            PathTestNode.objects.rebuild_paths(tree_id=1)
+            self.assertEqual(self.paths(), ['', 'politics', 'sports',
+                'sports/football', 'sports/tennis', 'blog'])
+        finally:
+            PathTestNode._easytree_meta.path_include_root = True
+
+class PrefetchChildrenTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeQuerySet.prefetch_children
+    """
+    def setUp(self):
+        self.build_tree()
+
+    def test_prefetch_children(self):
+        def children():
+            return [(node.title, self.titles(node.children())) for node in
+                TestNode.objects.filter(depth=2).prefetch_children()]
+        count, result = self.count_queries(children)
+        self.assertEqual(count, 2)
+        self.assertEqual(result, [
+            ('platformer', ['platformer_2d', 'platformer_3d', 'platformer_4d']),
+            ('shmup', ['shmup_vertical', 'shmup_horizontal']),
+            ('arpg', []), ('trpg', [])])
+
+    def test_depth(self):
+        roots = list(TestNode.objects.filter(depth=1).prefetch_children())
+        platformer = roots[0].children()[0]
+        self.assertFalse(hasattr(platformer, '_cached_children'))
+        self.assertEqual(self.titles(platformer.children()),
+            ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+
+        count, roots = self.count_queries(list,
+            TestNode.objects.filter(depth=1).prefetch_children(depth=None))
+        self.assertEqual(count, 2)
+        def descendants():
+            return [self.titles(root.descendants()) for root in roots]
+        count, result = self.count_queries(descendants)
+        self.assertEqual(count, 0)
+        self.assertEqual(result, [self.titles(TestNode.objects.get_descendants_for(root))
+            for root in roots])
+
+class MoveTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.move
+    """
+    positions = ('first-sibling', 'left', 'right', 'last-sibling',
+        'first-child', 'last-child')
+
+    def setUp(self):
+        self.build_tree()
+
+    def move(self, title, dest_title, pos, single_statement_move):
+        TestNode._easytree_meta.single_statement_move = single_statement_move
+        try:
+            TestNode.objects.move(self.node(title), self.node(dest_title), pos)
+        finally:
+            TestNode._easytree_meta.single_statement_move = False
+        return self.snapshot()
+
+    def test_engines(self):
+        """
+        The single statement move must give the same results as moving the
+        subtree to a hole.
+        """
+        nodes = list(TestNode.objects.all())
+        def restore():
+            for node in nodes:
+                TestNode.objects.filter(pk=node.pk).update(tree_id=node.tree_id,
+                    lft=node.lft, rgt=node.rgt, depth=node.depth)
+
+        for node in nodes:
+            # moves to other trees don't use the single statement
+            for dest in TestNode.objects.filter(tree_id=node.tree_id):
+                title, dest_title = node.title, dest.title
+                for pos in self.positions:
+                    try:
+                        expected = self.move(title, dest_title, pos, False)
+                    except InvalidMoveToDescendant:
+                        continue
+                    restore()
+                    self.assertEqual(self.move(title, dest_title, pos, True), expected,
+                        '%s %s %s' % (title, pos, dest_title))
+                    self.assertValidTree()
+                    restore()
+
+    def test_move(self):
+        TestNode.objects.move(self.node('platformer'), self.node('shmup_horizontal'), 'right')
+        self.assertEqual(self.snapshot(), [
+            ('action', 1, 1, 16, 1),
+            ('shmup', 1, 2, 15, 2),
+            ('shmup_vertical', 1, 3, 4, 3),
+            ('shmup_horizontal', 1, 5, 6, 3),
+            ('platformer', 1, 7, 14, 3),
+            ('platformer_2d', 1, 8, 9, 4),
+            ('platformer_3d', 1, 10, 11, 4),
+            ('platformer_4d', 1, 12, 13, 4),
+            ('rpg', 2, 1, 6, 1),
+            ('arpg', 2, 2, 3, 2),
+            ('trpg', 2, 4, 5, 2)])
+
+class BulkLoadTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.bulk_load and bulk_load_pairs
+    """
+    def test_bulk_load(self):
+        self.add_node('existing')
+        count, loaded = self.count_queries(TestNode.objects.bulk_load, [
+            {'data': {'title': 'action'}, 'children': [
+                {'data': {'title': 'platformer'}, 'children': [
+                    {'data': {'title': 'platformer_2d'}}]},
+                {'data': {'title': 'shmup'}}]},
+            {'data': {'title': 'rpg'}}], batch_size=2)
+        self.assertEqual(loaded, 5)
+        # the last tree is read again once the ids of the new trees are locked
+        self.assertEqual(count, 6)
+        self.assertEqual(self.snapshot(), [
+            ('existing', 1, 1, 2, 1),
+            ('action', 2, 1, 8, 1),
+            ('platformer', 2, 2, 5, 2),
+            ('platformer_2d', 2, 3, 4, 3),
+            ('shmup', 2, 6, 7, 2),
+            ('rpg', 3, 1, 2, 1)])
+
+    def test_bulk_load_pairs(self):
+        self.build_tree()
+        TestNode.objects.bulk_load_pairs([
+            (1, None, {'title': 'shmup_diagonal'}),
+            (2, 1, {'title': 'shmup_diagonal_up'}),
+            (3, None, {'title': 'shmup_circular'})], parent=self.node('shmup'))
+        self.assertValidTree()
+        self.assertEqual(self.titles(self.node('shmup').children()),
+            ['shmup_vertical', 'shmup_horizontal', 'shmup_diagonal', 'shmup_circular'])
+        self.assertEqual(self.titles(self.node('shmup_diagonal').children()),
+            ['shmup_diagonal_up'])
+        self.assertEqual(self.node('rpg').rgt, 6)
+
+    def test_inheritance(self):
+        self.assertRaises(EasyTreeException, InheritedTestNode.objects.bulk_load,
+            [{'data': {'title': 'action', 'genre': 'action'}}])
+        self.assertEqual(PlainTestNode.objects.count(), 0)
+
+    def test_paths(self):
+        PathTestNode.objects.bulk_load([{'data': {'slug': 'news'}, 'children': [
+            {'data': {'slug': 'sports'}}]}])
+        PathTestNode.objects.bulk_load([{'data': {'slug': 'football'}}],
+            parent=PathTestNode.objects.get_by_path('news/sports'))
+        self.assertEqual([node.path for node in PathTestNode.objects.all()],
+            ['news', 'news/sports', 'news/sports/football'])
+        self.assertValidTree(PathTestNode)
+
+class RebuildTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.rebuild
+    """
+    def setUp(self):
+        nodes = {}
+        for title, parent in (('action', None), ('platformer', 'action'),
+                ('platformer_2d', 'platformer'), ('shmup', 'action'),
+                ('rpg', None), ('arpg', 'rpg')):
+            nodes[title] = ParentTestNode.objects.create(title=title, parent=nodes.get(parent))
+
+    def test_rebuild(self):
+        count, result = self.count_queries(ParentTestNode.objects.rebuild)
+        self.assertEqual(count, 3)
+        self.assertEqual(self.snapshot(ParentTestNode), [
+            ('action', 1, 1, 8, 1),
+            ('platformer', 1, 2, 5, 2),
+            ('platformer_2d', 1, 3, 4, 3),
+            ('shmup', 1, 6, 7, 2),
+            ('rpg', 2, 1, 4, 1),
+            ('arpg', 2, 2, 3, 2)])
+
+        ParentTestNode.objects.filter(tree_id=1).update(lft=0, rgt=0)
+        ParentTestNode.objects.filter(title='arpg').update(depth=7)
+        ParentTestNode.objects.rebuild(tree_id=1)
+        self.assertEqual([node.depth for node in ParentTestNode.objects.all()],
+            [1, 2, 3, 2, 1, 7])
+
+        ParentTestNode.objects.filter(title='shmup').update(parent=None)
+        ParentTestNode.objects.rebuild(tree_id=1)
+        self.assertEqual(self.snapshot(ParentTestNode), [
+            ('action', 1, 1, 6, 1),
+            ('platformer', 1, 2, 5, 2),
+            ('platformer_2d', 1, 3, 4, 3),
+            ('rpg', 2, 1, 4, 1),
+            ('arpg', 2, 2, 3, 7),
+            ('shmup', 3, 1, 2, 1)])
+
+    def test_deep_tree(self):
+        table = qn(ParentTestNode._meta.db_table)
+        ParentTestNode.objects.all().delete()
+        first = ParentTestNode.objects.create(title='0')
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (title, tree_id, lft, rgt, depth) '
+            'VALUES (%%s, 0, 0, 0, 1)' % table, [(str(i),) for i in range(1, 2000)])
+        cursor.execute('UPDATE %s SET parent_id = id - 1 WHERE id > %%s' % table, [first.pk])
+        ParentTestNode.objects.rebuild()
+        deepest = ParentTestNode.objects.get(title='1999')
+        self.assertEqual((deepest.lft, deepest.rgt, deepest.depth), (2000, 2001, 2000))
+        self.assertValidTree(ParentTestNode)
+
+class DeleteTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeQuerySet.delete
+    """
+    def setUp(self):
+        self.build_tree()
+
+    def test_delete(self):
+        TestNode.objects.filter(title__in=['platformer', 'platformer_3d',
+            'shmup_vertical', 'trpg']).delete()
+        self.assertValidTree()
+        self.assertEqual(self.snapshot(), [
+            ('action', 1, 1, 6, 1),
+            ('shmup', 1, 2, 5, 2),
+            ('shmup_horizontal', 1, 3, 4, 3),
+            ('rpg', 2, 1, 4, 1),
+            ('arpg', 2, 2, 3, 2)])
+
+    def test_scattered_leaves(self):
+        TestNode.objects.all().delete()
+        TestNode.objects.bulk_load([{'data': {'title': 'root'}, 'children': [
+            {'data': {'title': 'node %d' % i}, 'children': [
+                {'data': {'title': 'leaf %d' % i}}]} for i in range(100)]}])
+        leaves = TestNode.objects.filter(depth=3, lft__in=[
+            node.lft for node in TestNode.objects.filter(depth=3)[::3]])
+        count, result = self.count_queries(leaves.delete)
+        self.assertTrue(count < 10)
+        self.assertEqual(TestNode.objects.filter(depth=3).count(), 66)
+        self.assertValidTree()
+
+class SparseTreeTestCase(EasyTreeTestCase):
+    """
+    Tests for the spacing EasyTreeMeta option
+    """
+    def setUp(self):
+        self.build_tree()
+        self.build_tree(SparseTestNode)
+
+    def assertSameTree(self):
+        self.assertValidTree(SparseTestNode)
+        self.assertEqual(self.structure(SparseTestNode), self.structure(TestNode))
+
+    def test_add(self):
+        self.assertSameTree()
+        for pos in ('first-child', 'last-child'):
+            for title in ('platformer_2d', 'shmup', 'rpg', 'arpg'):
+                for model in (TestNode, SparseTestNode):
+                    self.add_node('new', self.node(title, model), pos, model)
+                self.assertSameTree()
+        for pos in ('left', 'right', 'first-sibling', 'last-sibling'):
+            for title in ('platformer_2d', 'shmup_horizontal', 'trpg'):
+                for model in (TestNode, SparseTestNode):
+                    self.add_node('new', self.node(title, model), pos, model)
+                self.assertSameTree()
+
+    def test_rows_written(self):
+        written = {}
+        for model in (TestNode, SparseTestNode):
+            start = rows_written(model)
+            self.add_node('arcade', self.node('action', model), 'first-child', model)
+            written[model] = rows_written(model) - start
+        self.assertEqual(written[SparseTestNode], 1)
+        self.assertTrue(written[TestNode] > 1)
+
+    def test_move_and_delete(self):
+        for title, dest, pos in (('platformer', 'shmup_horizontal', 'right'),
+                ('shmup_vertical', 'rpg', 'left'),
+                ('arpg', 'platformer_3d', 'last-child'),
+                ('rpg', 'shmup', 'first-child')):
+            for model in (TestNode, SparseTestNode):
+                model.objects.move(self.node(title, model), self.node(dest, model), pos)
+            self.assertSameTree()
+        for model in (TestNode, SparseTestNode):
+            model.objects.filter(title__in=['platformer_2d', 'platformer_4d', 'trpg']).delete()
+        self.assertSameTree()
+        self.assertEqual(SparseTestNode.objects.get_descendant_count(
+            self.node('action', SparseTestNode)), self.node('action').get_descendant_count())
+
+    def test_bulk_load(self):
+        SparseTestNode.objects.bulk_load([{'data': {'title': 'puzzle'}, 'children': [
+            {'data': {'title': 'sokoban'}}]}], parent=self.node('action', SparseTestNode))
+        TestNode.objects.bulk_load([{'data': {'title': 'puzzle'}, 'children': [
+            {'data': {'title': 'sokoban'}}]}], parent=self.node('action'))
+        self.assertSameTree()
+        sokoban = self.node('sokoban', SparseTestNode)
+        self.assertEqual(sokoban.lft - self.node('puzzle', SparseTestNode).lft, 4)
+
+class TreeIdSpacingTestCase(EasyTreeTestCase):
+    """
+    Tests for the tree_id_spacing EasyTreeMeta option
+    """
+    def setUp(self):
+        self.build_tree()
+        self.build_tree(GappedTestNode)
+
+    def assertSameTree(self):
+        self.assertValidTree(GappedTestNode)
+        self.assertEqual(self.structure(GappedTestNode), self.structure(TestNode))
+
+    def test_add_root(self):
+        self.assertEqual([node.tree_id for node in GappedTestNode.objects.get_root_nodes()], [16, 32])
+        for title, pos in [('puzzle', 'first-sibling'), ('racing', 'right'), ('sports', 'left')]:
+            for model in (TestNode, GappedTestNode):
+                self.add_node(title, self.node('action', model), pos, model)
+            self.assertSameTree()
+
+    def test_add_root_rows_written(self):
+        for model in (TestNode, GappedTestNode):
+            start = rows_written(model)
+            self.add_node('puzzle', self.node('action', model), 'first-sibling', model)
+            if model is GappedTestNode:
+                self.assertEqual(rows_written(model) - start, 1)
+            else:
+                self.assertEqual(rows_written(model) - start, 12)
+
+    def test_exhausted_gap(self):
+        # the ids before the first tree run out after a few inserts, the
+        # trees are then shifted up to the next unused id
+        for i in range(8):
+            for model in (TestNode, GappedTestNode):
+                self.add_node('new %d' % i, self.node('rpg', model), 'left', model)
+            self.assertSameTree()
+        tree_id = self.node('rpg', GappedTestNode).tree_id
+        for model in (TestNode, GappedTestNode):
+            self.add_node('last', self.node('rpg', model), 'left', model)
+        self.assertSameTree()
+        self.assertEqual(self.node('action', GappedTestNode).tree_id, 16)
+        self.assertEqual(self.node('rpg', GappedTestNode).tree_id, tree_id + 1)
+
+    def test_move(self):
+        moves = [
+            ('rpg', 'action', 'first-sibling'),
+            ('action', 'rpg', 'left'),
+            ('shmup', 'rpg', 'right'),
+            ('rpg', 'shmup', 'last-sibling'),
+            ('platformer', 'rpg', 'left'),
+            ('action', 'trpg', 'last-child'),
+            ('shmup', 'platformer', 'first-sibling'),
+        ]
+        for title, dest, pos in moves:
+            for model in (TestNode, GappedTestNode):
+                model.objects.move(self.node(title, model), self.node(dest, model), pos)
+            self.assertSameTree()
+
+    def test_move_root_rows_written(self):
+        start = rows_written(GappedTestNode)
+        GappedTestNode.objects.move(self.node('rpg', GappedTestNode),
+            self.node('action', GappedTestNode), 'left')
+        self.assertEqual(rows_written(GappedTestNode) - start, 3)
+        self.assertEqual(self.node('action', GappedTestNode).tree_id, 16)
+
+    def test_batch(self):
+        with GappedTestNode.objects.batch():
+            self.add_node('puzzle', self.node('action', GappedTestNode), 'first-sibling', GappedTestNode)
+            GappedTestNode.objects.move(self.node('shmup', GappedTestNode),
+                self.node('rpg', GappedTestNode), 'left')
+        self.add_node('puzzle', self.node('action'), 'first-sibling')
+        TestNode.objects.move(self.node('shmup'), self.node('rpg'), 'left')
+        self.assertSameTree()
+        self.assertEqual(self.node('action', GappedTestNode).tree_id, 16)
+        self.assertEqual(self.node('rpg', GappedTestNode).tree_id, 32)
+
+class SortedTestCase(EasyTreeTestCase):
+    """
+    Tests for node_order_by models
+    """
+    def setUp(self):
+        for title in ('rpg', 'action', 'strategy'):
+            self.add_node(title, model=SortedTestNode)
+        for title in ('shmup', 'arcade', 'platformer', 'fighting'):
+            self.add_node(title, self.node('action', SortedTestNode), 'sorted-child', SortedTestNode)
+
+    def test_sorted_insert(self):
+        self.assertValidTree(SortedTestNode)
+        self.assertEqual(self.titles(SortedTestNode.objects.get_root_nodes()),
+            ['action', 'rpg', 'strategy'])
+        self.assertEqual(self.titles(self.node('action', SortedTestNode).children()),
+            ['arcade', 'fighting', 'platformer', 'shmup'])
+
+    def test_sorted_move(self):
+        SortedTestNode.objects.move(self.node('strategy', SortedTestNode),
+            self.node('action', SortedTestNode), 'sorted-child')
+        self.assertValidTree(SortedTestNode)
+        self.assertEqual(self.titles(self.node('action', SortedTestNode).children()),
+            ['arcade', 'fighting', 'platformer', 'shmup', 'strategy'])
+
+    def test_sorted_position_query(self):
+        action = self.node('action', SortedTestNode)
+        start = len(connection.queries)
+        self.count_queries(self.add_node, 'racing', action, 'sorted-child', SortedTestNode)
+        lookups = [query['sql'] for query in connection.queries[start:]
+            if '%s > ' % qn('title') in query['sql']]
+        self.assertEqual(len(lookups), 1)
+        self.assertTrue(lookups[0].endswith('LIMIT 1'))
+        self.assertEqual(self.titles(self.node('action', SortedTestNode).children()),
+            ['arcade', 'fighting', 'platformer', 'racing', 'shmup'])
+
+    def test_resort_siblings(self):
+        for title, new_title in [('arcade', 'zaxxon'), ('shmup', 'beat em up')]:
+            SortedTestNode.objects.filter(title=title).update(title=new_title)
+        self.add_node('pinball', self.node('fighting', SortedTestNode), 'first-child', SortedTestNode)
+        SortedTestNode.objects.resort_siblings(self.node('fighting', SortedTestNode))
+        self.assertValidTree(SortedTestNode)
+        self.assertEqual(self.titles(self.node('action', SortedTestNode).children()),
+            ['beat em up', 'fighting', 'platformer', 'zaxxon'])
+        self.assertEqual(self.titles(self.node('fighting', SortedTestNode).children()), ['pinball'])
+
+    def test_resort_roots(self):
+        SortedTestNode.objects.filter(title='action').update(title='sports')
+        SortedTestNode.objects.resort_siblings(self.node('rpg', SortedTestNode))
+        self.assertValidTree(SortedTestNode)
+        self.assertEqual(self.titles(SortedTestNode.objects.get_root_nodes()),
+            ['rpg', 'sports', 'strategy'])
+        self.assertEqual([node.tree_id for node in SortedTestNode.objects.get_root_nodes()], [1, 2, 3])
+        self.assertEqual(self.node('shmup', SortedTestNode).tree_id, 2)
+
+class ParentFieldTestCase(EasyTreeTestCase):
+    """
+    Tests for the parent_field EasyTreeMeta option
+    """
+    def setUp(self):
+        self.build_tree(LinkedTestNode)
+
+    def assertValidParents(self):
+        self.assertValidTree(LinkedTestNode)
+        stack = []
+        for node in LinkedTestNode.objects.order_by('tree_id', 'lft'):
+            while stack and (stack[-1].tree_id != node.tree_id or stack[-1].rgt < node.lft):
+                stack.pop()
+            self.assertEqual(node.parent_id, stack and stack[-1].pk or None)
+            stack.append(node)
+
+    def test_add(self):
+        self.assertValidParents()
+        self.add_node('puzzle', self.node('shmup', LinkedTestNode), 'left', LinkedTestNode)
+        self.add_node('racing', self.node('rpg', LinkedTestNode), 'first-sibling', LinkedTestNode)
+        self.add_node('jrpg', self.node('arpg', LinkedTestNode), 'first-child', LinkedTestNode)
+        self.assertValidParents()
+
+    def test_move(self):
+        moves = [
+            ('shmup', 'rpg', 'first-child'),
+            ('platformer_2d', 'arpg', 'right'),
+            ('rpg', 'action', 'left'),
+            ('platformer', 'trpg', 'last-child'),
+            ('shmup', 'action', 'last-sibling'),
+            ('action', 'shmup_vertical', 'first-child'),
+        ]
+        for title, dest, pos in moves:
+            LinkedTestNode.objects.move(self.node(title, LinkedTestNode),
+                self.node(dest, LinkedTestNode), pos)
+            self.assertValidParents()
+
+    def test_bulk_load(self):
+        data = [{'data': {'title': 'puzzle'}, 'children': [
+            {'data': {'title': 'sokoban'}, 'children': [{'data': {'title': 'boxes'}}]},
+            {'data': {'title': 'tetris'}}]}]
+        LinkedTestNode.objects.bulk_load(data, parent=self.node('action', LinkedTestNode))
+        LinkedTestNode.objects.bulk_load(data)
+        self.assertValidParents()
+
+    def test_batch(self):
+        with LinkedTestNode.objects.batch():
+            self.add_node('puzzle', self.node('action', LinkedTestNode), 'first-child', LinkedTestNode)
+            LinkedTestNode.objects.move(self.node('trpg', LinkedTestNode),
+                self.node('puzzle', LinkedTestNode), 'last-child')
+            LinkedTestNode.objects.move(self.node('shmup', LinkedTestNode),
+                self.node('rpg', LinkedTestNode), 'right')
+        self.assertValidParents()
+
+    def test_lookups(self):
+        node = LinkedTestNode.objects.select_related('parent').get(title='platformer_3d')
+        count, parent = self.count_queries(LinkedTestNode.objects.get_parent_for, node)
+        self.assertEqual((count, parent.title), (0, 'platformer'))
+        count, children = self.count_queries(lambda: list(parent.children()))
+        self.assertEqual(count, 1)
+        self.assertEqual(self.titles(children), ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+        self.assertEqual(self.titles(LinkedTestNode.objects.get_children_for(
+            self.node('action', LinkedTestNode)).reverse()), ['shmup', 'platformer'])
+
+class ClosureTestCase(EasyTreeTestCase):
+    """
+    Tests for the closure_model EasyTreeMeta option, checked against the
+    same operations on nested sets
+    """
+    def setUp(self):
+        self.build_tree(ClosureTestNode)
+        self.build_tree(LinkedTestNode)
+
+    def outline(self, model):
+        return [(node.title, node.depth, node.parent_id and node.parent.title)
+            for node in model.objects.get_cached_tree()]
+
+    def assertSameTrees(self):
+        self.assertEqual(self.outline(ClosureTestNode), self.outline(LinkedTestNode))
+        links = set()
+        for node in ClosureTestNode.objects.all():
+            ancestor, distance = node, 0
+            while ancestor is not None:
+                links.add((ancestor.pk, node.pk, distance))
+                ancestor, distance = ancestor.parent, distance + 1
+        self.assertEqual(set(ClosureTestNodeClosure.objects.values_list(
+            'ancestor', 'descendant', 'distance')), links)
+        for node in ClosureTestNode.objects.all():
+            self.assertEqual(node.path, node.make_materialized_path('title', '/', True))
+            self.assertEqual(node.path, '/'.join(self.titles(
+                list(node.ancestors()) + [node])))
+
+    def test_add(self):
+        for model in (ClosureTestNode, LinkedTestNode):
+            self.add_node('puzzle', self.node('shmup', model), 'left', model)
+            self.add_node('racing', self.node('rpg', model), 'first-sibling', model)
+            self.add_node('jrpg', self.node('arpg', model), 'first-child', model)
+            self.add_node('sokoban', self.node('puzzle', model), 'right', model)
+            self.add_node('platformer_1d', self.node('platformer', model), 'first-child', model)
+        self.assertSameTrees()
+
+    def test_move(self):
+        moves = [
+            ('shmup', 'rpg', 'first-child'),
+            ('platformer_2d', 'arpg', 'right'),
+            ('rpg', 'action', 'left'),
+            ('platformer', 'trpg', 'last-child'),
+            ('shmup', 'action', 'last-sibling'),
+            ('action', 'shmup_vertical', 'first-child'),
+            ('platformer_4d', 'platformer_3d', 'left'),
+            ('shmup_horizontal', 'rpg', 'right'),
+        ]
+        for title, dest, pos in moves:
+            for model in (ClosureTestNode, LinkedTestNode):
+                model.objects.move(self.node(title, model), self.node(dest, model), pos)
+            self.assertSameTrees()
+        self.assertRaises(InvalidMoveToDescendant, ClosureTestNode.objects.move,
+            self.node('rpg', ClosureTestNode), self.node('platformer', ClosureTestNode), 'left')
+
+    def test_delete(self):
+        for model in (ClosureTestNode, LinkedTestNode):
+            model.objects.filter(title__in=['platformer', 'shmup_vertical', 'trpg']).delete()
+        self.assertSameTrees()
+        self.assertEqual(ClosureTestNode.objects.count(), 5)
+
+    def test_lookups(self):
+        action, platformer, platformer_3d, rpg = [self.node(title, ClosureTestNode)
+            for title in ('action', 'platformer', 'platformer_3d', 'rpg')]
+        self.assertEqual(self.titles(platformer_3d.ancestors()), ['action', 'platformer'])
+        self.assertEqual(self.titles(platformer.descendants()),
+            ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+        self.assertEqual(self.titles(platformer.children()),
+            ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+        self.assertEqual(self.titles(platformer_3d.siblings()),
+            ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+        self.assertEqual(ClosureTestNode.objects.get_root(platformer_3d), action)
+        self.assertEqual(action.get_descendant_count(), 7)
+        self.assertTrue(platformer_3d.is_descendant_of(action))
+        self.assertFalse(platformer_3d.is_descendant_of(rpg))
+        self.assertTrue(action.is_ancestor_of(platformer_3d))
+        self.assertTrue(platformer.is_sibling_of(self.node('shmup', ClosureTestNode)))
+        self.assertTrue(platformer_3d.is_leaf())
+        self.assertFalse(action.is_leaf())
+        self.assertEqual(self.titles(ClosureTestNode.objects.get_cached_tree(rpg)),
+            ['rpg', 'arpg', 'trpg'])
+        ancestors = ClosureTestNode.objects.get_ancestors_for_nodes([platformer_3d, rpg])
+        self.assertEqual(self.titles(ancestors[platformer_3d]), ['action', 'platformer'])
+        self.assertEqual(ancestors[rpg], [])
+
+    def test_rows_written(self):
+        """
+        Moving a subtree to another tree rewrites the target tree under
+        nested sets, but only the new siblings and the links of the
+        subtree with a closure table.
+        """
+        written = {}
+        for model, tables in ((ClosureTestNode, (ClosureTestNode, ClosureTestNodeClosure)),
+                              (LinkedTestNode, (LinkedTestNode,))):
+            target, dest = self.node('arpg', model), self.node('platformer', model)
+            before = rows_written(*tables)
+            model.objects.move(target, dest, 'left')
+            written[model] = rows_written(*tables) - before
+        self.assertSameTrees()
+        self.assertTrue(written[ClosureTestNode] < written[LinkedTestNode])
+
+    def test_dfs_order(self):
+        for model in (ClosureTestNode, LinkedTestNode):
+            model.objects.move(self.node('platformer_4d', model), self.node('platformer_2d', model), 'left')
+            model.objects.move(self.node('rpg', model), self.node('shmup', model), 'first-child')
+        for model in (ClosureTestNode, LinkedTestNode):
+            self.assertEqual(self.titles(model.objects.get_tree()),
+                self.titles(model.objects.get_cached_tree()))
+        self.assertEqual(self.titles(ClosureTestNode.objects.get_tree()),
+            self.titles(LinkedTestNode.objects.get_tree()))
+        self.assertEqual(self.titles(self.node('action', ClosureTestNode).descendants()),
+            self.titles(self.node('action', LinkedTestNode).descendants()))
+
+    def test_changelist(self):
+        model_admin = EasyTreeAdmin(ClosureTestNode, AdminSite())
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET = QueryDict('')
+        cl = EasyTreeChangeList(request, ClosureTestNode, model_admin.list_display,
+            model_admin.list_display_links, model_admin.list_filter, model_admin.date_hierarchy,
+            model_admin.search_fields, model_admin.list_select_related, model_admin.list_per_page,
+            model_admin.list_editable, model_admin)
+        self.assertEqual(self.titles(cl.result_list), self.titles(LinkedTestNode.objects.get_tree()))
+
+    def test_batch(self):
+        for model in (ClosureTestNode, LinkedTestNode):
+            model.objects.move_many([
+                (self.node('shmup', model), self.node('rpg', model), 'first-child'),
+                (self.node('trpg', model), self.node('action', model), 'left'),
+            ])
+        self.assertSameTrees()
+        with ClosureTestNode.objects.batch():
+            ClosureTestNode.objects.move(self.node('arpg', ClosureTestNode),
+                self.node('platformer', ClosureTestNode), 'first-child')
+            self.assertEqual(self.titles(self.node('platformer', ClosureTestNode).children()),
+                ['arpg', 'platformer_2d', 'platformer_3d', 'platformer_4d'])
+
+    def test_prefetch_children(self):
+        roots = list(ClosureTestNode.objects.filter(lft=1).order_by('tree_id').prefetch_children(2))
+        self.assertEqual([self.titles(root._cached_children) for root in roots],
+            [['platformer', 'shmup'], ['arpg', 'trpg']])
+        platformer = roots[0]._cached_children[0]
+        self.assertEqual(self.titles(platformer.children()),
+            ['platformer_2d', 'platformer_3d', 'platformer_4d'])
+        self.assertFalse(hasattr(platformer._cached_children[0], '_cached_children'))
+        self.assertEqual(self.titles(platformer._cached_children[0].ancestors()),
+            ['action', 'platformer'])
+
+    def test_bulk_load(self):
+        data = [{'data': {'title': 'puzzle'}, 'children': [
+            {'data': {'title': 'sokoban'}, 'children': [{'data': {'title': 'sokoban_3d'}}]},
+            {'data': {'title': 'tetris'}}]}]
+        for model in (ClosureTestNode, LinkedTestNode):
+            self.assertEqual(model.objects.bulk_load(data), 4)
+            self.assertEqual(model.objects.bulk_load(data, parent=self.node('shmup', model)), 4)
+            self.assertEqual(model.objects.bulk_load([{'data': {'title': 'jrpg'}}],
+                parent=self.node('rpg', model)), 1)
+        self.assertSameTrees()
+        self.assertEqual(ClosureTestNode.objects.check(), {})
+
+    def test_resort_siblings(self):
+        ClosureTestNode.objects.filter(title='platformer_2d').update(title='platformer_5d')
+        ClosureTestNode._easytree_meta.node_order_by = ['title']
+        try:
+            ClosureTestNode.objects.resort_siblings(self.node('platformer_3d', ClosureTestNode))
+        finally:
+            ClosureTestNode._easytree_meta.node_order_by = []
+        self.assertEqual(self.titles(self.node('platformer', ClosureTestNode).children()),
+            ['platformer_3d', 'platformer_4d', 'platformer_5d'])
+        self.assertEqual(ClosureTestNode.objects.check(), {})
+
+    def test_rebuild_and_check(self):
+        self.assertEqual(ClosureTestNode.objects.check(), {})
+        rpg, action = self.node('rpg', ClosureTestNode), self.node('action', ClosureTestNode)
+        ClosureTestNode.objects.filter(title='shmup').update(parent=rpg)
+        ClosureTestNode.objects.filter(title='platformer_3d').update(lft=2, rgt=3)
+        self.assertEqual(ClosureTestNode.objects.check(), {
+            action.tree_id: ['closure', 'duplicate', 'nesting']})
+        ClosureTestNode.objects.rebuild()
+        self.assertEqual(ClosureTestNode.objects.check(), {})
+        self.assertEqual(self.titles(self.node('rpg', ClosureTestNode).children()),
+            ['shmup', 'arpg', 'trpg'])
+        for model in (ClosureTestNode, LinkedTestNode):
+            model.objects.move(self.node('shmup', model), self.node('trpg', model), 'right')
+        ClosureTestNodeClosure.objects.all().delete()
+        ClosureTestNode.objects.rebuild(tree_id=self.node('rpg', ClosureTestNode).tree_id)
+        self.assertEqual(ClosureTestNode.objects.check().keys(), [action.tree_id])
+        ClosureTestNode.objects.rebuild()
+        self.assertSameTrees()
+
+class SignalsTestCase(EasyTreeTestCase):
+    """
+    Tests for the node_pre_move and node_moved signals
+    """
+    positions = ('first-sibling', 'left', 'right', 'last-sibling',
+        'first-child', 'last-child')
+
+    def values(self, node):
+        return {'tree_id': node.tree_id, 'lft': node.lft, 'rgt': node.rgt, 'depth': node.depth}
+
+    def connect(self, signal, receiver, model):
+        signal.connect(receiver, sender=model)
+        self.receivers.append((signal, receiver, model))
+
+    def setUp(self):
+        self.receivers = []
+
+    def tearDown(self):
+        for signal, receiver, model in self.receivers:
+            signal.disconnect(receiver, sender=model)
+
+    def check_moves(self, model, count=40):
+        """
+        Makes random moves and checks the values announced before each move
+        against the node before and after it.
+        """
+        self.build_tree(model)
+        sent = []
+        def receiver(sender, node, old_values, new_values, **kwargs):
+            sent.append((node.pk, old_values, new_values))
+        self.connect(node_pre_move, receiver, model)
+        rnd = random.Random(0)
+        titles = [node.title for node in model.objects.all()]
+        checked = 0
+        for i in range(count):
+            target = self.node(rnd.choice(titles), model)
+            dest = self.node(rnd.choice(titles), model)
+            pos = rnd.choice(self.positions)
+            del sent[:]
+            try:
+                model.objects.move(target, dest, pos)
+            except InvalidMoveToDescendant:
+                continue
+            if not sent:
+                continue
+            pk, old_values, new_values = sent[0]
+            message = '%s %s %s' % (target.title, pos, dest.title)
+            self.assertEqual((pk, old_values), (target.pk, self.values(target)), message)
+            self.assertEqual(new_values, self.values(model.objects.get(pk=pk)), message)
+            checked += 1
+        self.assertTrue(checked > count / 2)
+
+    def test_pre_move_values(self):
+        self.check_moves(TestNode)
+
+    def test_pre_move_values_single_statement(self):
+        TestNode._easytree_meta.single_statement_move = True
+        try:
+            self.check_moves(TestNode)
+        finally:
+            TestNode._easytree_meta.single_statement_move = False
+
+    def test_pre_move_values_sparse(self):
+        self.check_moves(SparseTestNode)
+        self.check_moves(GappedTestNode)
+
+    def test_pre_move_values_closure(self):
+        self.check_moves(ClosureTestNode)
+
+    def test_lazy_nodes(self):
+        self.build_tree()
+        target, dest = self.node('arpg'), self.node('platformer')
+        count = self.count_queries(TestNode.objects.move, target, dest, 'last-child')[0]
+
+        received = []
+        def receiver(sender, node_moved, moved_to_node, **kwargs):
+            received.append((node_moved, moved_to_node))
+        self.connect(node_moved, receiver, TestNode)
+        target, dest = self.node('trpg'), self.node('platformer')
+        self.assertEqual(self.count_queries(TestNode.objects.move, target, dest, 'last-child')[0],
+            count)
+        moved, moved_to = received[0]
+        loaded = self.count_queries(lambda: (moved.title, moved.depth, moved_to.title))
+        self.assertEqual(loaded, (2, ('trpg', 3, 'platformer')))
+        self.assertEqual(moved, TestNode.objects.get(title='trpg'))
+
+    def test_batch(self):
+        self.build_tree()
+        sent = []
+        def receiver(sender, node, old_values, new_values, **kwargs):
+            sent.append((node.title, old_values, new_values))
+        self.connect(node_pre_move, receiver, TestNode)
+        platformer = self.values(self.node('platformer'))
+        with TestNode.objects.batch():
+            TestNode.objects.move(self.node('platformer'), self.node('rpg'), 'last-child')
+            self.assertEqual(sent, [])
+        self.assertEqual(sent, [('platformer', platformer,
+            self.values(self.node('platformer')))])
+
+class InstrumentationTestCase(EasyTreeTestCase):
+    """
+    Tests for easytree.instrumentation
+    """
+    def setUp(self):
+        self.collector = Collector()
+        self.collector.connect(TestNode)
+
+    def tearDown(self):
+        self.collector.disconnect(TestNode)
+
+    def last(self):
+        return self.collector.operations[-1]
+
+    def test_operations(self):
+        self.build_tree()
+        self.assertEqual([operation.name for operation in self.collector.operations],
+            ['add_root'] + ['add_child_to'] * 7 + ['add_root'] + ['add_child_to'] * 2)
+        self.assertEqual((self.last().tree_id, self.last().subtree_size), (2, 1))
+
+        rows = rows_written(TestNode)
+        TestNode.objects.move(self.node('platformer'), self.node('rpg'), 'first-child')
+        operation = self.last()
+        self.assertEqual((operation.name, operation.tree_id, operation.subtree_size),
+            ('move', 1, 4))
+        self.assertTrue(operation.statements > 0)
+        self.assertTrue(operation.seconds >= 0)
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            self.assertEqual(operation.rows, rows_written(TestNode) - rows)
+
+        TestNode.objects.filter(title='shmup').delete()
+        # the subtree and the root, whose rgt shrinks
+        self.assertEqual((self.last().name, self.last().rows), ('delete', 4))
+
+        totals = self.collector.totals[('tests', 'TestNode', 'add_child_to')]
+        self.assertEqual(totals['count'], 9)
+        self.assertEqual(len(self.collector.report()), 4)
+
+    def test_other_models(self):
+        self.build_tree(SparseTestNode)
+        self.build_tree(LinkedTestNode)
+        self.assertEqual(self.collector.operations, [])
+        self.collector.connect(SparseTestNode)
+        self.collector.connect(LinkedTestNode)
+        try:
+            SparseTestNode.objects.move(self.node('platformer', SparseTestNode),
+                self.node('rpg', SparseTestNode), 'first-child')
+            self.assertEqual((self.last().model, self.last().subtree_size),
+                (SparseTestNode, None))
+            LinkedTestNode.objects.rebuild(2)
+            self.assertEqual((self.last().name, self.last().tree_id), ('rebuild', 2))
+        finally:
+            self.collector.disconnect(SparseTestNode)
+            self.collector.disconnect(LinkedTestNode)
+
+    def test_batch(self):
+        self.build_tree()
+        self.collector.reset()
+        rows = rows_written(TestNode)
+        with TestNode.objects.batch():
+            self.add_node('puzzle', self.node('action'), 'first-child')
+            TestNode.objects.move(self.node('trpg'), self.node('puzzle'), 'last-child')
+        # adds and moves only record the changes, the batch writes them
+        self.assertEqual([(operation.name, operation.rows) for operation in
+            self.collector.operations[:2]], [('add_child_to', 0), ('move', 0)])
+        self.assertEqual(self.last().name, 'batch')
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            # and the insert of the new node
+            self.assertEqual(self.last().rows, rows_written(TestNode) - rows - 1)
+
+class CacheTestCase(EasyTreeTestCase):
+    """
+    Tests for easytree.cache
+    """
+    def setUp(self):
+        self.build_tree()
+        TestNode._easytree_meta.cache_backend = 'locmem://'
+
+    def tearDown(self):
+        TestNode._easytree_meta.cache_backend = None
+        del TestNode._easytree_meta._tree_cache
+
+    def read(self, func, *args):
+        count, nodes = self.count_queries(lambda: self.titles(func(*args)))
+        return nodes, count > 0
+
+    def test_reads(self):
+        platformer = self.node('platformer')
+        for func, arg in ((TestNode.objects.get_tree, None),
+              (TestNode.objects.get_tree, platformer),
+              (TestNode.objects.get_descendants_for, platformer),
+              (TestNode.objects.get_children_for, platformer)):
+            nodes, queried = self.read(func, arg)
+            self.assertTrue(queried)
+            self.assertEqual(self.read(func, arg), (nodes, False))
+        self.assertEqual(self.read(TestNode.objects.get_children_for, platformer),
+            (['platformer_2d', 'platformer_3d', 'platformer_4d'], False))
+        self.assertEqual(get_tree_cache(SparseTestNode.objects), None)
+
+    def test_invalidation(self):
+        rpg = self.node('rpg')
+        self.read(TestNode.objects.get_children_for, rpg)
+        self.read(TestNode.objects.get_tree, None)
+        arpg = self.node('arpg')
+        arpg.title = 'action_rpg'
+        arpg.save()
+        self.assertEqual(self.read(TestNode.objects.get_children_for, rpg),
+            (['action_rpg', 'trpg'], True))
+
+        TestNode.objects.move(self.node('rpg'), self.node('action'), 'left')
+        self.assertEqual(self.read(TestNode.objects.get_tree, None)[0][:3],
+            ['rpg', 'action_rpg', 'trpg'])
+        # the trees were renumbered
+        self.assertTrue(self.read(TestNode.objects.get_children_for, self.node('rpg'))[1])
+
+        shmup = self.node('shmup')
+        self.read(TestNode.objects.get_descendants_for, shmup)
+        TestNode.objects.filter(title='shmup_vertical').delete()
+        self.assertEqual(self.read(TestNode.objects.get_descendants_for, self.node('shmup')),
+            (['shmup_horizontal'], True))
+
+    def test_new_trees(self):
+        """
+        Adding a root or rebuilding a tree leaves the reads of the other
+        trees cached.
+        """
+        platformer, rpg = self.node('platformer'), self.node('rpg')
+        self.read(TestNode.objects.get_children_for, platformer)
+        self.read(TestNode.objects.get_children_for, rpg)
+        self.read(TestNode.objects.get_tree, None)
+        self.add_node('puzzle')
+        self.assertFalse(self.read(TestNode.objects.get_children_for, platformer)[1])
+        self.assertEqual(self.read(TestNode.objects.get_tree, None)[0][-1], 'puzzle')
+
+        self.build_tree(LinkedTestNode)
+        LinkedTestNode._easytree_meta.cache_backend = 'locmem://'
+        try:
+            platformer, rpg = self.node('platformer', LinkedTestNode), self.node('rpg', LinkedTestNode)
+            self.read(LinkedTestNode.objects.get_children_for, platformer)
+            self.read(LinkedTestNode.objects.get_children_for, rpg)
+            LinkedTestNode.objects.rebuild(tree_id=rpg.tree_id)
+            self.assertFalse(self.read(LinkedTestNode.objects.get_children_for, platformer)[1])
+            self.assertTrue(self.read(LinkedTestNode.objects.get_children_for, rpg)[1])
+        finally:
+            LinkedTestNode._easytree_meta.cache_backend = None
+            del LinkedTestNode._easytree_meta._tree_cache
+
+    def test_batch(self):
+        self.read(TestNode.objects.get_tree, None)
+        with TestNode.objects.batch():
+            TestNode.objects.move(self.node('trpg'), self.node('action'), 'first-child')
+        self.assertEqual(self.read(TestNode.objects.get_tree, None)[0][:2], ['action', 'trpg'])
+
+class VersionsTestCase(EasyTreeTestCase):
+    """
+    Tests for easytree.versions
+    """
+    def setUp(self):
+        TestNode._easytree_meta.version_model = 'TestNodeVersion'
+        self.build_tree()
+        self.versions = get_versions(TestNode.objects)
+
+    def tearDown(self):
+        TestNode._easytree_meta.version_model = None
+
+    def get(self, *tree_ids):
+        return [self.versions.get(tree_id)[0] for tree_id in tree_ids]
+
+    def test_touch(self):
+        forest, first, second = self.get(None, 1, 2)
+        self.assertTrue(forest > second > 0)
+        self.assertEqual(self.versions.get(3), (0, None))
+
+        # the changes of a tree don't update the row of the forest
+        forest_row, = self.get(FOREST)
+        TestNode.objects.move(self.node('trpg'), self.node('arpg'), 'left')
+        self.assertEqual(self.get(1, FOREST), [first, forest_row])
+        self.assertTrue(self.get(None, 2) > [forest, second])
+        forest, second = self.get(None, 2)
+
+        arpg = self.node('arpg')
+        arpg.title = 'action_rpg'
+        arpg.save()
+        self.assertEqual(self.get(None, 1, 2, FOREST), [forest + 1, first, second + 1, forest_row])
+
+        self.add_node('puzzle')
+        self.assertEqual(self.get(None, 3, FOREST), [forest + 3, 1, forest_row + 1])
+
+        TestNode.objects.filter(title='shmup').delete()
+        self.assertTrue(self.get(1) > [first])
+        # renumbering the trees changes all of them
+        forest, first, second = self.get(None, 1, 2)
+        TestNode.objects.move(self.node('rpg'), self.node('action'), 'left')
+        self.assertTrue(self.get(1, 2) > [first, second])
+        self.assertEqual(TestNodeVersion.objects.count(), 4)
+
+    def test_condition(self):
+        calls = []
+        def view(request, title):
+            calls.append(title)
+            return HttpResponse(title)
+        view = condition_on_tree(TestNode, lambda request, title: 2)(view)
+
+        def get(**headers):
+            request = HttpRequest()
+            request.method = 'GET'
+            request.META.update(headers)
+            return self.count_queries(view, request, 'rpg')
+
+        count, response = get()
+        self.assertEqual((count, response.status_code, calls), (1, 200, ['rpg']))
+        etag, modified = response['ETag'], response['Last-Modified']
+        count, response = get(HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual((count, response.status_code, calls), (1, 304, ['rpg']))
+
+        # the other trees are not part of it
+        TestNode.objects.filter(title='shmup').delete()
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=etag)[1].status_code, 304)
+        TestNode.objects.filter(title='trpg').delete()
+        response = get(HTTP_IF_NONE_MATCH=etag)[1]
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+class LazyTestNodeAdmin(EasyTreeAdmin):
+    lazy_changelist = True
+
+class AdminTestCase(EasyTreeTestCase):
+    """
+    Tests for the lazy changelist of easytree.admin
+    """
+    def request(self, query=''):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET = QueryDict(query)
+        return request
+
+    def children(self, model, node):
+        model_admin = LazyTestNodeAdmin(model, AdminSite())
+        request = self.request(node and 'node=%s' % node.pk or '')
+        count, response = self.count_queries(model_admin.children_view, request)
+        return count, simplejson.loads(response.content)
+
+    def test_children(self):
+        self.build_tree()
+        count, data = self.children(TestNode, self.node('action'))
+        self.assertEqual(count, 1)
+        self.assertEqual([(node['label'], node['depth'], node['descendant_count'], node['is_leaf'])
+            for node in data['nodes']], [('platformer', 2, 3, False), ('shmup', 2, 2, False)])
+        self.assertEqual(self.children(TestNode, self.node('arpg'))[1]['nodes'], [])
+        self.assertEqual(self.children(TestNode, None)[1]['success'], False)
+
+        self.build_tree(ParentTestNode)
+        count, data = self.children(ParentTestNode, self.node('rpg', ParentTestNode))
+        self.assertEqual((count, [node['label'] for node in data['nodes']]),
+            (1, ['arpg', 'trpg']))
+
+        self.build_tree(SparseTestNode)
+        data = self.children(SparseTestNode, self.node('shmup', SparseTestNode))[1]
+        self.assertEqual([(node['label'], node['descendant_count'], node['is_leaf'])
+            for node in data['nodes']], [('shmup_vertical', None, True), ('shmup_horizontal', None, True)])
+
+    def test_changelist(self):
+        self.build_tree()
+        model_admin = LazyTestNodeAdmin(TestNode, AdminSite())
+        self.assertEqual(model_admin.change_list_template, 'admin/easytree_lazy_change_list.html')
+        def changelist(query):
+            return EasyTreeChangeList(self.request(query), TestNode, model_admin.list_display,
+                model_admin.list_display_links, model_admin.list_filter, model_admin.date_hierarchy,
+                ['title'], model_admin.list_select_related, model_admin.list_per_page,
+                model_admin.list_editable, model_admin)
+        self.assertEqual(self.titles(changelist('').result_list), ['action', 'rpg'])
+        self.assertEqual(self.titles(changelist('q=shmup_').result_list),
+            ['shmup_vertical', 'shmup_horizontal'])
+
+class AutocompleteTestCase(EasyTreeTestCase):
+    """
+    Tests for the autocomplete view of relative_to
+    """
+    def autocomplete(self, model_admin, query):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET = QueryDict(query)
+        count, response = self.count_queries(model_admin.autocomplete_view, request)
+        return count, simplejson.loads(response.content)
+
+    def test_pages(self):
+        self.build_tree()
+        model_admin = EasyTreeAdmin(TestNode, AdminSite())
+        model_admin.search_fields = ('title',)
+        model_admin.autocomplete_per_page = 2
+        count, data = self.autocomplete(model_admin, 'q=platformer')
+        self.assertEqual(count, 2)
+        self.assertEqual((data['has_next'], [(node['label'], node['path']) for node in data['nodes']]),
+            (True, [('>>> platformer', 'action / platformer'),
+                ('>>>>>> platformer_2d', 'action / platformer / platformer_2d')]))
+        data = self.autocomplete(model_admin, 'q=platformer&page=2')[1]
+        self.assertEqual((data['has_next'], [node['label'] for node in data['nodes']]),
+            (False, ['>>>>>> platformer_3d', '>>>>>> platformer_4d']))
+        data = self.autocomplete(model_admin, 'q=rpg+t')[1]
+        self.assertEqual([node['label'] for node in data['nodes']], ['>>> trpg'])
+        self.assertEqual(self.autocomplete(model_admin, 'q=rpg')[1]['nodes'][0]['label'], ' rpg')
+        self.assertEqual(self.autocomplete(model_admin, 'page=x')[1]['success'], False)
+
+    def test_path_field(self):
+        self.build_tree(ClosureTestNode)
+        model_admin = EasyTreeAdmin(ClosureTestNode, AdminSite())
+        count, data = self.autocomplete(model_admin, 'q=shmup_')
+        self.assertEqual((count, [node['path'] for node in data['nodes']]),
+            (1, ['action/shmup/shmup_vertical', 'action/shmup/shmup_horizontal']))
+
+    def test_no_search_fields(self):
+        self.build_tree()
+        model_admin = EasyTreeAdmin(TestNode, AdminSite())
+        self.assertEqual(model_admin.get_autocomplete_search_fields(), [])
+        data = self.autocomplete(model_admin, 'q=shmup')[1]
+        self.assertEqual(len(data['nodes']), TestNode.objects.count())
+        request = HttpRequest()
+        request.method = 'GET'
+        self.assertEqual(model_admin.get_form(request).relative_to_autocomplete_url, None)
+
+        model_admin.search_fields = ('^title',)
+        data = self.autocomplete(model_admin, 'q=shmup_')[1]
+        self.assertEqual([node['label'] for node in data['nodes']],
+            ['>>>>>> shmup_vertical', '>>>>>> shmup_horizontal'])
+        self.assertEqual(self.autocomplete(model_admin, 'q=vertical')[1]['nodes'], [])
+
+    def test_widget(self):
+        self.build_tree()
+        class TestNodeForm(BaseEasyTreeForm):
+            relative_to_autocomplete_url = '/admin/tests/testnode/autocomplete/'
+            class Meta:
+                model = TestNode
+                exclude = ('tree_id', 'depth', 'lft', 'rgt')
+        form = TestNodeForm(initial={'relative_to': self.node('shmup').pk})
+        self.assertTrue(isinstance(form.fields['relative_to'].widget, EasyTreeAutocompleteWidget))
+        count, html = self.count_queries(unicode, form['relative_to'])
+        self.assertEqual(count, 1)
+        self.assertTrue('value=">>> shmup"' in html.replace('&gt;', '>'))
+        form = TestNodeForm({'title': 'puzzle', 'relative_to': self.node('action').pk,
+            'relative_position': 'last-child'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.save(commit=True).ancestors()[0].title, 'action')
+
+class BenchmarkTestCase(EasyTreeTestCase):
+    """
+    Smoke tests for the benchmark suite
+    """
+    def test_shapes(self):
+        def depth(entry):
+            return 1 + max([0] + [depth(child) for child in entry['children']])
+        def size(entry):
+            return 1 + sum([size(child) for child in entry['children']])
+        for shape, expected_depth in (('deep', 10), ('wide', 2), ('random', None)):
+            entries = make_entries(shape, 37)
+            self.assertEqual(size(entries[0]), 37)
+            if expected_depth:
+                self.assertEqual(depth(entries[0]), expected_depth)
+        self.assertEqual(make_entries('random', 37, 1), make_entries('random', 37, 1))
+
+    def test_suite(self):
+        results = bench_suite(sizes=(12,), shapes=('random',), repeat=1)
+        self.assertEqual(len(results), len(get_operations()))
+        for result in results:
+            if result['operation'].startswith('add') or result['operation'] == 'move':
+                self.assertTrue(result['queries'] > 0, result)
+
+class CheckTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.check() and the easytree_check command
+    """
+    def setUp(self):
+        self.build_tree()
+        self.build_tree(SparseTestNode)
+        self.build_tree(LinkedTestNode)
+
+    def corrupt(self, model, title, **values):
+        model.objects.filter(title=title).update(**values)
+
+    def call_check(self, *args, **options):
+        """
+        :returns: the output of the command and its exit status.
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            try:
+                call_command('easytree_check', *args, **options)
+            except SystemExit, e:
+                return sys.stdout.getvalue(), e.code
+            return sys.stdout.getvalue(), 0
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_valid(self):
+        SparseTestNode.objects.move(self.node('shmup', SparseTestNode),
+            self.node('rpg', SparseTestNode), 'first-child')
+        for model in (TestNode, SparseTestNode, LinkedTestNode):
+            self.assertEqual(model.objects.check(), {})
+
+    def test_problems(self):
+        self.corrupt(TestNode, 'arpg', lft=3, rgt=2)
+        self.assertEqual(TestNode.objects.check(), {2: ['interval', 'nesting']})
+        self.corrupt(TestNode, 'arpg', lft=2, rgt=3)
+        self.corrupt(TestNode, 'trpg', lft=3)
+        self.assertEqual(TestNode.objects.check(), {2: ['duplicate']})
+        self.corrupt(TestNode, 'trpg', lft=4)
+        self.corrupt(TestNode, 'platformer_3d', depth=2)
+        self.assertEqual(TestNode.objects.check(), {1: ['nesting']})
+        # overlapping siblings
+        self.corrupt(TestNode, 'platformer_3d', depth=3, rgt=7)
+        self.corrupt(TestNode, 'platformer_4d', lft=6)
+        self.assertEqual(TestNode.objects.check(), {1: ['nesting']})
+        self.corrupt(TestNode, 'platformer_3d', rgt=6)
+        self.corrupt(TestNode, 'platformer_4d', lft=7)
+        self.corrupt(TestNode, 'shmup', rgt=16)
+        self.corrupt(TestNode, 'action', rgt=17)
+        self.assertEqual(TestNode.objects.check(), {1: ['gap']})
+        self.corrupt(TestNode, 'shmup', rgt=15)
+        self.corrupt(TestNode, 'action', rgt=16)
+        self.corrupt(TestNode, 'rpg', depth=2)
+        self.assertEqual(TestNode.objects.check(), {2: ['nesting', 'root']})
+
+    def test_sparse_gaps(self):
+        self.corrupt(SparseTestNode, 'trpg', lft=F('lft') + 1, rgt=F('rgt') + 1)
+        self.assertEqual(SparseTestNode.objects.check(), {})
+
+    def test_command(self):
+        self.assertEqual(self.call_check('tests.LinkedTestNode'), ('', 0))
+        self.corrupt(LinkedTestNode, 'platformer', lft=10)
+        self.assertEqual(self.call_check('tests.LinkedTestNode'),
+            ('tests.LinkedTestNode: tree 1: duplicate, interval, nesting\n', 1))
+        output, status = self.call_check('tests.LinkedTestNode', repair=True)
+        self.assertEqual(status, 0)
+        self.assertTrue(output.endswith('tests.LinkedTestNode: repaired trees 1\n'))
+        self.assertValidTree(LinkedTestNode)
+        self.assertEqual(self.titles(self.node('action', LinkedTestNode).children()),
+            ['platformer', 'shmup'])
+        # without a parent column the trees can't be repaired
+        self.corrupt(TestNode, 'platformer', lft=10)
+        output, status = self.call_check('tests.TestNode', repair=True)
+        self.assertEqual(status, 1)
+
+class ConcurrencyTestCase(EasyTreeTestMixin, TransactionTestCase):
+    """
+    Several processes adding, moving and deleting nodes of the same trees at
+    once, PostgreSQL only.
+    """
+    workers = 4
+    operations = 20
+
+    def tearDown(self):
+        TestNode.objects.all().delete()
+
+    def work(self, seed):
+        rnd = random.Random(seed)
+        for i in range(self.operations):
+            nodes = list(TestNode.objects.all())
+            try:
+                if i % 5 == 3:
+                    TestNode.objects.move(rnd.choice(nodes), rnd.choice(nodes),
+                        rnd.choice(['left', 'right', 'first-child', 'last-child']))
+                elif i % 5 == 4:
+                    TestNode.objects.filter(pk=rnd.choice(nodes).pk, depth__gt=1).delete()
+                else:
+                    self.add_node('%d-%d' % (seed, i), rnd.choice(nodes),
+                        rnd.choice(['left', 'right', 'first-child', 'last-child']))
+            except (InvalidMoveToDescendant, TestNode.DoesNotExist):
+                # the nodes were moved or deleted by another process
+                pass
+
+    def test_concurrent_writers(self):
+        if settings.DATABASE_ENGINE not in ('postgresql', 'postgresql_psycopg2'):
+            return
+        self.build_tree()
+        count = TestNode.objects.count()
+
+        # every process needs its own connection
+        connection.close()
+        pids = []
+        for seed in range(self.workers):
+            pid = os.fork()
+            if not pid:
+                status = 0
+                try:
+                    self.work(seed)
+                except:
+                    traceback.print_exc()
+                    status = 1
+                os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        self.assertValidTree()
+        self.assertTrue(TestNode.objects.count() < count + self.workers * self.operations * 3 / 5)
+
+class BatchTestCase(EasyTreeTestCase):
+    """
+    Tests for EasyTreeManager.batch
+    """
+    operations = [
+        ('add', 'arcade', 'action', 'first-child'),
+        ('add', 'pinball', 'arcade', 'last-child'),
+        ('move', 'shmup', 'platformer_2d', 'left'),
+        ('add', 'puzzle', 'rpg', 'left'),
+        ('move', 'rpg', 'action', 'first-sibling'),
+        ('add', 'sokoban', 'puzzle', 'first-child'),
+        ('move', 'trpg', 'sokoban', 'right'),
+        ('move', 'puzzle', 'platformer', 'last-child'),
+        ('move', 'platformer_4d', 'platformer_4d', 'first-sibling'),
+        ('add', 'strategy', 'trpg', 'last-sibling'),
+    ]
+
+    def setUp(self):
+        self.build_tree()
+        self.build_tree(SparseTestNode)
+
+    def apply(self, model):
+        for operation, title, dest, pos in self.operations:
+            if operation == 'add':
+                self.add_node(title, self.node(dest, model), pos, model)
+            else:
+                model.objects.move(self.node(title, model), self.node(dest, model), pos)
+
+    def test_batch(self):
+        self.apply(SparseTestNode)
+        moved = []
+        def receiver(sender, node_moved, **kwargs):
+            moved.append(node_moved.title)
+        node_moved.connect(receiver, sender=TestNode)
+        try:
+            with TestNode.objects.batch():
+                self.apply(TestNode)
+                self.assertEqual(moved, [])
+        finally:
+            node_moved.disconnect(receiver, sender=TestNode)
+        self.assertEqual(moved, ['shmup', 'rpg', 'trpg', 'puzzle', 'platformer_4d'])
+        self.assertValidTree()
+        self.assertEqual(self.structure(TestNode), self.structure(SparseTestNode))
+
+    def test_rows_written(self):
+        start = rows_written(TestNode)
+        with TestNode.objects.batch():
+            for i in range(20):
+                self.add_node('platformer %d' % i, self.node('platformer'), 'first-child')
+        # the new nodes are inserted and updated once, the others are
+        # updated once at most
+        self.assertTrue(rows_written(TestNode) - start <= 2 * 20 + 11)
+        self.assertValidTree()
+        self.assertEqual(self.titles(self.node('platformer').children()[:2]),
+            ['platformer 19', 'platformer 18'])
+
+    def test_write(self):
+        moved = []
+        def receiver(sender, node_moved, **kwargs):
+            moved.append(node_moved.title)
+        node_moved.connect(receiver, sender=TestNode)
+        try:
+            with TestNode.objects.batch():
+                TestNode.objects.move(self.node('shmup'), self.node('platformer_2d'), 'left')
+                # written before the delete, which works on the stored values
+                TestNode.objects.filter(title='platformer').delete()
+                TestNode.objects.move(self.node('trpg'), self.node('action'), 'first-child')
+        finally:
+            node_moved.disconnect(receiver, sender=TestNode)
+        # shmup was deleted with platformer
+        self.assertEqual(moved, ['trpg'])
+        self.assertEqual(TestNode.objects.check(), {})
+        self.assertEqual(self.titles(TestNode.objects.get_tree()),
+            ['action', 'trpg', 'rpg', 'arpg'])
+
+        self.build_tree(LinkedTestNode)
+        with LinkedTestNode.objects.batch():
+            LinkedTestNode.objects.move(self.node('rpg', LinkedTestNode),
+                self.node('shmup', LinkedTestNode), 'last-child')
+            LinkedTestNode.objects.rebuild()
+        self.assertEqual(LinkedTestNode.objects.check(), {})
+        self.assertEqual(self.node('rpg', LinkedTestNode).depth, 3)
+
+    def test_move_root(self):
+        with TestNode.objects.batch():
+            self.add_node('puzzle')
+            TestNode.objects.move(self.node('action'), self.node('rpg'), 'last-child')
+        self.assertEqual(TestNode.objects.check(), {})
+        self.assertEqual(self.titles(TestNode.objects.get_root_nodes()), ['rpg', 'puzzle'])
+        self.assertEqual(self.titles(self.node('rpg').children()), ['arpg', 'trpg', 'action'])
+        self.assertEqual(self.titles(self.node('action').children()), ['platformer', 'shmup'])
+        self.assertEqual(self.node('platformer_2d').depth, 4)
+
+    def test_move_many(self):
+        moves = [('shmup', 'platformer_2d', 'left'), ('rpg', 'action', 'first-sibling'),
+            ('trpg', 'shmup', 'right'), ('platformer_4d', 'trpg', 'first-child'),
+            ('platformer', 'arpg', 'last-sibling')]
+        for title, dest, pos in moves:
+            SparseTestNode.objects.move(self.node(title, SparseTestNode),
+                self.node(dest, SparseTestNode), pos)
+        TestNode.objects.move_many([(self.node(title), self.node(dest), pos)
+            for title, dest, pos in moves])
+        self.assertValidTree()
+        self.assertEqual(self.structure(TestNode), self.structure(SparseTestNode))
+
+    def test_move_many_root(self):
+        # the first move lists the roots, the second one moves one of them
+        TestNode.objects.move_many([(self.node('shmup'), self.node('action'), 'left'),
+            (self.node('rpg'), self.node('platformer'), 'first-child')])
+        self.assertEqual(TestNode.objects.check(), {})
+        self.assertEqual(self.titles(TestNode.objects.get_root_nodes()), ['shmup', 'action'])
+        self.assertEqual(self.titles(self.node('platformer').children()),
+            ['rpg', 'platformer_2d', 'platformer_3d', 'platformer_4d'])
+        self.assertEqual(self.titles(self.node('rpg').children()), ['arpg', 'trpg'])
+        self.assertEqual(self.node('arpg').depth, 4)
+
+    def test_reorder_children(self):
+        platformer = self.node('platformer')
+        TestNode.objects.reorder_children(platformer,
+            [self.node('platformer_4d'), self.node('platformer_2d'), self.node('platformer_3d')])
+        self.assertEqual(self.titles(self.node('platformer').children()),
+            ['platformer_4d', 'platformer_2d', 'platformer_3d'])
+        TestNode.objects.reorder_children(None, [self.node('rpg'), self.node('action')])
+        self.assertEqual(self.titles(TestNode.objects.get_root_nodes()), ['rpg', 'action'])
+        self.assertValidTree()
+
+        for titles in (['platformer_2d', 'platformer_3d', 'platformer_4d', 'arpg'],
+                       ['platformer_2d', 'platformer_3d'],
+                       ['platformer_2d', 'platformer_3d', 'platformer_3d']):
+            self.assertRaises(InvalidPosition, TestNode.objects.reorder_children,
+                self.node('platformer'), [self.node(title) for title in titles])
+        self.assertRaises(InvalidPosition, TestNode.objects.reorder_children,
+            None, [self.node('rpg'), self.node('action'), self.node('shmup')])
+        self.assertEqual(self.titles(self.node('platformer').children()),
+            ['platformer_4d', 'platformer_2d', 'platformer_3d'])
+
+    def test_validators(self):
+        """
+        The moves of move_many are validated before the batch, which doesn't
+        run the validators.
+        """
+        TestNode.objects.filter(title='rpg').delete()
+        TestNode._easytree_meta.validators = [SingleRootAllowedValidator()]
+        try:
+            self.assertRaises(SingleRootAllowed, TestNode.objects.move_many, [
+                (self.node('platformer_2d'), self.node('shmup'), 'first-child'),
+                (self.node('shmup'), self.node('action'), 'right')])
+        finally:
+            TestNode._easytree_meta.validators = []
+        self.assertEqual(self.titles(TestNode.objects.get_root_nodes()), ['action'])
+        self.assertEqual(TestNode.objects.get_parent_for(self.node('platformer_2d')).title, 'platformer')
+
+    def test_admin(self):
+        model_admin = EasyTreeAdmin(TestNode, AdminSite())
+        def post(**data):
+            request = HttpRequest()
+            request.method = 'POST'
+            request.POST = QueryDict('').copy()
+            request.POST.update(data)
+            return simplejson.loads(model_admin.batch_move_view(request).content)
+        self.assertEqual(post(moves=simplejson.dumps([
+            [self.node('trpg').pk, self.node('shmup').pk, 'first-child'],
+            [self.node('arpg').pk, self.node('trpg').pk, 'right']])), {'success': True})
+        self.assertEqual(self.titles(self.node('shmup').children()),
+            ['trpg', 'arpg', 'shmup_vertical', 'shmup_horizontal'])
+        self.assertEqual(post(parent=str(self.node('shmup').pk), children=simplejson.dumps(
+            [self.node(title).pk for title in ('shmup_horizontal', 'trpg', 'arpg', 'shmup_vertical')])),
+            {'success': True})
+        self.assertEqual(self.titles(self.node('shmup').children()),
+            ['shmup_horizontal', 'trpg', 'arpg', 'shmup_vertical'])
+        self.assertValidTree()
+
+        self.assertEqual(post(moves=simplejson.dumps([
+            [self.node('trpg').pk, self.node('shmup').pk, 'first-child'],
+            [self.node('action').pk, self.node('trpg').pk, 'last-child']]))['success'], False)
+        self.assertEqual(self.titles(self.node('shmup').children())[0], 'shmup_horizontal')
+        self.assertEqual(post(children='[]')['success'], False)
+        self.assertEqual(post(parent=str(self.node('shmup').pk), children=simplejson.dumps(
+            [self.node('trpg').pk]))['success'], False)
+        self.assertEqual(post(moves=simplejson.dumps([
+            [self.node('trpg').pk, 0, 'first-child']])),
+            {'success': False, 'error': 'No such model instance'})
+
+class BatchTransactionTestCase(EasyTreeTestMixin, TransactionTestCase):
+    """
+    Tests for the transaction of EasyTreeManager.batch
+    """
+    def tearDown(self):
+        TestNode.objects.all().delete()
+
+    def test_rollback(self):
+        self.build_tree()
+        before = self.snapshot()
+        try:
+            with TestNode.objects.batch():
+                self.add_node('arcade', self.node('action'), 'first-child')
+                TestNode.objects.move(self.node('rpg'), self.node('action'), 'left')
+                TestNode.objects.move(self.node('action'), self.node('platformer'), 'last-child')
+        except InvalidMoveToDescendant:
+            pass
+        self.assertEqual(self.snapshot(), before)
+
+class ClosureTransactionTestCase(EasyTreeTestMixin, TransactionTestCase):
+    """
+    Tests for the transactions of the closure storage, PostgreSQL only.
+    """
+    def tearDown(self):
+        ClosureTestNode.objects.all().delete()
+
+    def test_insert_committed(self):
+        if settings.DATABASE_ENGINE not in ('postgresql', 'postgresql_psycopg2'):
+            return
+        self.build_tree(ClosureTestNode)
+        # the rows of the closure table are visible to other connections
+        other = connection.__class__(connection.settings_dict)
+        try:
+            cursor = other.cursor()
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(
+                ClosureTestNodeClosure._meta.db_table))
+            self.assertEqual(cursor.fetchone()[0], ClosureTestNodeClosure.objects.count())
+        finally:
+            other.close()
+        self.assertEqual(ClosureTestNode.objects.check(), {})
+
 def suite():
     s = unittest.TestSuite()
     s.addTest(EasyTreeManagerTestCase())
     s.addTest(doctest.DocFileSuite(os.path.join('doctests', 'tree_structure.txt')))
+    s.addTest(unittest.makeSuite(CachedTreeTestCase))
+    s.addTest(unittest.makeSuite(PredicatesTestCase))
+    s.addTest(unittest.makeSuite(BulkAncestorsTestCase))
+    s.addTest(unittest.makeSuite(MaterializedPathTestCase))
+    s.addTest(unittest.makeSuite(PrefetchChildrenTestCase))
+    s.addTest(unittest.makeSuite(MoveTestCase))
+    s.addTest(unittest.makeSuite(BulkLoadTestCase))
+    s.addTest(unittest.makeSuite(RebuildTestCase))
+    s.addTest(unittest.makeSuite(DeleteTestCase))
+    s.addTest(unittest.makeSuite(SparseTreeTestCase))
+    s.addTest(unittest.makeSuite(TreeIdSpacingTestCase))
+    s.addTest(unittest.makeSuite(SortedTestCase))
+    s.addTest(unittest.makeSuite(ParentFieldTestCase))
+    s.addTest(unittest.makeSuite(CheckTestCase))
+    s.addTest(unittest.makeSuite(ClosureTestCase))
+    s.addTest(unittest.makeSuite(SignalsTestCase))
+    s.addTest(unittest.makeSuite(InstrumentationTestCase))
+    s.addTest(unittest.makeSuite(CacheTestCase))
+    s.addTest(unittest.makeSuite(VersionsTestCase))
+    s.addTest(unittest.makeSuite(AdminTestCase))
+    s.addTest(unittest.makeSuite(AutocompleteTestCase))
+    s.addTest(unittest.makeSuite(BenchmarkTestCase))
+    s.addTest(unittest.makeSuite(BatchTestCase))
+    s.addTest(unittest.makeSuite(BatchTransactionTestCase))
+    s.addTest(unittest.makeSuite(ClosureTransactionTestCase))
+    s.addTest(unittest.makeSuite(ConcurrencyTestCase))
     return s
@@ -4,4 +4,70 @@ def get_toplevel_model(model):
         toplevel_model = list(parent_models)[0]
     else:
         toplevel_model = model
-    return toplevel_model
\ No newline at end of file
+    return toplevel_model
+
+def link_tree_nodes(nodes):
+    """
+    Links a list of nodes ordered by ``tree_id`` and ``lft`` to each other,
+    caching parent, children and ancestors on every node.
+
+    A node gets its parent cached only if the parent is in the list; a node
+    gets its ancestors cached only if all of them are in the list.
+
+    :returns: the nodes in the list whose parent is not in the list.
+    """
+    top_level = []
+    stack = []
+    for node in nodes:
+        while stack and (stack[-1].tree_id != node.tree_id or stack[-1].rgt < node.lft):
+            stack.pop()
+        node._cached_children = []
+        if stack and stack[-1].depth == node.depth - 1:
+            parent = stack[-1]
+            node._cached_parent_obj = parent
+            parent._cached_children.append(node)
+            if hasattr(parent, '_cached_ancestors'):
+                node._cached_ancestors = parent._cached_ancestors + [parent]
+        else:
+            top_level.append(node)
+            if node.depth == 1:
+                node._cached_ancestors = []
+        stack.append(node)
+    return top_level
+
+def number_tree(nodes, get_children, lft=1, depth=1, spacing=1):
+    """
+    Numbers a list of sibling nodes and all their descendants as a nested
+    set, using an explicit stack instead of recursion.
+
+    ``get_children`` is called with a node and must return its children.
+    With a ``spacing`` greater than 1, ``spacing - 1`` values are left free
+    between consecutive values, except between the ``lft`` and ``rgt`` of a
+    leaf.
+
+    :returns: a list of ``[node, lft, rgt, depth, parent]`` lists in DFS
+        order, ``parent`` being ``None`` for the given nodes.
+    """
+    numbered = []
+    stack = [(iter(nodes), None)]
+    counter = lft - spacing
+    while stack:
+        siblings, parent_row = stack[-1]
+        for node in siblings:
+            parent = None
+            if parent_row is not None:
+                parent = parent_row[0]
+            counter += spacing
+            row = [node, counter, None, depth + len(stack) - 1, parent]
+            numbered.append(row)
+            stack.append((iter(get_children(node)), row))
+            break
+        else:
+            stack.pop()
+            if parent_row is not None:
+                if counter == parent_row[1]:
+                    counter += 1
+                else:
+                    counter += spacing
+                parent_row[2] = counter
+    return numbered
@@ -0,0 +1,149 @@
+"""
+Version counters of the trees.
+
+With the ``version_model`` EasyTreeMeta option, every tree of the model has
+a row in the version model counting its changes and keeping the time of the
+last one. The rows are updated in the transaction of the change, when the
+trees are locked: adds, moves, deletes, batches, ``bulk_load``,
+``rebuild`` and ``resort_siblings``, and saves of existing nodes. Changes
+renumbering the trees update the rows of all the trees.
+
+The row with ``tree_id = 0`` only counts the changes of the forest itself:
+trees appended and changes of all the trees. The version of the whole forest
+is the sum of the versions of all the rows, so that changes of different
+trees don't wait for each other on a common row.
+
+:func:`condition_on_tree` turns them into ``ETag`` and ``Last-Modified``
+headers, answering the requests for unchanged trees with a ``304`` after a
+single query on the version model::
+
+    @condition_on_tree(Category)
+    def category_tree(request):
+        ...
+
+    @condition_on_tree(Category, lambda request, tree_id: int(tree_id))
+    def category_subtree(request, tree_id):
+        ...
+
+Changes made with ``QuerySet.update()`` or in raw SQL are not counted.
+"""
+from datetime import datetime
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Max, Sum
+from django.views.decorators.http import condition
+
+qn = connection.ops.quote_name
+
+FOREST = 0
+
+def get_versions(manager):
+    """
+    :returns: the version counters of the manager's model, or ``None`` if
+        they are not kept.
+    """
+    if manager.model._easytree_meta.version_model:
+        return TreeVersions(manager)
+    return None
+
+class TreeVersions(object):
+    """
+    Reads and updates the version rows of a model.
+    """
+    def __init__(self, manager):
+        self.model = manager.get_first_model()
+        self.version_model = self.model._easytree_meta.version_model
+        if isinstance(self.version_model, basestring):
+            self.version_model = models.get_model(self.model._meta.app_label, self.version_model)
+        meta = self.version_model._meta
+        self.sql_params = {
+            'table': qn(meta.db_table),
+            'tree_id_col': qn(meta.get_field('tree_id').column),
+            'version_col': qn(meta.get_field('version').column),
+            'modified_col': qn(meta.get_field('modified').column),
+        }
+
+    def get(self, tree_id=None):
+        """
+        :returns: the ``(version, modified)`` pair of a tree, or of the
+            forest if ``tree_id`` is ``None``; ``(0, None)`` for a tree
+            never changed.
+        """
+        if tree_id is None:
+            forest = self.version_model.objects.aggregate(Sum('version'), Max('modified'))
+            return (forest['version__sum'] or 0, forest['modified__max'])
+        try:
+            return self.version_model.objects.filter(tree_id=tree_id).values_list(
+                'version', 'modified')[0]
+        except IndexError:
+            return (0, None)
+
+    def touch(self, tree_ids=(), all_trees=False, forest=False):
+        """
+        Counts a change of the given trees, or of all the trees and of the
+        forest; with ``forest``, the change of the forest is counted as well,
+        e.g. for trees appended. The rows are written with SQL, leaving the
+        transaction open.
+        """
+        tree_ids = set([int(tree_id) for tree_id in tree_ids])
+        if forest or all_trees:
+            tree_ids.add(FOREST)
+        if not tree_ids:
+            return
+        now = datetime.now()
+        cursor = connection.cursor()
+        params = dict(self.sql_params, where='')
+        if not all_trees:
+            params['where'] = ' WHERE %s IN (%s)' % (params['tree_id_col'],
+                ', '.join([str(tree_id) for tree_id in tree_ids]))
+        cursor.execute('UPDATE %(table)s SET %(version_col)s = %(version_col)s + 1, '
+            ' %(modified_col)s = %%s%(where)s' % params, [now])
+        if not all_trees and cursor.rowcount == len(tree_ids):
+            return
+        missing = tree_ids - set(self.version_model.objects.filter(
+            tree_id__in=tree_ids).values_list('tree_id', flat=True))
+        for tree_id in sorted(missing):
+            sid = transaction.savepoint()
+            try:
+                cursor.execute('INSERT INTO %(table)s (%(tree_id_col)s, %(version_col)s, %(modified_col)s) '
+                    ' VALUES (%%s, 1, %%s)' % params, [tree_id, now])
+            except IntegrityError:
+                # inserted by a concurrent change since the UPDATE
+                transaction.savepoint_rollback(sid)
+                cursor.execute('UPDATE %(table)s SET %(version_col)s = %(version_col)s + 1, '
+                    ' %(modified_col)s = %%s WHERE %(tree_id_col)s = %%s' % params, [now, tree_id])
+            else:
+                transaction.savepoint_commit(sid)
+
+    def make_etag(self, tree_id, version):
+        """
+        :returns: the ETag of a version of a tree, or of the forest if
+            ``tree_id`` is ``None``.
+        """
+        return '%s.%s-%s-%d' % (self.model._meta.app_label, self.model._meta.module_name,
+            tree_id is None and 'all' or tree_id, version)
+
+def condition_on_tree(model, tree_id_func=None, key_func=None):
+    """
+    Decorates a view showing a tree of ``model``, or all its trees, with
+    the ``ETag`` and ``Last-Modified`` of its version. ``tree_id_func`` is
+    passed the arguments of the view and returns the ``tree_id`` of the
+    tree shown; without it, the version of the forest is used.
+    ``key_func`` returns a string added to the ETag, for views whose
+    content also depends on the request.
+    """
+    def get(request, *args, **kwargs):
+        # both headers are computed from the same row
+        try:
+            return request._easytree_version
+        except AttributeError:
+            versions = get_versions(model.objects)
+            tree_id = tree_id_func and tree_id_func(request, *args, **kwargs)
+            version, modified = versions.get(tree_id)
+            etag = versions.make_etag(tree_id, version)
+            if key_func is not None:
+                etag = '%s-%s' % (etag, key_func(request, *args, **kwargs))
+            request._easytree_version = (etag, modified)
+            return request._easytree_version
+    return condition(
+        etag_func=lambda request, *args, **kwargs: get(request, *args, **kwargs)[0],
+        last_modified_func=lambda request, *args, **kwargs: get(request, *args, **kwargs)[1])